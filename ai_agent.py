@@ -12,12 +12,17 @@ import logging
 import datetime
 import requests
 import base64
+from io import BytesIO
 from functools import lru_cache
+from PIL import Image
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 load_dotenv()
 
+# Ảnh gửi cho model được thu nhỏ về tối đa chiều rộng này (px) để giảm dung lượng request
+AGENT_IMAGE_MAX_WIDTH = int(os.getenv("AGENT_IMAGE_MAX_WIDTH", 1024))
+
 class AIAgent:
     def __init__(self):
         # Giới hạn request rate
@@ -56,7 +61,19 @@ class AIAgent:
             response = requests.get(url, stream=True, timeout=10)
             if response.status_code != 200:
                 return None
-            return base64.b64encode(response.content).decode("utf-8")
+            content = response.content
+            try:
+                # Thu nhỏ và nén lại dạng JPEG trước khi gửi cho model
+                with Image.open(BytesIO(content)) as img:
+                    img.draft('RGB', (AGENT_IMAGE_MAX_WIDTH, AGENT_IMAGE_MAX_WIDTH * 4))
+                    img = img.convert('RGB')
+                    img.thumbnail((AGENT_IMAGE_MAX_WIDTH, img.height), Image.LANCZOS)
+                    buf = BytesIO()
+                    img.save(buf, format='JPEG', quality=85)
+                    content = buf.getvalue()
+            except Exception as e:
+                logger.warning(f"Không thể thu nhỏ ảnh {url}, gửi ảnh gốc: {e}")
+            return base64.b64encode(content).decode("utf-8")
 
         @tool
         def analyze_image_from_url(image_url: str, question: str):
@@ -103,7 +120,8 @@ class AIAgent:
         trong cơ sở dữ liệu. Không bao giờ truy vấn tất cả các cột từ một bảng cụ thể,
         chỉ yêu cầu các cột có liên quan cho câu hỏi.
         2. Nếu cần xem và phân tích ảnh: 
-           - Query lấy URL ảnh từ DB.
+           - Query lấy URL ảnh từ DB. Với bảng fact_post_performance, ưu tiên bản thu nhỏ
+             picture_variants->>'1024' (nếu NULL thì dùng full_picture_url).
            - Dùng tool `analyze_image_from_url` với URL đó. Tool này sẽ trả về dữ liệu ảnh. 
            - Bạn tự sử dụng khả năng vision của mình để trả lời câu hỏi dựa trên dữ liệu ảnh nhận được.
 
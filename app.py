@@ -38,8 +38,13 @@ from database_manager import (
     User
 )
 from ai_agent import AIAgent
+from graph_client import get_graph_client
+from storage_manager import pick_picture_variant
+from page_token_manager import get_page_token_manager, is_token_error
 
 DATE_PRESET = ['today', 'yesterday', 'this_month', 'last_month', 'this_quarter', 'maximum', 'data_maximum', 'last_3d', 'last_7d', 'last_14d', 'last_28d', 'last_30d', 'last_90d', 'last_week_mon_sun', 'last_week_sun_sat', 'last_quarter', 'last_year', 'this_week_mon_today', 'this_week_sun_today', 'this_year']
+# Chiều rộng (px) ảnh thu nhỏ dùng trong các bảng Top Content
+TOP_POSTS_THUMBNAIL_WIDTH = int(os.getenv("TOP_POSTS_THUMBNAIL_WIDTH", 160))
 
 # --- BIẾN TOÀN CỤC ĐỂ KIỂM SOÁT TÁC VỤ CHẠY NGẦM ---
 task_status = {
@@ -68,6 +73,9 @@ login_manager.login_view = 'login'
 db_manager = DatabaseManager()
 # Tạo tất cả các bảng nếu chưa tồn tại
 db_manager.create_all_tables()
+# Cache Page Token (nạp từ dim_fanpage, token mới được lưu lại qua upsert_fanpages) và làm mới nền trước khi hết hạn
+page_token_manager = get_page_token_manager(loader=db_manager.get_page_tokens, saver=db_manager.upsert_fanpages)
+page_token_manager.start()
 # Khởi tạo AI Agent
 try:
     ai_analyst = AIAgent()
@@ -352,7 +360,8 @@ def get_task_status(task_type):
 def refresh_data():
     """
     [ASYNC] Kích hoạt quy trình làm mới dữ liệu Ads chạy ngầm.
-    [ĐÃ SỬA] Thực hiện refresh theo từng ngày (daily loop) để tránh timeout.
+    Refresh một lần cho cả khoảng ngày: Dimension lấy một lần, Insights lấy theo time_increment=1
+    cho toàn khoảng và nạp Fact theo lô.
     """
     # 1. Đọc trạng thái từ file
     current_status = load_task_status()
@@ -381,10 +390,9 @@ def refresh_data():
         def run_async_job(app_context, s_date_str, e_date_str, preset):
             import time
             from datetime import datetime, timedelta
-            
-            start_date_worker = datetime.strptime(s_date_str, '%Y-%m-%d').date()
-            end_date_worker = datetime.strptime(e_date_str, '%Y-%m-%d').date()
-            current_date_worker = start_date_worker
+
+            # Giữ logic D -> D+1 của vòng lặp theo ngày trước đây: lấy dư đến ngày sau ngày kết thúc
+            until_date_str = (datetime.strptime(e_date_str, '%Y-%m-%d').date() + timedelta(days=1)).strftime('%Y-%m-%d')
             
             with app_context: 
                 logger.info(">>> BẮT ĐẦU THREAD REFRESH ADS <<<")
@@ -395,27 +403,19 @@ def refresh_data():
                 status_update['ads_start_time'] = time.time()
                 save_task_status(status_update)
                 
+                # Mã job cố định theo khoảng ngày: bấm refresh lại sau khi dyno restart sẽ tiếp tục từ checkpoint
+                job_id = f"api-refresh-{s_date_str}-{e_date_str}-{preset or 'range'}"
                 try:
-                    while current_date_worker <= end_date_worker:
-                        current_date_str = current_date_worker.strftime('%Y-%m-%d')
-                        
-                        # D to D+1 logic (Giữ nguyên)
-                        until_date_obj = current_date_worker + timedelta(days=1)
-                        until_date_str = until_date_obj.strftime('%Y-%m-%d') 
-                        
-                        logger.info(f"THREAD ADS: Đang nạp {current_date_str}")
-
-                        try:
-                            db_manager.refresh_data(
-                                start_date=current_date_str, 
-                                end_date=until_date_str,
-                                date_preset=preset
-                            )
-                        except Exception as e:
-                            logger.error(f"Lỗi nạp ngày {current_date_str}: {e}")
-                        
-                        current_date_worker += timedelta(days=1)
-                        time.sleep(1) 
+                    # Khoảng ngày đã được tính sẵn từ preset nên chỉ truyền start/end
+                    logger.info(f"THREAD ADS: Đang nạp {s_date_str} -> {until_date_str} (preset: {preset})")
+                    db_manager.refresh_data(
+                        start_date=s_date_str,
+                        end_date=until_date_str,
+                        job_id=job_id
+                    )
+                    db_manager.clear_checkpoints(job_id)
+                except Exception as e:
+                    logger.error(f"Lỗi nạp dữ liệu Ads {s_date_str} -> {e_date_str}: {e}")
 
                 finally:
                     # [QUAN TRỌNG] Luôn cập nhật trạng thái về False dù có lỗi hay không
@@ -439,7 +439,7 @@ def refresh_data():
         thread.start()
         
         # 4. Trả về ngay lập tức
-        return jsonify({'message': 'Đã tiếp nhận yêu cầu! Dữ liệu đang được cập nhật ngầm (theo từng ngày).'})
+        return jsonify({'message': 'Đã tiếp nhận yêu cầu! Dữ liệu đang được cập nhật ngầm.'})
     
     except Exception as e:
         logger.error(f"Lỗi khi kích hoạt refresh: {e}", exc_info=True)
@@ -1060,6 +1060,9 @@ def get_breakdown_chart_data():
                 'messages_started': table_model.messages_started,
                 'post_engagement': table_model.post_engagement,
                 'link_click': table_model.link_click,
+                'leads': table_model.leads,
+                'add_to_cart': table_model.add_to_cart,
+                'video_views': table_model.video_views,
             }
             # Các metric cần AVG
             avg_metrics = {
@@ -1353,7 +1356,7 @@ def refresh_data_fanpage():
                 status_update['fanpage_refreshing'] = True
                 status_update['fanpage_start_time'] = time.time()
                 save_task_status(status_update)
-                
+
                 try:
                     while current_date_worker <= end_date_worker:
                         current_date_str = current_date_worker.strftime('%Y-%m-%d')
@@ -1373,7 +1376,6 @@ def refresh_data_fanpage():
                             logger.error(f"Lỗi nạp Fanpage ngày {current_date_str}: {e}")
                         
                         current_date_worker += timedelta(days=1)
-                        time.sleep(1) # Throttling
 
                 finally:
                     logger.info(">>> KẾT THÚC THREAD REFRESH FANPAGE <<<")
@@ -1662,6 +1664,7 @@ def get_fanpage_overview_data():
             return session.query(
                 FactPostPerformance.message,
                 FactPostPerformance.full_picture_url,
+                FactPostPerformance.picture_variants,
                 metric_column.label('metric_value')
             ).filter(FactPostPerformance.page_id == page_id)\
              .filter(FactPostPerformance.created_time.between(start_datetime, end_datetime))\
@@ -1673,10 +1676,14 @@ def get_fanpage_overview_data():
         top_likes = _get_top_posts(FactPostPerformance.lt_post_reactions_like_total)
         top_clicks = _get_top_posts(FactPostPerformance.lt_post_clicks)
 
+        # Bảng chỉ hiển thị ảnh nhỏ: dùng bản thu nhỏ nếu có, không thì ảnh gốc
+        def _thumbnail(row):
+            return pick_picture_variant(row.picture_variants, TOP_POSTS_THUMBNAIL_WIDTH) or row.full_picture_url
+
         top_content_data = {
-            'impressions': [{'message': row.message, 'image': row.full_picture_url, 'value': row.metric_value or 0} for row in top_impressions],
-            'likes': [{'message': row.message, 'image': row.full_picture_url, 'value': row.metric_value or 0} for row in top_likes],
-            'clicks': [{'message': row.message, 'image': row.full_picture_url, 'value': row.metric_value or 0} for row in top_clicks]
+            'impressions': [{'message': row.message, 'image': _thumbnail(row), 'value': row.metric_value or 0} for row in top_impressions],
+            'likes': [{'message': row.message, 'image': _thumbnail(row), 'value': row.metric_value or 0} for row in top_likes],
+            'clicks': [{'message': row.message, 'image': _thumbnail(row), 'value': row.metric_value or 0} for row in top_clicks]
         }
         
         # === 7. TỔNG HỢP VÀ TRẢ VỀ (Giữ nguyên) ===
@@ -1701,11 +1708,9 @@ def get_fanpage_overview_data():
 def get_fanpage_cover():
     """
     Lấy URL ảnh bìa (cover source) cho một page_id cụ thể.
-    Tự động refresh Page Token nếu gặp lỗi 190 (Token hết hạn).
+    Page Token lấy từ PageTokenManager; nếu gặp lỗi 190 (Token hết hạn) chỉ làm mới token của page này rồi thử lại.
     Thêm HARDCODE FALLBACK nếu API gọi thất bại.
     """
-    session = db_manager.SessionLocal()
-    
     # 1. Lấy page_id từ query param
     page_id = request.args.get('page_id')
     if not page_id:
@@ -1722,20 +1727,17 @@ def get_fanpage_cover():
     }
 
     try:
-        # 2. Lấy Page Access Token đã lưu trong CSDL
-        page = session.query(DimFanpage.page_access_token)\
-            .filter(DimFanpage.page_id == page_id)\
-            .first()
+        # 2. Lấy Page Access Token từ cache (nạp từ CSDL)
+        page_access_token = page_token_manager.get_token(page_id)
         
-        if not page or not page.page_access_token:
-            logger.error(f"Không tìm thấy token cho page_id {page_id} trong dim_fanpage.")
+        if not page_access_token:
+            logger.error(f"Không tìm thấy token cho page_id {page_id}.")
             # Chuyển qua Fallback
             if page_id in HARDCODE_COVER_URLS:
                 logger.info(f"Sử dụng HARDCODE fallback cho page_id {page_id}")
                 return jsonify({'cover_url': HARDCODE_COVER_URLS[page_id]})
             return jsonify({'error': 'Không tìm thấy Fanpage hoặc Page Access Token trong CSDL.'}), 404
         
-        page_access_token = page.page_access_token
         base_url = os.getenv("BASE_URL", "https://graph.facebook.com/v24.0")
         
         # 3. Định nghĩa hàm gọi API (để có thể retry)
@@ -1745,9 +1747,8 @@ def get_fanpage_cover():
                 'fields': 'cover{source}',
                 'access_token': token_to_use
             }
-            response = requests.get(api_url, params=params)
-            response.raise_for_status() # Ném lỗi (ví dụ: 190) nếu thất bại
-            return response.json()
+            # Dùng pool kết nối chung, ném lỗi (ví dụ: 190) nếu thất bại
+            return get_graph_client().get_json(api_url, params=params)
 
         # 4. Thử gọi API lần 1
         data = None
@@ -1756,38 +1757,19 @@ def get_fanpage_cover():
         
         except requests.exceptions.RequestException as e:
             # Kiểm tra xem có phải lỗi token hết hạn (190) không
-            is_token_error = False
-            if e.response is not None:
-                try:
-                    is_token_error = e.response.json().get('error', {}).get('code') == 190
-                except Exception:
-                    pass # Không phải lỗi JSON
-            
-            if is_token_error:
+            if is_token_error(e):
                 logger.warning(f"Token ảnh bìa cho {page_id} đã hết hạn. Đang làm mới...")
                 
-                # Import extractor (cần thiết cho logic này)
-                from fbads_extract import FacebookAdsExtractor
-                extractor = FacebookAdsExtractor()
-                
-                # B1: Lấy token mới (dùng User Token)
-                new_fanpages = extractor.get_all_fanpages()
-                
-                # B2: Cập nhật CSDL (dùng db_manager đã có)
-                db_manager.upsert_fanpages(new_fanpages) # upsert_fanpages tự quản lý session
-                
-                # B3: Tìm token mới cho page này
-                new_token = None
-                for new_page in new_fanpages:
-                    if new_page.get('id') == page_id:
-                        new_token = new_page.get('access_token')
-                        break
+                # B1: Bỏ token hỏng khỏi cache, lấy token mới cho riêng page này
+                #     (các request đồng thời dùng chung một lần làm mới)
+                page_token_manager.invalidate(page_id, page_access_token)
+                new_token = page_token_manager.get_token(page_id)
                         
                 if not new_token:
                     logger.error(f"Không tìm thấy token mới cho {page_id} sau khi làm mới.")
                     raise e # Ném lại lỗi gốc để except bên ngoài bắt
 
-                # B4: Thử lại (Lần 2) với token mới
+                # B2: Thử lại (Lần 2) với token mới
                 logger.info(f"Thử lại API ảnh bìa cho {page_id} với token mới...")
                 data = call_api(new_token) # Nếu thất bại lần 2, nó sẽ ném lỗi ra ngoài
                 
@@ -1833,8 +1815,6 @@ def get_fanpage_cover():
             return jsonify({'cover_url': HARDCODE_COVER_URLS[page_id]})
             
         return jsonify({'error': 'Lỗi server nội bộ.'}), 500
-    finally:
-        session.close()
 
 # ======================================================================
 # API ENDPOINTS - CAMPAIGN ANALYSIS (GEO MAP)
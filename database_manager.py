@@ -1,15 +1,21 @@
 import os
+import io
+import csv
 import logging
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import Dict, List, Any, Set, Optional
-from datetime import datetime, timedelta
+from datetime import datetime, date, timedelta
 from dotenv import load_dotenv
 from flask import json
 import requests
-from sqlalchemy import UniqueConstraint, create_engine, Column, String, DateTime, MetaData, Table, ForeignKey, func, Float, BigInteger, Integer, Date, Boolean
+from sqlalchemy import UniqueConstraint, create_engine, or_, update, text, Column, String, DateTime, MetaData, Table, ForeignKey, func, Float, BigInteger, Integer, Date, Boolean
 from sqlalchemy.orm import sessionmaker, declarative_base
-from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.postgresql import insert as pg_insert, JSONB
 import pytz
 import time
+import pandas as pd
 from geopy.geocoders import Nominatim
 from geopy.extra.rate_limiter import RateLimiter
 from flask_login import UserMixin
@@ -20,9 +26,69 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Đồng bộ Dimension (Campaign/Adset/Ad) theo updated_time
+# - DIM_INCREMENTAL_SYNC: bật/tắt chế độ incremental (tắt = lấy lại toàn bộ theo khoảng ngày mỗi lần refresh)
+# - DIM_FULL_SYNC_INTERVAL_HOURS: chu kỳ full sync định kỳ cho mỗi tài khoản
+# - DIM_SYNC_OVERLAP_SECONDS: lùi mốc updated_time một chút để không bỏ sót object cập nhật sát mốc
+DIM_INCREMENTAL_SYNC = os.getenv("DIM_INCREMENTAL_SYNC", "true").lower() in ("1", "true", "yes")
+DIM_FULL_SYNC_INTERVAL_HOURS = float(os.getenv("DIM_FULL_SYNC_INTERVAL_HOURS", 168))
+DIM_SYNC_OVERLAP_SECONDS = int(os.getenv("DIM_SYNC_OVERLAP_SECONDS", 300))
+# Số dòng insights gom lại trước mỗi lần upsert vào một bảng Fact
+FACT_UPSERT_BATCH_ROWS = int(os.getenv("FACT_UPSERT_BATCH_ROWS", 5000))
+# Số trang insights tối đa chờ trong hàng đợi nạp; thread extract bị chặn khi hàng đợi đầy (giới hạn bộ nhớ)
+FACT_LOAD_QUEUE_PAGES = int(os.getenv("FACT_LOAD_QUEUE_PAGES", 32))
+# Nạp Fact bằng COPY vào bảng staging tạm rồi INSERT ... SELECT ... ON CONFLICT (thay vì một câu INSERT khổng lồ)
+# - FACT_COPY_LOAD: bật/tắt đường COPY
+# - FACT_COPY_MIN_ROWS: lô nhỏ hơn ngưỡng này vẫn dùng INSERT ... VALUES (COPY không đáng chi phí tạo staging)
+# - FACT_COPY_BATCH_ROWS: số dòng mỗi lần COPY + INSERT ... SELECT
+FACT_COPY_LOAD = os.getenv("FACT_COPY_LOAD", "true").lower() in ("1", "true", "yes")
+FACT_COPY_MIN_ROWS = int(os.getenv("FACT_COPY_MIN_ROWS", 1000))
+FACT_COPY_BATCH_ROWS = int(os.getenv("FACT_COPY_BATCH_ROWS", 50000))
+# Transform insights dạng cột (pandas): trường số trong bản ghi thô
+INSIGHT_ID_FIELDS = ['date_start', 'ad_id', 'adset_id', 'campaign_id']
+INSIGHT_INT_FIELDS = ['impressions', 'clicks', 'reach']
+INSIGHT_FLOAT_FIELDS = ['spend', 'ctr', 'cpm', 'frequency']
+# Registry duy nhất ánh xạ action_type của Meta -> cột trong các bảng Fact insights.
+# Mỗi dòng: (tên cột, trường nguồn 'actions' | 'action_values', action_type, kiểu int | float).
+# Thêm một dòng ở đây là đủ: cột được thêm vào model + ALTER TABLE, được bóc tách khi transform
+# và được cập nhật khi ON CONFLICT.
+ACTION_MAPPINGS = [
+    ('messages_started', 'actions', 'onsite_conversion.messaging_conversation_started_7d', int),
+    ('purchases', 'actions', 'onsite_conversion.purchase', int),
+    ('purchase_value', 'action_values', 'onsite_conversion.purchase', float),
+    ('post_engagement', 'actions', 'post_engagement', int),
+    ('link_click', 'actions', 'link_click', int),
+    ('leads', 'actions', 'lead', int),
+    ('add_to_cart', 'actions', 'omni_add_to_cart', int),
+    ('video_views', 'actions', 'video_view', int),
+]
+# Các cột chỉ số được cập nhật khi trùng khóa (giống nhau cho mọi bảng Fact insights)
+FACT_METRIC_COLUMNS = ['spend', 'impressions', 'clicks', 'ctr', 'cpm', 'reach', 'frequency'] + \
+    [column for column, _, _, _ in ACTION_MAPPINGS]
+# Làm mới metrics LIFETIME của post theo tier: (tuổi tối đa của post, khoảng cách tối thiểu giữa 2 lần làm mới)
+# - Post < 3 ngày: mỗi lần chạy; < 30 ngày: mỗi ngày; cũ hơn: mỗi tuần
+# - POST_REFRESH_SLACK_MINUTES: dung sai để job chạy hằng ngày không bị lệch sang ngày hôm sau
+POST_REFRESH_TIERS = [
+    (timedelta(days=3), timedelta(0)),
+    (timedelta(days=30), timedelta(days=1)),
+    (None, timedelta(days=7)),
+]
+POST_REFRESH_SLACK_MINUTES = float(os.getenv("POST_REFRESH_SLACK_MINUTES", 60))
+# Chế độ incremental của refresh_data: luôn lấy lại N ngày cuối (cửa sổ attribution, purchases còn thay đổi)
+# cộng các ngày chưa có trong bảng Fact; các ngày cũ hơn đã nạp thì bỏ qua
+INCREMENTAL_ATTRIBUTION_DAYS = int(os.getenv("INCREMENTAL_ATTRIBUTION_DAYS", 7))
+# Key etl_state lưu các ngày insights còn lỗi theo tài khoản ({account_id: [ngày]}) để incremental lấy lại
+FAILED_INSIGHT_DATES_KEY = 'insights_failed_dates'
+
 # SQLAlchemy Base (Lớp cơ sở cho các model)
 Base = declarative_base()
 
+# Các cột action (sinh từ ACTION_MAPPINGS) dùng chung cho mọi bảng Fact insights
+ActionMetricsMixin = type('ActionMetricsMixin', (), {
+    column: Column(Integer, default=0) if kind is int else Column(Float, default=0.0)
+    for column, _, _, kind in ACTION_MAPPINGS
+})
+
 def parse_datetime_flexible(date_string: str) -> Optional[datetime]:
     """
     Thử phân tích một chuỗi ngày tháng với nhiều định dạng khác nhau.
@@ -45,6 +111,161 @@ def parse_datetime_flexible(date_string: str) -> Optional[datetime]:
     logger.warning(f"Không thể phân tích chuỗi ngày tháng: '{date_string}' với các định dạng đã biết.")
     return None
 
+def post_refresh_tier(created_time: Optional[datetime], updated_at: Optional[datetime], now: datetime) -> Optional[int]:
+    """
+    Trả về chỉ số tier (trong POST_REFRESH_TIERS) nếu metrics lifetime của post đã đến hạn làm mới,
+    hoặc None nếu chưa đến hạn.
+    """
+    if created_time is None:
+        return 0
+    if created_time.tzinfo is not None:
+        created_time = created_time.astimezone(pytz.utc).replace(tzinfo=None)
+    age = now - created_time
+    for tier, (max_age, interval) in enumerate(POST_REFRESH_TIERS):
+        if max_age is not None and age >= max_age:
+            continue
+        if updated_at is None or now - updated_at >= interval - timedelta(minutes=POST_REFRESH_SLACK_MINUTES):
+            return tier
+        return None
+    return None
+
+
+def incremental_date_ranges(start_date: str, end_date: str, loaded_dates: Set[date],
+                            trailing_days: int = INCREMENTAL_ATTRIBUTION_DAYS) -> List[tuple]:
+    """
+    Trả về các khoảng ngày liên tiếp (YYYY-MM-DD, bao gồm 2 đầu) cần lấy lại trong [start_date, end_date]:
+    `trailing_days` ngày cuối cùng và mọi ngày chưa có trong loaded_dates.
+    """
+    start_obj = datetime.strptime(start_date, '%Y-%m-%d').date()
+    end_obj = datetime.strptime(end_date, '%Y-%m-%d').date()
+    trailing_start = end_obj - timedelta(days=max(trailing_days, 0) - 1)
+
+    ranges = []
+    current = start_obj
+    while current <= end_obj:
+        if current >= trailing_start or current not in loaded_dates:
+            if ranges and ranges[-1][1] == current - timedelta(days=1):
+                ranges[-1][1] = current
+            else:
+                ranges.append([current, current])
+        current += timedelta(days=1)
+    return [(s.isoformat(), e.isoformat()) for s, e in ranges]
+
+
+def update_failed_insight_dates(pending: Dict[str, List[str]], fetched: List[tuple],
+                                account_ids: List[str]) -> Dict[str, List[str]]:
+    """
+    Cập nhật danh sách ngày insights còn lỗi theo tài khoản ({account_id: ['YYYY-MM-DD', ...]}).
+    fetched: [(start_date, end_date, failed_account_ids)] của các khoảng vừa lấy - ngày của tài khoản lỗi
+    được thêm vào, ngày của tài khoản thành công được xóa khỏi danh sách.
+    """
+    for start_date, end_date, failed_ids in fetched:
+        start_obj = datetime.strptime(start_date, '%Y-%m-%d').date()
+        end_obj = datetime.strptime(end_date, '%Y-%m-%d').date()
+        days = {(start_obj + timedelta(days=i)).isoformat() for i in range((end_obj - start_obj).days + 1)}
+        for account_id in account_ids:
+            current = set(pending.get(account_id, ()))
+            current = current | days if account_id in failed_ids else current - days
+            if current:
+                pending[account_id] = sorted(current)
+            else:
+                pending.pop(account_id, None)
+    return pending
+
+
+def _pivot_actions(frame: pd.DataFrame, field: str) -> pd.DataFrame:
+    """
+    Explode list `field` ('actions' / 'action_values') của cả trang một lần, giữ các action_type có trong
+    ACTION_MAPPINGS rồi pivot thành các cột (action_type trùng lặp: lấy giá trị cuối). Dòng không có action = 0.
+    """
+    mappings = [(column, action_type, kind) for column, source, action_type, kind in ACTION_MAPPINGS if source == field]
+    action_columns = {action_type: column for column, action_type, _ in mappings}
+    dtypes = {column: 'int64' if kind is int else 'float64' for column, _, kind in mappings}
+    columns = list(dtypes)
+    empty = pd.DataFrame(0, index=frame.index, columns=columns).astype(dtypes)
+    if not columns or field not in frame.columns:
+        return empty
+    exploded = frame[field].dropna().explode().dropna()
+    if exploded.empty:
+        return empty
+    actions = pd.DataFrame(exploded.tolist(), index=exploded.index)
+    if 'action_type' not in actions.columns or 'value' not in actions.columns:
+        return empty
+    actions = actions[actions['action_type'].isin(list(action_columns))]
+    if actions.empty:
+        return empty
+    actions = pd.DataFrame({
+        'row': actions.index,
+        'column': actions['action_type'].map(action_columns).to_numpy(),
+        'value': pd.to_numeric(actions['value'], errors='coerce').to_numpy(),
+    })
+    pivot = actions.pivot_table(index='row', columns='column', values='value', aggfunc='last')
+    return pivot.reindex(index=frame.index, columns=columns).fillna(0).astype(dtypes)
+
+
+def transform_insights_frame(insights_data: List[Dict[str, Any]], breakdown_fields: List[str]) -> pd.DataFrame:
+    """
+    Chuyển một lô bản ghi insights thô thành DataFrame dạng cột có kiểu (một lượt cho cả lô):
+    các trường ID + `breakdown_fields` (giữ nguyên), các chỉ số int/float và các cột action
+    theo ACTION_MAPPINGS. Bỏ các bản ghi thiếu một trong INSIGHT_ID_FIELDS.
+    """
+    frame = pd.DataFrame.from_records(insights_data)
+    for field in INSIGHT_ID_FIELDS + list(breakdown_fields) + INSIGHT_INT_FIELDS + INSIGHT_FLOAT_FIELDS:
+        if field not in frame.columns:
+            frame[field] = None
+    ids = frame[INSIGHT_ID_FIELDS]
+    frame = frame[(ids.notna() & (ids != '')).all(axis=1)]
+
+    columns = {field: frame[field] for field in INSIGHT_ID_FIELDS + list(breakdown_fields)}
+    for field in INSIGHT_INT_FIELDS:
+        columns[field] = pd.to_numeric(frame[field], errors='coerce').fillna(0).astype('int64')
+    for field in INSIGHT_FLOAT_FIELDS:
+        columns[field] = pd.to_numeric(frame[field], errors='coerce').fillna(0.0).astype('float64')
+    result = pd.DataFrame(columns, index=frame.index)
+    return result.join(_pivot_actions(frame, 'actions')).join(_pivot_actions(frame, 'action_values'))
+
+
+def frame_to_records(frame: pd.DataFrame, columns: List[str]) -> List[Dict[str, Any]]:
+    """
+    Chuyển các cột đã chọn thành list dict kiểu Python (NaN/NA -> None) để upsert.
+    """
+    subset = frame[columns].astype(object)
+    return subset.where(subset.notna(), None).to_dict('records')
+
+
+def date_key_for(d: date) -> int:
+    """
+    Khóa dim_date (YYYYMMDD) tính trực tiếp từ ngày, không cần tra bảng.
+    """
+    return d.year * 10000 + d.month * 100 + d.day
+
+
+def date_keys_for(values: pd.Series) -> pd.Series:
+    """
+    Bản vector hóa của date_key_for cho một cột chuỗi 'YYYY-MM-DD' (giá trị không hợp lệ -> NaN).
+    """
+    dates = pd.to_datetime(values.astype(str).str.slice(0, 10), format='%Y-%m-%d', errors='coerce')
+    return dates.dt.year * 10000 + dates.dt.month * 100 + dates.dt.day
+
+
+def dim_date_record(d: date) -> Dict[str, Any]:
+    return {
+        'date_key': date_key_for(d),
+        'full_date': d,
+        'day': d.day,
+        'month': d.month,
+        'year': d.year,
+        'quarter': (d.month - 1) // 3 + 1
+    }
+
+
+def dedupe_by_keys(records: List[Dict[str, Any]], key_fields: tuple) -> List[Dict[str, Any]]:
+    """
+    Loại bỏ các bản ghi trùng khóa (giữ bản ghi xuất hiện sau cùng).
+    PostgreSQL không cho INSERT ... ON CONFLICT DO UPDATE cập nhật cùng một dòng 2 lần trong một câu lệnh.
+    """
+    return list({tuple(r[f] for f in key_fields): r for r in records}.values())
+
 # --- ĐỊNH NGHĨA STAR SCHEMA ---
 
 class User(Base, UserMixin):
@@ -151,7 +372,7 @@ class DimDate(Base):
     year = Column(Integer)
     quarter = Column(Integer)
 
-class FactPerformancePlatform(Base):
+class FactPerformancePlatform(ActionMetricsMixin, Base):
     """
     Bảng Fact: Lưu trữ các chỉ số hiệu suất chi tiết theo từng breakdown theo nền tảng và vị trí quảng cáo.
     """
@@ -173,16 +394,12 @@ class FactPerformancePlatform(Base):
     cpm = Column(Float, default=0.0)
     reach = Column(BigInteger, default=0)
     frequency = Column(Float, default=0.0)
-    
-    messages_started = Column(Integer, default=0)
-    purchases = Column(Integer, default=0)
-    purchase_value = Column(Float, default=0.0)
-    post_engagement = Column(Integer, default=0)
-    link_click = Column(Integer, default=0)
-    
+
+    # Các cột action (messages_started, purchases, ...) lấy từ ActionMetricsMixin
+
     __table_args__ = (UniqueConstraint('date_key', 'ad_id', 'platform_id', 'placement_id', name='_ad_performance_platform_uc'),)
 
-class FactPerformanceDemographic(Base):
+class FactPerformanceDemographic(ActionMetricsMixin, Base):
     """
     Bảng Fact: Lưu trữ các chỉ số hiệu suất chi tiết theo từng breakdown theo nhân khẩu học.
     """
@@ -204,12 +421,8 @@ class FactPerformanceDemographic(Base):
     cpm = Column(Float, default=0.0)
     reach = Column(BigInteger, default=0)
     frequency = Column(Float, default=0.0)
-    
-    messages_started = Column(Integer, default=0)
-    purchases = Column(Integer, default=0)
-    purchase_value = Column(Float, default=0.0)
-    post_engagement = Column(Integer, default=0)
-    link_click = Column(Integer, default=0)
+
+    # Các cột action (messages_started, purchases, ...) lấy từ ActionMetricsMixin
 
     __table_args__ = (UniqueConstraint('date_key', 'ad_id', 'gender', 'age', name='_ad_performance_demographic_uc'),)
 
@@ -264,6 +477,8 @@ class FactPostPerformance(Base):
     post_type = Column(String, nullable=True)
     message = Column(String, nullable=True)
     full_picture_url = Column(String, nullable=True)
+    # Các bản thu nhỏ WebP của ảnh: {"160": url, "480": url, ...}
+    picture_variants = Column(JSONB, nullable=True)
     
     # Các chỉ số Lifetime (LT)
     shares_count = Column(Integer, default=0)
@@ -288,7 +503,7 @@ class DimRegion(Base):
     longitude = Column(Float, nullable=True)
     updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
 
-class FactPerformanceRegion(Base):
+class FactPerformanceRegion(ActionMetricsMixin, Base):
     """
     Bảng Fact: Lưu trữ các chỉ số hiệu suất chi tiết theo breakdown khu vực.
     """
@@ -312,16 +527,361 @@ class FactPerformanceRegion(Base):
     cpm = Column(Float, default=0.0)
     reach = Column(BigInteger, default=0)
     frequency = Column(Float, default=0.0)
-    
-    messages_started = Column(Integer, default=0)
-    purchases = Column(Integer, default=0)
-    purchase_value = Column(Float, default=0.0)
-    post_engagement = Column(Integer, default=0)
-    link_click = Column(Integer, default=0)
+
+    # Các cột action (messages_started, purchases, ...) lấy từ ActionMetricsMixin
 
     # Ràng buộc duy nhất
     __table_args__ = (UniqueConstraint('date_key', 'ad_id', 'region_id', name='_ad_performance_region_uc'),)
 
+class EtlCheckpoint(Base):
+    """
+    Bảng kỹ thuật: Lưu cursor phân trang đã nạp xong của từng luồng insights
+    (job, tài khoản, breakdown, khoảng ngày) để job chạy lại có thể tiếp tục từ trang dở dang.
+    """
+    __tablename__ = 'etl_checkpoint'
+
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    job_id = Column(String, nullable=False, index=True)
+    account_id = Column(String, nullable=False)
+    breakdown = Column(String, nullable=False)
+    date_window = Column(String, nullable=False) # 'YYYY-MM-DD:YYYY-MM-DD' hoặc tên date_preset
+    after_cursor = Column(String) # Cursor 'after' của trang kế tiếp cần lấy
+    pages_loaded = Column(Integer, default=0)
+    is_completed = Column(Boolean, default=False)
+    updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
+
+    __table_args__ = (UniqueConstraint('job_id', 'account_id', 'breakdown', 'date_window', name='_etl_checkpoint_uc'),)
+
+class EtlState(Base):
+    """
+    Bảng kỹ thuật: Lưu trạng thái dạng key-value của ETL giữa các lần chạy
+    (VD: mốc updated_time của Dimension theo tài khoản, thời điểm full sync gần nhất).
+    """
+    __tablename__ = 'etl_state'
+
+    state_key = Column(String, primary_key=True)
+    state_value = Column(String)
+    updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
+
+# --- CHECKPOINT PHÂN TRANG ---
+
+class PaginationCheckpoint:
+    """
+    Checkpoint của một luồng phân trang insights, được extractor gọi sau mỗi trang đã nạp vào DB.
+    - after: cursor để tiếp tục (None nếu bắt đầu từ trang đầu)
+    - completed: luồng đã nạp xong toàn bộ trong job này
+    """
+
+    def __init__(self, db_manager: 'DatabaseManager', job_id: str, account_id: str, breakdown: str, date_window: str):
+        self.db_manager = db_manager
+        self.key = {
+            'job_id': job_id,
+            'account_id': account_id,
+            'breakdown': breakdown,
+            'date_window': date_window,
+        }
+        self.after = None
+        self.completed = False
+        self.pages_loaded = 0
+
+        session = db_manager.SessionLocal()
+        try:
+            record = session.query(EtlCheckpoint).filter_by(**self.key).first()
+            if record:
+                self.after = record.after_cursor
+                self.completed = bool(record.is_completed)
+                self.pages_loaded = record.pages_loaded or 0
+        finally:
+            session.close()
+
+    def _save(self):
+        values = dict(self.key, after_cursor=self.after, pages_loaded=self.pages_loaded, is_completed=self.completed)
+        stmt = pg_insert(EtlCheckpoint).values(values)
+        on_conflict_stmt = stmt.on_conflict_do_update(
+            constraint='_etl_checkpoint_uc',
+            set_={
+                'after_cursor': stmt.excluded.after_cursor,
+                'pages_loaded': stmt.excluded.pages_loaded,
+                'is_completed': stmt.excluded.is_completed,
+                'updated_at': datetime.now()
+            }
+        )
+        session = self.db_manager.SessionLocal()
+        try:
+            session.execute(on_conflict_stmt)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def commit(self, after_cursor: Optional[str]):
+        """
+        Ghi nhận một trang đã nạp xong; after_cursor là cursor của trang kế tiếp.
+        """
+        self.after = after_cursor
+        self.pages_loaded += 1
+        self._save()
+
+    def complete(self):
+        """
+        Đánh dấu luồng đã nạp hết dữ liệu.
+        """
+        self.after = None
+        self.completed = True
+        self._save()
+
+    def for_window(self, since: str, until: str) -> 'PaginationCheckpoint':
+        """
+        Checkpoint con cho một cửa sổ ngày nhỏ hơn (khi extractor chia nhỏ khoảng ngày).
+        """
+        return PaginationCheckpoint(self.db_manager, self.key['job_id'], self.key['account_id'], self.key['breakdown'], f"{since}:{until}")
+
+# --- NẠP FACT THEO LÔ (MICRO-BATCH) ---
+
+class FactUpsertBuffer:
+    """
+    Gom các trang insights của một bảng Fact thành lô lớn (FACT_UPSERT_BATCH_ROWS dòng) trước khi upsert,
+    để mỗi lô chỉ tốn một câu lệnh INSERT ... ON CONFLICT thay vì một câu lệnh cho mỗi trang 100 dòng.
+    Các checkpoint phân trang của những trang trong lô chỉ được ghi sau khi lô đã upsert xong.
+    Mọi thao tác chạy dưới `lock` dùng chung (các lần nạp được tuần tự hóa).
+
+    Buffer dùng chung cho mọi tài khoản ghi cùng bảng Fact, nên khi một lô lỗi, buffer bị đánh dấu
+    hỏng (`failed`) cho cả lần chạy: các dòng của lô lỗi được giữ lại để đẩy lại ở lần flush sau,
+    và mọi checkpoint (commit/complete) sau đó đều bị bỏ qua - lần chạy lại sẽ lấy lại các trang này.
+    """
+
+    def __init__(self, upsert_fn, lock: threading.Lock, before_flush=None, batch_rows: int = None):
+        self.upsert_fn = upsert_fn
+        self.lock = lock
+        self.before_flush = before_flush
+        self.batch_rows = batch_rows or FACT_UPSERT_BATCH_ROWS
+        self.records = []
+        self.deferred_commits = []
+        self.failed: Optional[Exception] = None
+
+    def add(self, records: List[Dict[str, Any]]):
+        with self.lock:
+            self.records.extend(records)
+            if len(self.records) >= self.batch_rows:
+                self._flush_locked()
+
+    def defer(self, commit_fn):
+        """
+        Hoãn một lần ghi checkpoint tới khi lô hiện tại được upsert.
+        """
+        with self.lock:
+            if self.failed is not None:
+                return
+            if self.records:
+                self.deferred_commits.append(commit_fn)
+                return
+        commit_fn()
+
+    def flush(self):
+        with self.lock:
+            self._flush_locked()
+
+    def _flush_locked(self):
+        if self.records:
+            records, self.records = self.records, []
+            try:
+                if self.before_flush:
+                    self.before_flush(records)
+                self.upsert_fn(records)
+            except Exception as e:
+                # Giữ lại các dòng để đẩy lại; từ giờ không ghi checkpoint nào nữa trong lần chạy này
+                self.records = records + self.records
+                self.deferred_commits = []
+                self.failed = e
+                raise
+        commits, self.deferred_commits = self.deferred_commits, []
+        if self.failed is not None:
+            return
+        for commit_fn in commits:
+            commit_fn()
+
+
+class FactLoadPipeline:
+    """
+    Hàng đợi có giới hạn giữa các thread extract (producer) và một thread nạp (consumer):
+    thread extract chỉ đẩy công việc (thêm trang vào FactUpsertBuffer, ghi checkpoint) vào hàng đợi rồi
+    quay lại gọi API ngay, trong khi thread nạp upsert các lô vào CSDL song song.
+    - Hàng đợi đầy (FACT_LOAD_QUEUE_PAGES) thì submit() bị chặn -> bộ nhớ không tăng theo độ dài khoảng ngày.
+    - Công việc chạy đúng thứ tự submit, nên checkpoint của một trang luôn được ghi sau khi trang đó vào lô.
+    - Lỗi khi nạp được ghi log và trả về ở close(); lô lỗi không được ghi checkpoint (xem FactUpsertBuffer).
+    """
+
+    _STOP = object()
+
+    def __init__(self, max_pages: int = None):
+        self.queue = queue.Queue(maxsize=max_pages or FACT_LOAD_QUEUE_PAGES)
+        self.errors: List[Exception] = []
+        self._thread = threading.Thread(target=self._run, name='fact-loader', daemon=True)
+        self._thread.start()
+
+    def submit(self, fn):
+        self.queue.put(fn)
+
+    def _run(self):
+        while True:
+            fn = self.queue.get()
+            if fn is self._STOP:
+                return
+            try:
+                fn()
+            except Exception as e:
+                logger.error(f"Lỗi khi nạp lô Fact (pipeline): {e}", exc_info=True)
+                self.errors.append(e)
+
+    def close(self) -> List[Exception]:
+        """
+        Chờ thread nạp xử lý hết hàng đợi rồi dừng. Trả về danh sách lỗi đã gặp.
+        """
+        self.queue.put(self._STOP)
+        self._thread.join()
+        return self.errors
+
+
+class BufferedCheckpoint:
+    """
+    Checkpoint bọc ngoài cho một luồng phân trang khi nạp qua FactUpsertBuffer:
+    commit() được hoãn tới khi lô chứa trang đó đã upsert; complete() đẩy lô còn lại trước khi đánh dấu xong.
+    `checkpoint` có thể là None (không bật resume) - khi đó chỉ đảm bảo lô cuối được đẩy.
+    Nếu có `pipeline`, commit()/complete() được xếp hàng sau các trang đã submit thay vì chạy ngay.
+    """
+
+    def __init__(self, buffer: FactUpsertBuffer, checkpoint: Optional[PaginationCheckpoint] = None,
+                 pipeline: Optional[FactLoadPipeline] = None):
+        self.buffer = buffer
+        self.checkpoint = checkpoint
+        self.pipeline = pipeline
+
+    def _run(self, fn):
+        if self.pipeline is not None:
+            self.pipeline.submit(fn)
+        else:
+            fn()
+
+    @property
+    def completed(self) -> bool:
+        return bool(self.checkpoint and self.checkpoint.completed)
+
+    @property
+    def after(self) -> Optional[str]:
+        return self.checkpoint.after if self.checkpoint else None
+
+    @property
+    def pages_loaded(self) -> int:
+        return self.checkpoint.pages_loaded if self.checkpoint else 0
+
+    def commit(self, after_cursor: Optional[str]):
+        if self.checkpoint:
+            self._run(lambda: self.buffer.defer(lambda: self.checkpoint.commit(after_cursor)))
+
+    def complete(self):
+        self._run(self._complete)
+
+    def _complete(self):
+        self.buffer.flush()
+        # Buffer đã từng lỗi: không đánh dấu xong (có thể còn trang của luồng này chưa được ghi)
+        if self.checkpoint and self.buffer.failed is None:
+            self.checkpoint.complete()
+
+    def for_window(self, since: str, until: str) -> 'BufferedCheckpoint':
+        return BufferedCheckpoint(self.buffer, self.checkpoint.for_window(since, until) if self.checkpoint else None,
+                                  self.pipeline)
+
+# --- CACHE KHÓA DIMENSION ---
+
+class DimensionKeyCache:
+    """
+    Cache trong process ánh xạ khóa tự nhiên -> khóa thay thế cho các Dimension nhỏ
+    (dim_platform, dim_placement, dim_region) và tập date_key đã có trong dim_date.
+
+    - Mỗi bảng được nạp toàn bộ một lần (lần đầu dùng), sau đó chỉ giá trị MỚI mới chạm tới CSDL:
+      INSERT ... ON CONFLICT DO NOTHING RETURNING, rồi SELECT lại những giá trị do process khác vừa tạo.
+    - Bản ghi mới được commit ngay trước khi vào cache (fact lỗi/rollback không làm cache trỏ tới ID không tồn tại).
+    - Thread-safe: mọi thao tác chạy dưới một lock.
+    """
+
+    def __init__(self):
+        self._maps: Dict[str, Dict[str, int]] = {}
+        self._date_keys: Optional[Set[int]] = None
+        self._lock = threading.Lock()
+
+    def get_or_create(self, session, model, column_name: str, values: Set[str], pk_name: str) -> Dict[str, int]:
+        values = {value for value in values if value is not None}
+        if not values:
+            return {}
+        table_name = model.__tablename__
+        name_column, pk_column = getattr(model, column_name), getattr(model, pk_name)
+        with self._lock:
+            mapping = self._maps.get(table_name)
+            if mapping is None:
+                mapping = dict(session.query(name_column, pk_column).all())
+                self._maps[table_name] = mapping
+                logger.info(f"Đã nạp {len(mapping)} khóa của {table_name} vào cache.")
+
+            new_values = values - mapping.keys()
+            if new_values:
+                stmt = pg_insert(model).values([{column_name: value} for value in new_values]) \
+                    .on_conflict_do_nothing(index_elements=[column_name]) \
+                    .returning(name_column, pk_column)
+                created = dict(session.execute(stmt).all())
+                # Xung đột (process khác vừa tạo) không được RETURNING trả về -> lấy lại ID
+                conflicted = new_values - created.keys()
+                if conflicted:
+                    created.update(session.query(name_column, pk_column).filter(name_column.in_(conflicted)).all())
+                session.commit()
+                mapping.update(created)
+                logger.info(f"Đã tạo và map {len(created)} bản ghi mới trong bảng {table_name}.")
+            return {value: mapping[value] for value in values if value in mapping}
+
+    def ensure_dates(self, session, date_keys: Set[int]):
+        """
+        Đảm bảo các date_key (YYYYMMDD) đã có trong dim_date (khóa ngoại của bảng Fact).
+        """
+        with self._lock:
+            if self._date_keys is None:
+                self._date_keys = {row[0] for row in session.query(DimDate.date_key)}
+            new_keys = set(date_keys) - self._date_keys
+            if not new_keys:
+                return
+            records = [dim_date_record(date(key // 10000, key // 100 % 100, key % 100)) for key in sorted(new_keys)]
+            session.execute(pg_insert(DimDate).values(records).on_conflict_do_nothing(index_elements=['full_date']))
+            session.commit()
+            self._date_keys.update(new_keys)
+
+    def add_dates(self, date_keys: Set[int]):
+        with self._lock:
+            if self._date_keys is not None:
+                self._date_keys.update(date_keys)
+
+    def clear(self):
+        """
+        Xóa cache (VD: sau khi xóa/tạo lại bảng).
+        """
+        with self._lock:
+            self._maps.clear()
+            self._date_keys = None
+
+
+_dimension_caches: Dict[str, DimensionKeyCache] = {}
+_dimension_caches_lock = threading.Lock()
+
+
+def get_dimension_key_cache(db_url: str) -> DimensionKeyCache:
+    """
+    Trả về DimensionKeyCache dùng chung cho mọi DatabaseManager cùng db_url trong process.
+    """
+    with _dimension_caches_lock:
+        cache = _dimension_caches.get(db_url)
+        if cache is None:
+            cache = _dimension_caches[db_url] = DimensionKeyCache()
+        return cache
+
 # --- CLASS QUẢN LÝ DATABASE ---
 
 class DatabaseManager:
@@ -337,6 +897,10 @@ class DatabaseManager:
             
         self.engine = create_engine(self.db_url)
         self.SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=self.engine)
+        # Tuần tự hóa các lần nạp Fact từ nhiều thread extract (streaming refresh)
+        self._load_lock = threading.Lock()
+        # Cache khóa Dimension nhỏ + dim_date dùng chung trong process
+        self.dim_cache = get_dimension_key_cache(self.db_url)
         logger.info("Đã khởi tạo DatabaseManager.")
         self.base_url = os.getenv('BASE_URL', 'https://graph.facebook.com/v24.0')
 
@@ -346,10 +910,29 @@ class DatabaseManager:
         """
         try:
             Base.metadata.create_all(bind=self.engine, checkfirst=True)
+            self._ensure_columns()
             logger.info("Tất cả các bảng trong Star Schema đã được kiểm tra/tạo.")
         except Exception as e:
             logger.error(f"Lỗi khi tạo bảng: {e}")
 
+    # Các cột thêm sau khi bảng đã tồn tại (create_all không tự thêm cột vào bảng cũ)
+    _ADDED_COLUMNS = [
+        ('fact_post_performance', 'picture_variants', 'JSONB'),
+    ] + [
+        # Cột action mới thêm vào ACTION_MAPPINGS
+        (table_name, column, 'INTEGER DEFAULT 0' if kind is int else 'DOUBLE PRECISION DEFAULT 0')
+        for table_name in ('fact_performance_platform', 'fact_performance_demographic', 'fact_performance_region')
+        for column, _, _, kind in ACTION_MAPPINGS
+    ]
+
+    def _ensure_columns(self):
+        """
+        Thêm các cột mới (nếu chưa có) vào các bảng đã tồn tại.
+        """
+        with self.engine.begin() as conn:
+            for table_name, column_name, column_type in self._ADDED_COLUMNS:
+                conn.execute(text(f'ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS {column_name} {column_type}'))
+
     # === Hàm tiện ích để điền dữ liệu cho DimDate ===
     def upsert_dates(self, start_date: datetime, end_date: datetime):
         """
@@ -361,14 +944,7 @@ class DatabaseManager:
             dates_to_insert = []
             current_date = start_date
             while current_date <= end_date:
-                dates_to_insert.append({
-                    'date_key': int(current_date.strftime('%Y%m%d')),
-                    'full_date': current_date.date(),
-                    'day': current_date.day,
-                    'month': current_date.month,
-                    'year': current_date.year,
-                    'quarter': (current_date.month - 1) // 3 + 1
-                })
+                dates_to_insert.append(dim_date_record(current_date.date()))
                 current_date += timedelta(days=1)
 
             if not dates_to_insert:
@@ -380,6 +956,7 @@ class DatabaseManager:
             
             session.execute(on_conflict_stmt)
             session.commit()
+            self.dim_cache.add_dates({record['date_key'] for record in dates_to_insert})
             logger.info(f"Đã upsert {len(dates_to_insert)} ngày vào dim_date.")
         except Exception as e:
             logger.error(f"Lỗi khi upsert dates: {e}")
@@ -439,6 +1016,7 @@ class DatabaseManager:
                 'ad_account_id': camp['account_id']
             })
 
+        prepared_data = dedupe_by_keys(prepared_data, ('campaign_id',))
         stmt = pg_insert(DimCampaign).values(prepared_data)
         on_conflict_stmt = stmt.on_conflict_do_update(
             index_elements=['campaign_id'],
@@ -451,14 +1029,16 @@ class DatabaseManager:
                 'stop_time': stmt.excluded.stop_time,
                 'ad_account_id': stmt.excluded.ad_account_id,
                 'updated_at': datetime.now()
-            }
+            },
+            # Chỉ cập nhật các dòng có thay đổi thực sự
+            where=or_(*[getattr(DimCampaign, col).is_distinct_from(getattr(stmt.excluded, col)) for col in ['name', 'objective', 'status', 'created_time', 'start_time', 'stop_time', 'ad_account_id']])
         )
         
         session = self.SessionLocal()
         try:
-            session.execute(on_conflict_stmt)
+            result = session.execute(on_conflict_stmt)
             session.commit()
-            logger.info(f"Đã Upsert thành công {len(prepared_data)} chiến dịch vào dim_campaign.")
+            logger.info(f"Đã Upsert thành công {len(prepared_data)} chiến dịch vào dim_campaign ({result.rowcount} dòng mới/thay đổi).")
         except Exception as e:
             logger.error(f"Lỗi khi Upsert Campaigns: {e}")
             session.rollback()
@@ -487,6 +1067,7 @@ class DatabaseManager:
                 'ad_account_id': adset.get('account_id')
             })
 
+        prepared_data = dedupe_by_keys(prepared_data, ('adset_id',))
         stmt = pg_insert(DimAdset).values(prepared_data)
         on_conflict_stmt = stmt.on_conflict_do_update(
             index_elements=['adset_id'],
@@ -500,14 +1081,16 @@ class DatabaseManager:
                 'campaign_id': stmt.excluded.campaign_id,
                 'ad_account_id': stmt.excluded.ad_account_id,
                 'updated_at': datetime.now()
-            }
+            },
+            # Chỉ cập nhật các dòng có thay đổi thực sự
+            where=or_(*[getattr(DimAdset, col).is_distinct_from(getattr(stmt.excluded, col)) for col in ['name', 'status', 'created_time', 'start_time', 'end_time', 'campaign_id', 'ad_account_id']])
         )
         
         session = self.SessionLocal()
         try:
-            session.execute(on_conflict_stmt)
+            result = session.execute(on_conflict_stmt)
             session.commit()
-            logger.info(f"Đã Upsert thành công {len(prepared_data)} nhóm quảng cáo vào dim_adset.")
+            logger.info(f"Đã Upsert thành công {len(prepared_data)} nhóm quảng cáo vào dim_adset ({result.rowcount} dòng mới/thay đổi).")
         except Exception as e:
             logger.error(f"Lỗi khi Upsert Adsets: {e}")
             session.rollback()
@@ -537,6 +1120,7 @@ class DatabaseManager:
                 'ad_account_id': ad.get('account_id')
             })
 
+        prepared_data = dedupe_by_keys(prepared_data, ('ad_id',))
         stmt = pg_insert(DimAd).values(prepared_data)
         on_conflict_stmt = stmt.on_conflict_do_update(
             index_elements=['ad_id'],
@@ -551,14 +1135,16 @@ class DatabaseManager:
                 'campaign_id': stmt.excluded.campaign_id,
                 'ad_account_id': stmt.excluded.ad_account_id,
                 'updated_at': datetime.now()
-            }
+            },
+            # Chỉ cập nhật các dòng có thay đổi thực sự
+            where=or_(*[getattr(DimAd, col).is_distinct_from(getattr(stmt.excluded, col)) for col in ['name', 'status', 'created_time', 'ad_schedule_start_time', 'ad_schedule_end_time', 'adset_id', 'campaign_id', 'ad_account_id']])
         )
         
         session = self.SessionLocal()
         try:
-            session.execute(on_conflict_stmt)
+            result = session.execute(on_conflict_stmt)
             session.commit()
-            logger.info(f"Đã Upsert thành công {len(prepared_data)} quảng cáo vào dim_ad.")
+            logger.info(f"Đã Upsert thành công {len(prepared_data)} quảng cáo vào dim_ad ({result.rowcount} dòng mới/thay đổi).")
         except Exception as e:
             logger.error(f"Lỗi khi Upsert Ads: {e}")
             session.rollback()
@@ -569,37 +1155,9 @@ class DatabaseManager:
     def _get_or_create_dim_records(self, session, model, column_name: str, values: Set[str], pk_name: str) -> Dict[str, int]:
         """
         Hàm helper chung để lấy hoặc tạo các bản ghi trong bảng dimension.
-        Trả về một dictionary map từ tên -> id.
+        Trả về một dictionary map từ tên -> id (qua DimensionKeyCache, chỉ giá trị mới mới chạm CSDL).
         """
-        if not values:
-            return {}
-        
-        # 1. Lấy các bản ghi đã tồn tại
-        existing_records = session.query(model).filter(getattr(model, column_name).in_(values)).all()
-        mapping = {getattr(r, column_name): getattr(r, pk_name) for r in existing_records}
-        
-        # 2. Xác định các giá trị mới cần insert
-        new_values_set = values - set(mapping.keys())
-        
-        # 3. Insert các giá trị mới nếu có
-        if new_values_set:
-            new_records_data = [{column_name: val} for val in new_values_set]
-            
-            # Insert các bản ghi mới (không cần return_defaults)
-            session.bulk_insert_mappings(model, new_records_data)
-            session.commit()
-            
-            # Sau khi commit, query lại chính các bản ghi đó để lấy ID
-            logger.info(f"Đã tạo {len(new_records_data)} bản ghi. Đang lấy lại ID...")
-            inserted_records = session.query(model).filter(getattr(model, column_name).in_(new_values_set)).all()
-            
-            # Cập nhật lại mapping với các bản ghi vừa tạo
-            for record in inserted_records:
-                mapping[getattr(record, column_name)] = getattr(record, pk_name)
-            
-            logger.info(f"Đã tạo và map {len(inserted_records)} bản ghi mới trong bảng {model.__tablename__}.")
-            
-        return mapping
+        return self.dim_cache.get_or_create(session, model, column_name, values, pk_name)
 
     def upsert_performance_platform_data(self, insights_data: List[Dict[str, Any]]):
         """
@@ -615,97 +1173,31 @@ class DatabaseManager:
             # --- BƯỚC 1: Tải trước các Dimension vào bộ nhớ ---
             
             # Lấy tất cả các giá trị duy nhất từ dữ liệu thô
-            all_dates = {rec['date_start'] for rec in insights_data if 'date_start' in rec}
             all_platforms = {rec['publisher_platform'] for rec in insights_data if 'publisher_platform' in rec}
             all_placements = {rec['platform_position'] for rec in insights_data if 'platform_position' in rec}
 
             # Lấy mapping từ DB hoặc tạo mới nếu chưa có
-            date_map = {str(r.full_date): r.date_key for r in session.query(DimDate.full_date, DimDate.date_key).filter(DimDate.full_date.in_([datetime.fromisoformat(d).date() for d in all_dates]))}
             platform_map = self._get_or_create_dim_records(session, DimPlatform, 'platform_name', all_platforms, 'platform_id')
             placement_map = self._get_or_create_dim_records(session, DimPlacement, 'placement_name', all_placements, 'placement_id')
 
             # --- BƯỚC 2: Chuẩn bị dữ liệu để load vào Fact Table ---
-            prepared_data = []
-            for record in insights_data:
-                # Bỏ qua các bản ghi không có các ID chính
-                if not all([record.get('date_start'), record.get('ad_id'), record.get('adset_id'), record.get('campaign_id')]):
-                    continue
-
-                # Bóc tách các giá trị từ 'actions' và 'action_values'
-                messages_started = 0
-                purchases = 0
-                purchase_value = 0.0
-                post_engagement = 0
-                link_click = 0
-
-                if 'actions' in record:
-                    for action in record.get('actions', []):
-                        action_type = action.get('action_type')
-                        value = int(action.get('value', 0))
-                        if action_type == 'onsite_conversion.messaging_conversation_started_7d':
-                            messages_started = value
-                        elif action_type == 'onsite_conversion.purchase':
-                            purchases = value
-                        elif action_type == 'post_engagement':
-                            post_engagement = value
-                        elif action_type == 'link_click':
-                            link_click = value
-                
-                if 'action_values' in record:
-                    for action in record.get('action_values', []):
-                        if action.get('action_type') == 'onsite_conversion.purchase':
-                            purchase_value = float(action.get('value', 0.0))
-
-                # Map dữ liệu thô với các khóa ngoại đã tra cứu
-                fact_record = {
-                    'date_key': date_map.get(record['date_start']),
-                    'campaign_id': record['campaign_id'],
-                    'adset_id': record['adset_id'],
-                    'ad_id': record['ad_id'],
-                    'platform_id': platform_map.get(record.get('publisher_platform')),
-                    'placement_id': placement_map.get(record.get('platform_position')),
-                    'spend': float(record.get('spend', 0.0)),
-                    'impressions': int(record.get('impressions', 0)),
-                    'clicks': int(record.get('clicks', 0)),
-                    'ctr': float(record.get('ctr', 0.0)),
-                    'cpm': float(record.get('cpm', 0.0)),
-                    'reach': int(record.get('reach', 0)),
-                    'frequency': float(record.get('frequency', 0.0)),
-                    'messages_started': messages_started,
-                    'purchases': purchases,
-                    'purchase_value': purchase_value,
-                    'post_engagement': post_engagement,
-                    'link_click': link_click
-                }
-                # Chỉ thêm vào danh sách nếu có date_key hợp lệ
-                if fact_record['date_key']:
-                    prepared_data.append(fact_record)
+            frame = transform_insights_frame(insights_data, ['publisher_platform', 'platform_position'])
+            frame['date_key'] = date_keys_for(frame['date_start'])
+            frame['platform_id'] = frame['publisher_platform'].map(platform_map).astype('Int64')
+            frame['placement_id'] = frame['platform_position'].map(placement_map).astype('Int64')
+            # Chỉ giữ các dòng có ngày hợp lệ
+            frame = frame[frame['date_key'].notna()].astype({'date_key': 'int64'})
+            self.dim_cache.ensure_dates(session, set(frame['date_key'].tolist()))
+            prepared_data = frame_to_records(frame, ['date_key', 'campaign_id', 'adset_id', 'ad_id',
+                                                     'platform_id', 'placement_id'] + FACT_METRIC_COLUMNS)
 
             if not prepared_data:
                 logger.warning("Không có dữ liệu hợp lệ để chèn vào fact_performance_platform sau khi chuẩn bị.")
                 return
 
             # --- BƯỚC 3: Load hàng loạt vào Fact Table ---
-            stmt = pg_insert(FactPerformancePlatform).values(prepared_data)
-            on_conflict_stmt = stmt.on_conflict_do_update(
-                constraint='_ad_performance_platform_uc', # Sử dụng Unique Constraint đã định nghĩa
-                set_={
-                    'spend': stmt.excluded.spend,
-                    'impressions': stmt.excluded.impressions,
-                    'clicks': stmt.excluded.clicks,
-                    'ctr': stmt.excluded.ctr,
-                    'cpm': stmt.excluded.cpm,
-                    'reach': stmt.excluded.reach,
-                    'frequency': stmt.excluded.frequency,
-                    'messages_started': stmt.excluded.messages_started,
-                    'purchases': stmt.excluded.purchases,
-                    'purchase_value': stmt.excluded.purchase_value,
-                    'post_engagement': stmt.excluded.post_engagement,
-                    'link_click': stmt.excluded.link_click
-                }
-            )
-            
-            session.execute(on_conflict_stmt)
+            prepared_data = dedupe_by_keys(prepared_data, ('date_key', 'ad_id', 'platform_id', 'placement_id'))
+            self._bulk_upsert_fact(session, FactPerformancePlatform, prepared_data, '_ad_performance_platform_uc')
             session.commit()
             logger.info(f"Đã Upsert thành công {len(prepared_data)} bản ghi vào fact_performance_platform.")
 
@@ -719,7 +1211,6 @@ class DatabaseManager:
     def upsert_performance_demographic_data(self, insights_data: List[Dict[str, Any]]):
         """
         Thực hiện 'UPSERT' cho bảng fact_performance_demographic.
-        Sử dụng phương pháp "Pre-loading Dimensions" để tối ưu hiệu suất.
         """
         if not insights_data:
             logger.info("Không có dữ liệu performance demographic để upsert.")
@@ -727,96 +1218,23 @@ class DatabaseManager:
 
         session = self.SessionLocal()
         try:
-            # --- BƯỚC 1: Tải trước các Dimension vào bộ nhớ ---
-            
-            # Lấy tất cả các giá trị duy nhất từ dữ liệu thô
-            all_dates = {rec['date_start'] for rec in insights_data if 'date_start' in rec}
-
-            # Lấy mapping từ DB hoặc tạo mới nếu chưa có
-            date_map = {str(r.full_date): r.date_key for r in session.query(DimDate.full_date, DimDate.date_key).filter(DimDate.full_date.in_([datetime.fromisoformat(d).date() for d in all_dates]))}
-
-            # --- BƯỚC 2: Chuẩn bị dữ liệu để load vào Fact Table ---
-            prepared_data = []
-            for record in insights_data:
-                # Bỏ qua các bản ghi không có các ID chính
-                if not all([record.get('date_start'), record.get('ad_id'), record.get('adset_id'), record.get('campaign_id')]):
-                    continue
-
-                # Bóc tách các giá trị từ 'actions' và 'action_values'
-                messages_started = 0
-                purchases = 0
-                purchase_value = 0.0
-                post_engagement = 0
-                link_click = 0
-
-                if 'actions' in record:
-                    for action in record.get('actions', []):
-                        action_type = action.get('action_type')
-                        value = int(action.get('value', 0))
-                        if action_type == 'onsite_conversion.messaging_conversation_started_7d':
-                            messages_started = value
-                        elif action_type == 'onsite_conversion.purchase':
-                            purchases = value
-                        elif action_type == 'post_engagement':
-                            post_engagement = value
-                        elif action_type == 'link_click':
-                            link_click = value
-                
-                if 'action_values' in record:
-                    for action in record.get('action_values', []):
-                        if action.get('action_type') == 'onsite_conversion.purchase':
-                            purchase_value = float(action.get('value', 0.0))
-
-                # Map dữ liệu thô với các khóa ngoại đã tra cứu
-                fact_record = {
-                    'date_key': date_map.get(record['date_start']),
-                    'campaign_id': record['campaign_id'],
-                    'adset_id': record['adset_id'],
-                    'ad_id': record['ad_id'],
-                    'gender': record.get('gender', 'Unknown'),
-                    'age': record.get('age', 'Unknown'),
-                    'spend': float(record.get('spend', 0.0)),
-                    'impressions': int(record.get('impressions', 0)),
-                    'clicks': int(record.get('clicks', 0)),
-                    'ctr': float(record.get('ctr', 0.0)),
-                    'cpm': float(record.get('cpm', 0.0)),
-                    'reach': int(record.get('reach', 0)),
-                    'frequency': float(record.get('frequency', 0.0)),
-                    'messages_started': messages_started,
-                    'purchases': purchases,
-                    'purchase_value': purchase_value,
-                    'post_engagement': post_engagement,
-                    'link_click': link_click
-                }
-                # Chỉ thêm vào danh sách nếu có date_key hợp lệ
-                if fact_record['date_key']:
-                    prepared_data.append(fact_record)
+            # --- BƯỚC 1: Chuẩn bị dữ liệu để load vào Fact Table ---
+            frame = transform_insights_frame(insights_data, ['gender', 'age'])
+            frame['date_key'] = date_keys_for(frame['date_start'])
+            frame[['gender', 'age']] = frame[['gender', 'age']].fillna('Unknown')
+            # Chỉ giữ các dòng có ngày hợp lệ
+            frame = frame[frame['date_key'].notna()].astype({'date_key': 'int64'})
+            self.dim_cache.ensure_dates(session, set(frame['date_key'].tolist()))
+            prepared_data = frame_to_records(frame, ['date_key', 'campaign_id', 'adset_id', 'ad_id',
+                                                     'gender', 'age'] + FACT_METRIC_COLUMNS)
 
             if not prepared_data:
                 logger.warning("Không có dữ liệu hợp lệ để chèn vào fact_performance_demographic sau khi chuẩn bị.")
                 return
 
-            # --- BƯỚC 3: Load hàng loạt vào Fact Table ---
-            stmt = pg_insert(FactPerformanceDemographic).values(prepared_data)
-            on_conflict_stmt = stmt.on_conflict_do_update(
-                constraint='_ad_performance_demographic_uc', # Sử dụng Unique Constraint đã định nghĩa
-                set_={
-                    'spend': stmt.excluded.spend,
-                    'impressions': stmt.excluded.impressions,
-                    'clicks': stmt.excluded.clicks,
-                    'ctr': stmt.excluded.ctr,
-                    'cpm': stmt.excluded.cpm,
-                    'reach': stmt.excluded.reach,
-                    'frequency': stmt.excluded.frequency,
-                    'messages_started': stmt.excluded.messages_started,
-                    'purchases': stmt.excluded.purchases,
-                    'purchase_value': stmt.excluded.purchase_value,
-                    'post_engagement': stmt.excluded.post_engagement,
-                    'link_click': stmt.excluded.link_click
-                }
-            )
-            
-            session.execute(on_conflict_stmt)
+            # --- BƯỚC 2: Load hàng loạt vào Fact Table ---
+            prepared_data = dedupe_by_keys(prepared_data, ('date_key', 'ad_id', 'gender', 'age'))
+            self._bulk_upsert_fact(session, FactPerformanceDemographic, prepared_data, '_ad_performance_demographic_uc')
             session.commit()
             logger.info(f"Đã Upsert thành công {len(prepared_data)} bản ghi vào fact_performance_demographic.")
 
@@ -827,6 +1245,55 @@ class DatabaseManager:
         finally:
             session.close()
 
+    def _bulk_upsert_fact(self, session, model, rows: List[Dict[str, Any]], constraint: str):
+        """
+        Upsert các dòng đã chuẩn bị vào bảng Fact `model` (trong transaction của `session`, chưa commit).
+        Lô lớn (>= FACT_COPY_MIN_ROWS) đi qua COPY vào bảng staging; lô nhỏ dùng INSERT ... VALUES như cũ.
+        """
+        if FACT_COPY_LOAD and len(rows) >= FACT_COPY_MIN_ROWS:
+            self._copy_upsert(session, model, rows, constraint)
+            return
+        stmt = pg_insert(model).values(rows)
+        session.execute(stmt.on_conflict_do_update(
+            constraint=constraint,
+            set_={column: stmt.excluded[column] for column in FACT_METRIC_COLUMNS}
+        ))
+
+    def _copy_upsert(self, session, model, rows: List[Dict[str, Any]], constraint: str):
+        """
+        COPY ... FROM STDIN các dòng vào bảng tạm (TEMP, không ghi WAL) theo từng lô FACT_COPY_BATCH_ROWS,
+        sau mỗi lô chạy một câu INSERT ... SELECT ... ON CONFLICT DO UPDATE vào bảng Fact.
+        """
+        table = model.__tablename__
+        staging = f"staging_{table}"
+        columns = list(rows[0].keys())
+        column_list = ', '.join(columns)
+        set_clause = ', '.join(f"{column} = EXCLUDED.{column}" for column in FACT_METRIC_COLUMNS)
+
+        # Bảng tạm sống theo connection (được tái sử dụng qua pool), chỉ tạo một lần.
+        # Chỉ gồm các cột được nạp (không có id/DEFAULT nextval) để COPY không tiêu tốn sequence của bảng Fact.
+        session.execute(text(
+            f"CREATE TEMP TABLE IF NOT EXISTS {staging} ON COMMIT DELETE ROWS AS "
+            f"SELECT {column_list} FROM {table} WITH NO DATA"
+        ))
+        upsert_sql = text(
+            f"INSERT INTO {table} ({column_list}) SELECT {column_list} FROM {staging} "
+            f"ON CONFLICT ON CONSTRAINT {constraint} DO UPDATE SET {set_clause}"
+        )
+        cursor = session.connection().connection.cursor()
+        try:
+            for offset in range(0, len(rows), FACT_COPY_BATCH_ROWS):
+                buffer = io.StringIO()
+                writer = csv.writer(buffer)
+                for row in rows[offset:offset + FACT_COPY_BATCH_ROWS]:
+                    writer.writerow(['' if row[column] is None else row[column] for column in columns])
+                buffer.seek(0)
+                cursor.copy_expert(f"COPY {staging} ({column_list}) FROM STDIN WITH (FORMAT csv)", buffer)
+                session.execute(upsert_sql)
+                session.execute(text(f"TRUNCATE {staging}"))
+        finally:
+            cursor.close()
+
     def upsert_fanpages(self, fanpages_data: List[Dict[str, Any]]):
         """
         Thực hiện 'UPSERT' cho bảng dim_fanpage.
@@ -882,21 +1349,21 @@ class DatabaseManager:
 
         session = self.SessionLocal()
         try:
-            # 1. Tải trước DimDate
+            # 1. Tính date_key và đảm bảo có trong DimDate
             all_dates_str = {rec['date'] for rec in metrics_data if 'date' in rec}
             if not all_dates_str:
                 logger.warning("Dữ liệu page metrics không có trường 'date'.")
                 return
                 
-            all_dates_obj = {datetime.strptime(d, '%Y-%m-%d').date() for d in all_dates_str}
-            date_map = {str(r.full_date): r.date_key for r in session.query(DimDate.full_date, DimDate.date_key).filter(DimDate.full_date.in_(all_dates_obj))}
+            date_map = {d: date_key_for(datetime.strptime(d, '%Y-%m-%d').date()) for d in all_dates_str}
+            self.dim_cache.ensure_dates(session, set(date_map.values()))
 
             # 2. Chuẩn bị dữ liệu
             prepared_data = []
             for record in metrics_data:
                 date_key = date_map.get(record.get('date'))
                 if not date_key:
-                    continue # Bỏ qua nếu ngày không có trong DimDate
+                    continue # Bỏ qua nếu bản ghi không có ngày
 
                 prepared_data.append({
                     'date_key': date_key,
@@ -966,6 +1433,7 @@ class DatabaseManager:
                 'post_type': post.get('properties'),
                 'message': post.get('message'),
                 'full_picture_url': post.get('full_picture_url'),
+                'picture_variants': post.get('picture_variants'),
                 'shares_count': post.get('shares_count', 0),
                 'comments_total_count': post.get('comments_total_count', 0),
                 'lt_post_reactions_like_total': post.get('post_reactions_like_total', 0),
@@ -987,6 +1455,7 @@ class DatabaseManager:
                 'post_type': stmt.excluded.post_type,
                 'message': stmt.excluded.message,
                 'full_picture_url': func.coalesce(stmt.excluded.full_picture_url, FactPostPerformance.full_picture_url),
+                'picture_variants': func.coalesce(stmt.excluded.picture_variants, FactPostPerformance.picture_variants),
                 'shares_count': stmt.excluded.shares_count,
                 'comments_total_count': stmt.excluded.comments_total_count,
                 'lt_post_reactions_like_total': stmt.excluded.lt_post_reactions_like_total,
@@ -1009,6 +1478,87 @@ class DatabaseManager:
         finally:
             session.close()
 
+    def get_post_refresh_states(self, page_ids: List[str]) -> Dict[str, tuple]:
+        """
+        Trả về {post_id: (page_id, created_time, updated_at)} của các post đã lưu cho các page,
+        dùng để xác định tier làm mới metrics lifetime.
+        """
+        if not page_ids:
+            return {}
+        session = self.SessionLocal()
+        try:
+            rows = session.query(
+                FactPostPerformance.post_id,
+                FactPostPerformance.page_id,
+                FactPostPerformance.created_time,
+                FactPostPerformance.updated_at
+            ).filter(FactPostPerformance.page_id.in_(page_ids)).all()
+            return {row.post_id: (row.page_id, row.created_time, row.updated_at) for row in rows}
+        finally:
+            session.close()
+
+    def update_post_lifetime_metrics(self, metrics_data: List[Dict[str, Any]]):
+        """
+        Cập nhật các chỉ số LIFETIME (shares, comments, insights) cho các post đã có trong fact_post_performance.
+        Dữ liệu đầu vào là kết quả của get_post_lifetime_metrics.
+        """
+        if not metrics_data:
+            logger.info("Không có metrics lifetime nào cần cập nhật.")
+            return
+
+        now = datetime.now()
+        prepared_data = [
+            {
+                'post_id': record['post_id'],
+                'shares_count': record.get('shares_count', 0),
+                'comments_total_count': record.get('comments_total_count', 0),
+                'lt_post_reactions_like_total': record.get('post_reactions_like_total', 0),
+                'lt_post_impressions': record.get('post_impressions', 0),
+                'lt_post_clicks': record.get('post_clicks', 0),
+                'lt_post_impressions_organic_unique': record.get('post_impressions_organic_unique', 0),
+                'updated_at': now,
+            }
+            for record in dedupe_by_keys(metrics_data, ('post_id',))
+        ]
+
+        session = self.SessionLocal()
+        try:
+            session.execute(update(FactPostPerformance), prepared_data)
+            session.commit()
+            logger.info(f"Đã cập nhật metrics lifetime cho {len(prepared_data)} post.")
+        except Exception as e:
+            logger.error(f"Lỗi khi cập nhật metrics lifetime: {e}")
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def update_post_picture_urls(self, picture_urls: Dict[str, Dict[str, Any]]):
+        """
+        Cập nhật full_picture_url và picture_variants cho các post sau khi ảnh được mirror lên R2.
+        picture_urls: {post_id: {'full_picture_url': url, 'picture_variants': {width: url} | None}}
+        """
+        if not picture_urls:
+            logger.info("Không có ảnh post nào cần cập nhật.")
+            return
+
+        session = self.SessionLocal()
+        try:
+            session.execute(
+                update(FactPostPerformance),
+                [{'post_id': post_id, 'full_picture_url': mirrored['full_picture_url'],
+                  'picture_variants': mirrored.get('picture_variants')}
+                 for post_id, mirrored in picture_urls.items()]
+            )
+            session.commit()
+            logger.info(f"Đã cập nhật ảnh cho {len(picture_urls)} post.")
+        except Exception as e:
+            logger.error(f"Lỗi khi cập nhật ảnh post: {e}")
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
     def upsert_performance_region_data(self, insights_data: List[Dict[str, Any]]):
         """
         Thực hiện 'UPSERT' cho bảng fact_performance_region.
@@ -1020,93 +1570,29 @@ class DatabaseManager:
         session = self.SessionLocal()
         try:
             # --- BƯỚC 1: Tải trước các Dimension vào bộ nhớ ---
-            all_dates = {rec['date_start'] for rec in insights_data if 'date_start' in rec}
             # Lấy tất cả tên region duy nhất từ API
             all_regions = {rec['region'] for rec in insights_data if 'region' in rec}
 
-            date_map = {str(r.full_date): r.date_key for r in session.query(DimDate.full_date, DimDate.date_key).filter(DimDate.full_date.in_([datetime.fromisoformat(d).date() for d in all_dates]))}
             # Lấy map (hoặc tạo mới) cho DimRegion nếu chưa có xuất hiện.
             region_map = self._get_or_create_dim_records(session, DimRegion, 'region_name', all_regions, 'region_id')
 
             # --- BƯỚC 2: Chuẩn bị dữ liệu để load vào Fact Table ---
-            prepared_data = []
-            for record in insights_data:
-                if not all([record.get('date_start'), record.get('ad_id'), record.get('adset_id'), record.get('campaign_id')]):
-                    continue
-
-                # Bóc tách actions (y hệt các hàm upsert khác)
-                messages_started = 0
-                purchases = 0
-                purchase_value = 0.0
-                post_engagement = 0
-                link_click = 0
-                if 'actions' in record:
-                    for action in record.get('actions', []):
-                        action_type = action.get('action_type')
-                        value = int(action.get('value', 0))
-                        if action_type == 'onsite_conversion.messaging_conversation_started_7d':
-                            messages_started = value
-                        elif action_type == 'onsite_conversion.purchase':
-                            purchases = value
-                        elif action_type == 'post_engagement':
-                            post_engagement = value
-                        elif action_type == 'link_click':
-                            link_click = value
-                if 'action_values' in record:
-                    for action in record.get('action_values', []):
-                        if action.get('action_type') == 'onsite_conversion.purchase':
-                            purchase_value = float(action.get('value', 0.0))
-
-                # Map dữ liệu thô với các khóa ngoại đã tra cứu
-                fact_record = {
-                    'date_key': date_map.get(record['date_start']),
-                    'campaign_id': record['campaign_id'],
-                    'adset_id': record['adset_id'],
-                    'ad_id': record['ad_id'],
-                    'region_id': region_map.get(record.get('region')), # <-- Mapping Region ID
-                    'spend': float(record.get('spend', 0.0)),
-                    'impressions': int(record.get('impressions', 0)),
-                    'clicks': int(record.get('clicks', 0)),
-                    'ctr': float(record.get('ctr', 0.0)),
-                    'cpm': float(record.get('cpm', 0.0)),
-                    'reach': int(record.get('reach', 0)),
-                    'frequency': float(record.get('frequency', 0.0)),
-                    'messages_started': messages_started,
-                    'purchases': purchases,
-                    'purchase_value': purchase_value,
-                    'post_engagement': post_engagement,
-                    'link_click': link_click
-                }
-                
-                # Chỉ thêm vào nếu các khóa chính (FK) đều hợp lệ
-                if fact_record['date_key'] and fact_record['region_id']:
-                    prepared_data.append(fact_record)
+            frame = transform_insights_frame(insights_data, ['region'])
+            frame['date_key'] = date_keys_for(frame['date_start'])
+            frame['region_id'] = frame['region'].map(region_map)
+            # Chỉ giữ các dòng mà các khóa chính (FK) đều hợp lệ
+            frame = frame[frame['date_key'].notna() & frame['region_id'].notna()].astype({'date_key': 'int64', 'region_id': 'int64'})
+            self.dim_cache.ensure_dates(session, set(frame['date_key'].tolist()))
+            prepared_data = frame_to_records(frame, ['date_key', 'campaign_id', 'adset_id', 'ad_id',
+                                                     'region_id'] + FACT_METRIC_COLUMNS)
 
             if not prepared_data:
                 logger.warning("Không có dữ liệu hợp lệ để chèn vào fact_performance_region sau khi chuẩn bị.")
                 return
 
             # --- BƯỚC 3: Load hàng loạt vào Fact Table ---
-            stmt = pg_insert(FactPerformanceRegion).values(prepared_data)
-            on_conflict_stmt = stmt.on_conflict_do_update(
-                constraint='_ad_performance_region_uc', # <-- Dùng constraint của bảng region
-                set_={
-                    'spend': stmt.excluded.spend,
-                    'impressions': stmt.excluded.impressions,
-                    'clicks': stmt.excluded.clicks,
-                    'ctr': stmt.excluded.ctr,
-                    'cpm': stmt.excluded.cpm,
-                    'reach': stmt.excluded.reach,
-                    'frequency': stmt.excluded.frequency,
-                    'messages_started': stmt.excluded.messages_started,
-                    'purchases': stmt.excluded.purchases,
-                    'purchase_value': stmt.excluded.purchase_value,
-                    'post_engagement': stmt.excluded.post_engagement,
-                    'link_click': stmt.excluded.link_click
-                }
-            )
-            
-            session.execute(on_conflict_stmt)
+            prepared_data = dedupe_by_keys(prepared_data, ('date_key', 'ad_id', 'region_id'))
+            self._bulk_upsert_fact(session, FactPerformanceRegion, prepared_data, '_ad_performance_region_uc')
             session.commit()
             logger.info(f"Đã Upsert thành công {len(prepared_data)} bản ghi vào fact_performance_region.")
 
@@ -1187,17 +1673,198 @@ class DatabaseManager:
         finally:
             session.close()    
     
-    def refresh_data(self, start_date: str = None, end_date: str = None, date_preset: str = None):
+    def get_loaded_insight_dates(self, start_date: str, end_date: str) -> Set[date]:
+        """
+        Trả về các ngày trong [start_date, end_date] đã có dữ liệu ở CẢ 3 bảng Fact insights
+        (platform, demographic, region).
+        """
+        start_key = int(start_date.replace('-', ''))
+        end_key = int(end_date.replace('-', ''))
+        session = self.SessionLocal()
+        try:
+            loaded = None
+            for fact_model in (FactPerformancePlatform, FactPerformanceDemographic, FactPerformanceRegion):
+                keys = {row[0] for row in session.query(fact_model.date_key).distinct()
+                        .filter(fact_model.date_key.between(start_key, end_key))}
+                loaded = keys if loaded is None else loaded & keys
+            return {datetime.strptime(str(date_key), '%Y%m%d').date() for date_key in loaded or ()}
+        finally:
+            session.close()
+
+    def get_page_tokens(self) -> Dict[str, str]:
+        """
+        Trả về {page_id: page_access_token} đã lưu trong dim_fanpage.
+        """
+        session = self.SessionLocal()
+        try:
+            return {row.page_id: row.page_access_token
+                    for row in session.query(DimFanpage.page_id, DimFanpage.page_access_token).all()}
+        finally:
+            session.close()
+
+    def get_etl_states(self, keys: List[str]) -> Dict[str, str]:
+        """
+        Đọc nhiều trạng thái ETL theo key. Key chưa có sẽ không xuất hiện trong kết quả.
+        """
+        if not keys:
+            return {}
+        session = self.SessionLocal()
+        try:
+            rows = session.query(EtlState.state_key, EtlState.state_value).filter(EtlState.state_key.in_(keys)).all()
+            return {row.state_key: row.state_value for row in rows}
+        finally:
+            session.close()
+
+    def set_etl_states(self, states: Dict[str, str]):
+        """
+        Ghi (upsert) nhiều trạng thái ETL.
+        """
+        if not states:
+            return
+        stmt = pg_insert(EtlState).values([{'state_key': k, 'state_value': v} for k, v in states.items()])
+        on_conflict_stmt = stmt.on_conflict_do_update(
+            index_elements=['state_key'],
+            set_={
+                'state_value': stmt.excluded.state_value,
+                'updated_at': datetime.now()
+            }
+        )
+        session = self.SessionLocal()
+        try:
+            session.execute(on_conflict_stmt)
+            session.commit()
+        except Exception as e:
+            logger.error(f"Lỗi khi lưu etl_state: {e}")
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def sync_dimensions(self, extractor, accounts: List[Dict[str, Any]], start_date: str = None, end_date: str = None, date_preset: str = None):
+        """
+        Đồng bộ các bảng Dimension (Campaign, Adset, Ad).
+
+        - DIM_INCREMENTAL_SYNC bật: mỗi tài khoản chỉ lấy các object có updated_time sau mốc
+          (high-water mark lưu trong etl_state). Full sync (toàn bộ object, không lọc ngày) khi tài khoản
+          chưa có mốc hoặc lần full sync gần nhất cũ hơn DIM_FULL_SYNC_INTERVAL_HOURS.
+        - DIM_INCREMENTAL_SYNC tắt: lấy chuỗi Campaign -> Adset -> Ad theo khoảng ngày như trước.
+        """
+        if not DIM_INCREMENTAL_SYNC:
+            dims = extractor.get_dimensions_for_accounts(accounts, start_date=start_date, end_date=end_date, date_preset=date_preset)
+            self.upsert_campaigns(dims['campaigns'])
+            self.upsert_adsets(dims['adsets'])
+            self.upsert_ads(dims['ads'])
+            return
+
+        account_ids = [account['id'] for account in accounts]
+        hwm_keys = {account_id: f"dim_sync_hwm:{account_id}" for account_id in account_ids}
+        full_sync_keys = {account_id: f"dim_full_sync_at:{account_id}" for account_id in account_ids}
+        states = self.get_etl_states(list(hwm_keys.values()) + list(full_sync_keys.values()))
+
+        now_ts = int(time.time())
+        updated_since = {}
+        full_sync_accounts = set()
+        for account_id in account_ids:
+            hwm = states.get(hwm_keys[account_id])
+            full_sync_at = states.get(full_sync_keys[account_id])
+            if hwm is None or full_sync_at is None or now_ts - int(full_sync_at) >= DIM_FULL_SYNC_INTERVAL_HOURS * 3600:
+                updated_since[account_id] = None
+                full_sync_accounts.add(account_id)
+            else:
+                updated_since[account_id] = max(0, int(hwm) - DIM_SYNC_OVERLAP_SECONDS)
+
+        logger.info(f"Đồng bộ Dimension: {len(full_sync_accounts)} tài khoản full sync, "
+                    f"{len(account_ids) - len(full_sync_accounts)} tài khoản incremental (updated_time).")
+        dims = extractor.get_updated_dimensions(updated_since)
+        self.upsert_campaigns(dims['campaigns'])
+        self.upsert_adsets(dims['adsets'])
+        self.upsert_ads(dims['ads'])
+
+        # Chỉ tiến mốc sau khi upsert thành công và bỏ qua các tài khoản lấy dữ liệu bị lỗi
+        max_updated = {}
+        for level in ('campaigns', 'adsets', 'ads'):
+            for record in dims[level]:
+                updated_time = parse_datetime_flexible(record.get('updated_time'))
+                if updated_time:
+                    ts = int(updated_time.timestamp())
+                    max_updated[record['account_id']] = max(max_updated.get(record['account_id'], 0), ts)
+
+        failed_accounts = set(dims.get('failed_accounts', []))
+        new_states = {}
+        for account_id in account_ids:
+            if account_id in failed_accounts:
+                logger.warning(f"Không tiến mốc updated_time cho tài khoản {account_id} do lỗi khi đồng bộ Dimension.")
+                continue
+            if account_id in full_sync_accounts:
+                new_states[hwm_keys[account_id]] = str(max_updated.get(account_id, now_ts))
+                new_states[full_sync_keys[account_id]] = str(now_ts)
+            elif account_id in max_updated:
+                new_states[hwm_keys[account_id]] = str(max(int(states[hwm_keys[account_id]]), max_updated[account_id]))
+        self.set_etl_states(new_states)
+
+    def get_pagination_checkpoint(self, job_id: str, account_id: str, breakdown: str, date_window: str) -> PaginationCheckpoint:
+        """
+        Lấy (hoặc khởi tạo) checkpoint phân trang cho một luồng insights của job.
+        """
+        return PaginationCheckpoint(self, job_id, account_id, breakdown, date_window)
+
+    def clear_checkpoints(self, job_id: str):
+        """
+        Xóa toàn bộ checkpoint của một job (gọi khi job đã chạy xong toàn bộ),
+        để lần chạy sau với cùng job_id nạp lại dữ liệu từ đầu.
+        """
+        session = self.SessionLocal()
+        try:
+            deleted = session.query(EtlCheckpoint).filter(EtlCheckpoint.job_id == job_id).delete(synchronize_session=False)
+            session.commit()
+            logger.info(f"Đã xóa {deleted} checkpoint của job '{job_id}'.")
+        except Exception as e:
+            logger.error(f"Lỗi khi xóa checkpoint của job '{job_id}': {e}")
+            session.rollback()
+        finally:
+            session.close()
+
+    def refresh_data(self, start_date: str = None, end_date: str = None, date_preset: str = None, job_id: str = None,
+                     incremental: bool = False):
         """
         Hàm chính để điều phối toàn bộ quy trình ETL:
         1. Lấy dữ liệu mới từ Meta Ads API.
         2. Cập nhật các bảng Dimension.
-        3. Cập nhật bảng Fact.
+        3. Cập nhật bảng DimDate và Fact theo từng trang insights (streaming).
+
+        job_id (tùy chọn): ghi checkpoint cursor sau mỗi trang insights đã nạp vào bảng etl_checkpoint.
+        Chạy lại với cùng job_id (sau khi crash/restart) sẽ tiếp tục từ trang cuối cùng đã nạp.
+
+        incremental (tùy chọn, cần start_date/end_date): chỉ lấy lại INCREMENTAL_ATTRIBUTION_DAYS ngày cuối,
+        các ngày chưa có trong bảng Fact và các ngày có tài khoản bị lỗi ở lần chạy trước
+        (FAILED_INSIGHT_DATES_KEY), bỏ qua các ngày cũ hơn đã nạp.
         """
         from fbads_extract import FacebookAdsExtractor
+        from raw_archive import get_raw_archive
         extractor = FacebookAdsExtractor()
+        # Lưu các trang insights thô (NDJSON nén zstd) để có thể transform lại mà không gọi API
+        raw_archive = get_raw_archive()
 
         try:
+            # --- BƯỚC 0: XÁC ĐỊNH CÁC KHOẢNG NGÀY CẦN LẤY ---
+            insight_ranges = [(start_date, end_date)]
+            # Các ngày còn lỗi theo tài khoản từ những lần chạy trước (chỉ theo dõi khi có start_date/end_date)
+            track_failed_dates = not date_preset and bool(start_date and end_date)
+            failed_dates = json.loads(self.get_etl_states([FAILED_INSIGHT_DATES_KEY]).get(FAILED_INSIGHT_DATES_KEY) or '{}')
+            if incremental:
+                if date_preset or not (start_date and end_date):
+                    logger.warning("Chế độ incremental cần start_date/end_date (không dùng date_preset). Lấy toàn bộ khoảng.")
+                else:
+                    loaded = self.get_loaded_insight_dates(start_date, end_date)
+                    # Ngày mà một tài khoản nào đó còn lỗi chưa được coi là đã nạp (dù các tài khoản khác đã có dữ liệu)
+                    loaded -= {date.fromisoformat(day) for days in failed_dates.values() for day in days}
+                    insight_ranges = incremental_date_ranges(start_date, end_date, loaded)
+                    if not insight_ranges:
+                        logger.info(f"Incremental: mọi ngày từ {start_date} đến {end_date} đã được nạp. Bỏ qua.")
+                        return
+                    logger.info(f"Incremental: lấy lại {len(insight_ranges)} khoảng ngày "
+                                f"({', '.join(f'{s}:{e}' for s, e in insight_ranges)}).")
+
             # --- BƯỚC 1: LẤY VÀ CẬP NHẬT CÁC BẢNG DIMENSION CƠ BẢN ---
             logger.info("Bước 1: Lấy và cập nhật danh sách tài khoản quảng cáo...")
             accounts = extractor.get_all_ad_accounts()
@@ -1206,113 +1873,126 @@ class DatabaseManager:
             logger.info("=> Hoàn thành cập nhật tài khoản loại bỏ 'Nguyen Xuan Trang' và 'Lâm Khải'.")
             self.upsert_ad_accounts(accounts)
 
-            all_campaigns = []
-            all_adsets = []
-            all_ads = []
-            all_insights_platform = []
-            all_insights_demographic = []
-            all_insights_region = []
-
-            for account in accounts:
-                account_id = account['id']
-                logger.info(f"--- Đang xử lý cho tài khoản: {account['name']} ({account_id}) ---")
-
-                # (Logic lấy campaign, adset, ad giữ nguyên...)
-                campaigns = extractor.get_campaigns_for_account(account_id=account_id, start_date=start_date, end_date=end_date, date_preset=date_preset)
-                if campaigns:
-                    for c in campaigns:
-                        c['account_id'] = account_id
-                    all_campaigns.extend(campaigns)
-                    campaign_ids = [c['id'] for c in campaigns]
-
-                    adsets = extractor.get_adsets_for_campaigns(account_id=account_id, campaign_id=campaign_ids, start_date=start_date, end_date=end_date, date_preset=date_preset)
-                    if adsets:
-                        for a in adsets:
-                            a['account_id'] = account_id
-                        all_adsets.extend(adsets)
-                        adset_ids = [a['id'] for a in adsets]
-
-                        ads = extractor.get_ads_for_adsets(account_id=account_id, adset_id=adset_ids, start_date=start_date, end_date=end_date, date_preset=date_preset)
-                        if ads:
-                            for ad in ads:
-                                ad['account_id'] = account_id
-                            all_ads.extend(ads)
-
-            # Upsert hàng loạt vào các bảng Dimension
-            logger.info("Bước 2: Cập nhật các bảng Dimension (Campaign, Adset, Ad)...")
-            self.upsert_campaigns(all_campaigns)
-            self.upsert_adsets(all_adsets)
-            self.upsert_ads(all_ads)
-            logger.info("=> Hoàn thành cập nhật Dimension.")
-
-            # --- BƯỚC 2: LẤY VÀ CẬP NHẬT BẢNG FACT ---
             if date_preset:
-                logger.info(f"Lấy dữ liệu Insights cho khoảng thời gian preset: {date_preset}...")
+                logger.info(f"Lấy dữ liệu Dimension và Insights cho khoảng thời gian preset: {date_preset}...")
             elif start_date and end_date:
-                logger.info(f"Lấy dữ liệu Insights cho khoảng thời gian từ {start_date} đến {end_date}...")
+                logger.info(f"Lấy dữ liệu Dimension và Insights cho khoảng thời gian từ {start_date} đến {end_date}...")
             else:
-                logger.info("Lấy dữ liệu Insights cho khoảng thời gian mặc định...")
-            
-            for account in accounts:
-                account_id = account['id']
-                logger.info(f"Lấy Insights platform cho tài khoản: {account_id}")
-                insights_platform = extractor.get_all_insights_platform(
-                    account_id=account_id,
-                    date_preset=date_preset,
-                    start_date=start_date,
-                    end_date=end_date
-                )
-                if insights_platform:
-                    all_insights_platform.extend(insights_platform)
-                
-                logger.info(f"Lấy Insights demographic cho tài khoản: {account_id}")
-                insights_demographic = extractor.get_all_insights_demo(
-                    account_id=account_id,
-                    date_preset=date_preset,
-                    start_date=start_date,
-                    end_date=end_date
-                )
-                if insights_demographic:
-                    all_insights_demographic.extend(insights_demographic)
-
-                logger.info(f"Lấy Insights region cho tài khoản: {account_id}")
-                insights_region = extractor.get_all_insights_region(
-                    account_id=account_id,
-                    date_preset=date_preset,
-                    start_date=start_date,
-                    end_date=end_date
-                )
-                if insights_region:
-                    all_insights_region.extend(insights_region)
-            
-            if not all_insights_platform and not all_insights_demographic and not all_insights_region:
-                logger.warning("Không có dữ liệu insights nào được trả về từ API. Kết thúc quy trình.")
-                return
+                logger.info("Lấy dữ liệu Dimension và Insights cho khoảng thời gian mặc định...")
 
-            logger.info(f"Tổng cộng có {len(all_insights_platform) + len(all_insights_demographic) + len(all_insights_region)} bản ghi insights được lấy về.") # <-- SỬA
+            # --- BƯỚC 2: Dimension (phải có trước khi nạp Fact vì khóa ngoại) ---
+            logger.info("Bước 2: Cập nhật các bảng Dimension (Campaign, Adset, Ad)...")
+            self.sync_dimensions(extractor, accounts, start_date=start_date, end_date=end_date, date_preset=date_preset)
+            logger.info("=> Hoàn thành cập nhật Dimension.")
 
-            # BƯỚC 3: Cập nhật DimDate
-            logger.info("Bước 3: Cập nhật bảng DimDate...")
-            all_insights_combined = all_insights_platform + all_insights_demographic + all_insights_region
-            min_date_str = min(rec['date_start'] for rec in all_insights_combined)
-            max_date_str = max(rec['date_start'] for rec in all_insights_combined)
-            min_date = datetime.fromisoformat(min_date_str)
-            max_date = datetime.fromisoformat(max_date_str)
-            self.upsert_dates(min_date, max_date)
-            logger.info("=> Hoàn thành cập nhật DimDate.")
-
-            # BƯỚC 4: Cập nhật FactPerformance
-            logger.info("Bước 4: Cập nhật bảng FactPerformance...")
-            self.upsert_performance_platform_data(all_insights_platform)
-            self.upsert_performance_demographic_data(all_insights_demographic)
-            self.upsert_performance_region_data(all_insights_region)
-            logger.info("=> Hoàn thành cập nhật FactPerformance.")
+            # --- BƯỚC 3 & 4: DimDate + FactPerformance, nạp theo lô khi các trang insights về tới ---
+            logger.info("Bước 3 & 4: Cập nhật DimDate và FactPerformance theo lô...")
+            loaded_dates = set()
+
+            def _ensure_dates(records: List[Dict[str, Any]]):
+                # Được gọi dưới self._load_lock trước mỗi lần upsert lô Fact (khóa ngoại tới dim_date)
+                new_dates = {rec['date_start'] for rec in records if rec.get('date_start')} - loaded_dates
+                if new_dates:
+                    self.upsert_dates(datetime.fromisoformat(min(new_dates)), datetime.fromisoformat(max(new_dates)))
+                    loaded_dates.update(new_dates)
+
+            # Các lần nạp được tuần tự hóa để tránh tranh chấp khi tạo mới Dim (platform, placement, region)
+            fact_buffers = {
+                'insights_platform': FactUpsertBuffer(self.upsert_performance_platform_data, self._load_lock, _ensure_dates),
+                'insights_demographic': FactUpsertBuffer(self.upsert_performance_demographic_data, self._load_lock, _ensure_dates),
+                'insights_region': FactUpsertBuffer(self.upsert_performance_region_data, self._load_lock, _ensure_dates),
+            }
+
+            def _load_page(key: str, account_id: str, records: List[Dict[str, Any]]):
+                if raw_archive is not None:
+                    try:
+                        raw_archive.write_insights(key, account_id, records)
+                    except Exception as e:
+                        logger.warning(f"Lỗi khi lưu archive {key} của tài khoản {account_id}: {e}")
+                load_pipeline.submit(lambda: fact_buffers[key].add(records))
+
+            def _checkpoint_factory_for(date_window: str):
+                if job_id:
+                    logger.info(f"Bật checkpoint phân trang cho job '{job_id}' ({date_window}).")
+
+                def _checkpoint_factory(account_id: str, key: str) -> BufferedCheckpoint:
+                    checkpoint = self.get_pagination_checkpoint(job_id, account_id, key, date_window) if job_id else None
+                    return BufferedCheckpoint(fact_buffers[key], checkpoint, load_pipeline)
+                return _checkpoint_factory
+
+            # Cửa sổ ngày an toàn đã học ở các lần chạy trước (khi Insights báo "reduce the amount of data")
+            window_keys = {account['id']: f"insights_safe_window:{account['id']}" for account in accounts}
+            learned_windows = self.get_etl_states(list(window_keys.values()))
+            extractor.safe_window_days.update({
+                account_id: int(learned_windows[key]) for account_id, key in window_keys.items() if key in learned_windows
+            })
+            known_windows = dict(extractor.safe_window_days)
+
+            failed_accounts = []
+            counts = {'insights_platform': 0, 'insights_demographic': 0, 'insights_region': 0}
+            # Thread extract chỉ xếp trang vào hàng đợi; một thread nạp riêng upsert các lô song song với việc gọi API
+            load_pipeline = FactLoadPipeline()
+            fetched_ranges = []
+            try:
+                for range_start, range_end in insight_ranges:
+                    date_window = date_preset if date_preset else f"{range_start}:{range_end}"
+                    range_failed = []
+                    range_counts = extractor.stream_insights_concurrently(
+                        accounts,
+                        _load_page,
+                        start_date=range_start,
+                        end_date=range_end,
+                        date_preset=date_preset,
+                        checkpoint_factory=_checkpoint_factory_for(date_window),
+                        failed_accounts=range_failed
+                    )
+                    for key, count in range_counts.items():
+                        counts[key] += count
+                    failed_accounts.extend(account_id for account_id in range_failed if account_id not in failed_accounts)
+                    fetched_ranges.append((range_start, range_end, range_failed))
+            finally:
+                # Chờ thread nạp xử lý hết các trang còn trong hàng đợi
+                load_errors = load_pipeline.close()
+            # Đẩy nốt các lô còn lại (kể cả của những luồng dừng giữa chừng do lỗi)
+            for buffer in fact_buffers.values():
+                buffer.flush()
+
+            if track_failed_dates:
+                account_ids = [account['id'] for account in accounts]
+                if load_errors:
+                    # Không biết lô lỗi thuộc tài khoản nào -> coi mọi khoảng vừa lấy là lỗi cho mọi tài khoản
+                    fetched_ranges = [(range_start, range_end, account_ids) for range_start, range_end, _ in fetched_ranges]
+                self.set_etl_states({
+                    FAILED_INSIGHT_DATES_KEY: json.dumps(update_failed_insight_dates(failed_dates, fetched_ranges, account_ids))
+                })
+
+            # Lưu lại cửa sổ an toàn mới học được để lần chạy sau bắt đầu luôn với kích thước đó
+            self.set_etl_states({
+                window_keys[account_id]: str(days)
+                for account_id, days in extractor.safe_window_days.items()
+                if account_id in window_keys and known_windows.get(account_id) != days
+            })
+
+            if not any(counts.values()) and not failed_accounts:
+                logger.warning("Không có dữ liệu insights nào được nạp trong lần chạy này. Kết thúc quy trình.")
+                return
+
+            logger.info(f"Tổng cộng có {sum(counts.values())} bản ghi insights được nạp "
+                        f"(platform: {counts['insights_platform']}, demographic: {counts['insights_demographic']}, region: {counts['insights_region']}).")
+            logger.info("=> Hoàn thành cập nhật DimDate và FactPerformance.")
 
             # BƯỚC 5: Làm giàu (Enrich) dữ liệu cho DimRegion
             logger.info("Bước 5: Bắt đầu làm giàu dữ liệu Geo cho DimRegion (chỉ cho các region mới)...")
             self._enrich_region_geo_data()
             logger.info("=> Hoàn thành làm giàu DimRegion.")
 
+            if failed_accounts:
+                # Báo lỗi cho bên gọi để giữ lại checkpoint và chạy lại các tài khoản lỗi
+                raise RuntimeError(f"Nạp Insights thất bại cho {len(failed_accounts)} tài khoản: {', '.join(failed_accounts)}")
+            if load_errors:
+                # Bảng Fact có lô lỗi không ghi thêm checkpoint nào -> chạy lại cùng job_id sẽ lấy lại các trang đó
+                raise RuntimeError(f"Nạp {len(load_errors)} lô Fact thất bại: {load_errors[0]}")
+
         except Exception as e:
             logger.error(f"LỖI NGHIÊM TRỌNG trong quá trình làm mới dữ liệu: {e}", exc_info=True)
             # Ném lại lỗi để endpoint có thể bắt và trả về thông báo lỗi
@@ -1331,7 +2011,15 @@ class DatabaseManager:
             end_date (str): Ngày kết thúc (YYYY-MM-DD).
         """
         from fbads_extract import FacebookAdsExtractor
+        from storage_manager import MediaMirrorPipeline
+        from raw_archive import get_raw_archive
+        from page_token_manager import get_page_token_manager
         extractor = FacebookAdsExtractor()
+        extractor.raw_archive = get_raw_archive()
+        # Page Token được nạp từ / lưu lại vào dim_fanpage (kể cả khi chạy ngoài app, VD: loaddaily.py)
+        get_page_token_manager(loader=self.get_page_tokens, saver=self.upsert_fanpages)
+        # Ảnh post được mirror lên R2 ở một bước chạy nền riêng, không chặn việc nạp post
+        media_pipeline = None if skip_media else MediaMirrorPipeline(extractor.storage_manager)
         
         logger.info("--- BẮT ĐẦU QUY TRÌNH REFRESH DỮ LIỆU FANPAGE ---")
         
@@ -1342,48 +2030,51 @@ class DatabaseManager:
             self.upsert_fanpages(fanpages)
             logger.info("=> Hoàn thành cập nhật dim_fanpage.")
             
-            # --- BƯỚC 2: LẤY DỮ LIỆU TỪ API (CHO TẤT CẢ PAGES) ---
-            all_page_metrics = []
-            all_post_metrics = []
-
-            for page in fanpages:
-                page_id = page.get('id')
-                page_token = page.get('access_token')
-                page_name = page.get('name')
-                
-                if not page_token:
-                    logger.warning(f"Bỏ qua Page {page_name} ({page_id}) vì không có Page Access Token.")
-                    continue
-                
-                logger.info(f"--- Đang xử lý cho Fanpage: {page_name} ({page_id}) ---")
-                
-                # 2.1 Lấy Page Metrics (theo ngày)
-                logger.info(f"Lấy Page Metrics (daily) từ {start_date} đến {end_date}...")
-                page_metrics = extractor.get_page_metrics_by_day(
-                    page_id=page_id,
-                    page_access_token=page_token,
-                    start_date=start_date,
-                    end_date=end_date
-                )
-                all_page_metrics.extend(page_metrics)
-                
-                # 2.2 Lấy Post Metrics (lifetime, theo ngày post)
-                logger.info(f"Lấy Post Metrics (lifetime) cho các post tạo từ {start_date} đến {end_date}...")
-                post_metrics = extractor.get_posts_with_lifetime_insights(
-                    page_id=page_id,
-                    page_access_token=page_token,
-                    start_date=start_date,
-                    end_date=end_date,
-                    metrics_list=None, # Dùng default metrics
-                    skip_media=skip_media
-                )
-                
-                # Thêm page_id vào mỗi record post để load vào DB
-                for post in post_metrics:
-                    post['page_id'] = page_id
-                all_post_metrics.extend(post_metrics)
+            # --- BƯỚC 2: LẤY DỮ LIỆU TỪ API (CHO TẤT CẢ PAGES, SONG SONG) ---
+            logger.info(f"Bước 2: Trích xuất Page Metrics và Post Metrics từ {start_date} đến {end_date}...")
+
+            # Metrics lifetime của post chỉ được làm mới khi đến hạn theo tier (POST_REFRESH_TIERS)
+            post_states = self.get_post_refresh_states([page.get('id') for page in fanpages])
+            now = datetime.now()
+            range_start = datetime.strptime(start_date, '%Y-%m-%d').date()
+            range_end = datetime.strptime(end_date, '%Y-%m-%d').date()
+
+            def _post_refresh_tier(post_id: str, created_time: Optional[str]) -> Optional[int]:
+                state = post_states.get(post_id)
+                if state is None:
+                    return 0 # Post mới: luôn lấy
+                return post_refresh_tier(state[1], state[2], now)
+
+            # Các post ngoài khoảng ngày nhưng đã đến hạn: {page_id: {tier: [post_id]}}
+            due_post_ids = {}
+            for post_id, (page_id, created_time, updated_at) in post_states.items():
+                if created_time is not None and range_start <= created_time.date() <= range_end:
+                    continue # Đã được xử lý khi lấy danh sách post trong khoảng ngày
+                tier = post_refresh_tier(created_time, updated_at, now)
+                if tier is not None:
+                    due_post_ids.setdefault(page_id, {}).setdefault(tier, []).append(post_id)
+
+            failed_pages = []
+            extracted = extractor.extract_fanpages_concurrently(
+                fanpages,
+                start_date=start_date,
+                end_date=end_date,
+                skip_media=skip_media,
+                failed_pages=failed_pages,
+                media_pipeline=media_pipeline,
+                post_refresh_tier=_post_refresh_tier,
+                due_post_ids=due_post_ids
+            )
+            all_page_metrics = extracted['page_metrics']
+            all_post_metrics = extracted['post_metrics']
+            post_lifetime_metrics = extracted['post_lifetime_metrics']
+
+            if post_lifetime_metrics:
+                self.update_post_lifetime_metrics(post_lifetime_metrics)
 
             if not all_page_metrics and not all_post_metrics:
+                if failed_pages:
+                    raise RuntimeError(f"Trích xuất thất bại cho {len(failed_pages)} Fanpage: {', '.join(failed_pages)}")
                 logger.warning("Không có dữ liệu Fanpage nào được trả về từ API. Kết thúc.")
                 return
 
@@ -1423,9 +2114,92 @@ class DatabaseManager:
             self.upsert_page_metrics_daily(all_page_metrics)
             self.upsert_post_performance(all_post_metrics)
             logger.info("=> Hoàn thành cập nhật các bảng Fact.")
+
+            # --- BƯỚC 5: CẬP NHẬT ẢNH ĐÃ MIRROR ---
+            if media_pipeline is not None:
+                logger.info("Bước 5: Chờ pipeline mirror ảnh và cập nhật full_picture_url...")
+                self.update_post_picture_urls(media_pipeline.drain())
+                media_pipeline = None
+                logger.info("=> Hoàn thành cập nhật ảnh post.")
             
+            if failed_pages:
+                # Báo lỗi cho bên gọi (VD: lỗi Token 190) sau khi đã nạp dữ liệu của các Fanpage còn lại
+                raise RuntimeError(f"Trích xuất thất bại cho {len(failed_pages)} Fanpage: {', '.join(failed_pages)}")
+
             logger.info("--- QUY TRÌNH REFRESH DỮ LIỆU FANPAGE HOÀN TẤT ---")
 
         except Exception as e:
             logger.error(f"LỖI NGHIÊM TRỌNG trong quá trình làm mới dữ liệu Fanpage: {e}", exc_info=True)
-            raise
\ No newline at end of file
+            raise
+        finally:
+            if media_pipeline is not None:
+                # Có lỗi trước khi cập nhật ảnh: vẫn chờ worker dừng để không rò thread
+                media_pipeline.drain()
+
+    def reload_from_archive(self, start_date: str, end_date: str, kinds: Optional[List[str]] = None,
+                            account_ids: Optional[List[str]] = None, archive_root: Optional[str] = None,
+                            max_workers: Optional[int] = None) -> Dict[str, int]:
+        """
+        Transform và nạp lại bảng Fact insights từ archive thô (raw_archive), KHÔNG gọi Graph API.
+        Dùng khi đổi logic bóc tách (VD: thêm action_type mới) mà không muốn tốn quota lấy lại lịch sử.
+
+        - Các phân vùng archive được đọc/giải nén song song (max_workers thread), các lô upsert vẫn được
+          tuần tự hóa qua self._load_lock như refresh_data.
+        - Mỗi phân vùng gộp mọi lần chạy, bản ghi của lần chạy mới nhất thắng theo khóa tự nhiên.
+        - Các bảng Dimension (Campaign/Adset/Ad) phải đã có sẵn (từ các lần refresh trước).
+
+        Returns:
+            Dict[str, int]: số bản ghi đã nạp theo từng loại insights.
+        """
+        from raw_archive import RawArchive, INSIGHT_KINDS, INSIGHT_KEY_FIELDS, RAW_ARCHIVE_RELOAD_WORKERS
+
+        kinds = list(kinds or INSIGHT_KINDS)
+        unknown = [kind for kind in kinds if kind not in INSIGHT_KINDS]
+        if unknown:
+            raise ValueError(f"Loại insights không hợp lệ: {', '.join(unknown)}")
+
+        archive = RawArchive(root=archive_root)
+        partitions = [
+            (kind, paths)
+            for kind in kinds
+            for _, _, paths in archive.iter_partitions(kind, start_date, end_date, account_ids)
+        ]
+        counts = {kind: 0 for kind in kinds}
+        if not partitions:
+            logger.warning(f"Không tìm thấy dữ liệu archive nào từ {start_date} đến {end_date} trong '{archive.root}'.")
+            return counts
+
+        logger.info(f"Transform lại {len(partitions)} phân vùng archive từ {start_date} đến {end_date}...")
+        self.upsert_dates(datetime.fromisoformat(start_date), datetime.fromisoformat(end_date))
+
+        upsert_fns = {
+            'insights_platform': self.upsert_performance_platform_data,
+            'insights_demographic': self.upsert_performance_demographic_data,
+            'insights_region': self.upsert_performance_region_data,
+        }
+        fact_buffers = {kind: FactUpsertBuffer(upsert_fns[kind], self._load_lock) for kind in kinds}
+
+        def _load_partition(kind: str, paths: List[str]) -> int:
+            records = archive.read_partition(paths, INSIGHT_KEY_FIELDS[kind])
+            fact_buffers[kind].add(records)
+            return len(records)
+
+        failed = []
+        with ThreadPoolExecutor(max_workers=max_workers or RAW_ARCHIVE_RELOAD_WORKERS) as executor:
+            futures = {executor.submit(_load_partition, kind, paths): (kind, paths) for kind, paths in partitions}
+            for future in as_completed(futures):
+                kind, paths = futures[future]
+                partition_dir = os.path.dirname(paths[-1])
+                try:
+                    counts[kind] += future.result()
+                except Exception as e:
+                    logger.error(f"Lỗi khi nạp lại archive {partition_dir}: {e}", exc_info=True)
+                    failed.append(partition_dir)
+        for buffer in fact_buffers.values():
+            buffer.flush()
+
+        logger.info(f"Đã nạp lại {sum(counts.values())} bản ghi insights từ archive "
+                    f"({', '.join(f'{kind}: {count}' for kind, count in counts.items())}).")
+        if failed:
+            raise RuntimeError(f"Nạp lại thất bại cho {len(failed)} phân vùng archive: {', '.join(failed)}")
+        return counts
\ No newline at end of file
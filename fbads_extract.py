@@ -4,20 +4,138 @@ import os
 import json
 import logging
 import shutil
-from datetime import datetime, date
-from typing import Dict, List, Any, Optional
+import time
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, date, timedelta
+from typing import Dict, List, Any, Optional, Iterator, Callable, Tuple
 import pytz
 import requests
 from dotenv import load_dotenv
 from dateutil.relativedelta import relativedelta
-from storage_manager import StorageManager
+from storage_manager import StorageManager, MediaMirrorPipeline
+from graph_client import get_graph_client, relative_url, is_reduce_data_error
+from page_token_manager import get_page_token_manager, is_token_error
 
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Giới hạn đồng thời cho chế độ trích xuất nhiều tài khoản
+# (tổng số request HTTP đồng thời do GraphClient giới hạn qua EXTRACT_MAX_CONCURRENCY)
+# - MAX_CONCURRENT_ACCOUNTS: số tài khoản được xử lý song song
+# - MAX_CONCURRENT_PER_ACCOUNT: số tác vụ song song trong một tài khoản (3 breakdown insights)
+MAX_CONCURRENT_ACCOUNTS = int(os.getenv("EXTRACT_MAX_ACCOUNTS", 4))
+MAX_CONCURRENT_PER_ACCOUNT = int(os.getenv("EXTRACT_MAX_PER_ACCOUNT", 3))
+# Gộp các lệnh lấy Campaign/Adset/Ad của mọi tài khoản vào Graph API batch request
+GRAPH_BATCH_DIMENSIONS = os.getenv("GRAPH_BATCH_DIMENSIONS", "true").lower() in ("1", "true", "yes")
+# Số lần gửi lại một sub-request batch không có kết quả (Graph API trả về null)
+GRAPH_BATCH_MAX_RETRIES = int(os.getenv("GRAPH_BATCH_MAX_RETRIES", 2))
+
+# Fields dùng khi đồng bộ Dimension theo updated_time (không đi theo chuỗi Campaign -> Adset -> Ad)
+DIMENSION_SYNC_FIELDS = {
+    'campaigns': 'account_id,id,name,created_time,objective,status,start_time,stop_time,updated_time',
+    'adsets': 'account_id,campaign_id,id,name,created_time,status,start_time,end_time,updated_time',
+    'ads': 'account_id,campaign_id,adset_id,id,name,created_time,status,ad_schedule_start_time,ad_schedule_end_time,updated_time',
+}
+
+# Chế độ Async Report cho insights khối lượng lớn
+# Số dòng ước lượng (ngày x quảng cáo x cardinality breakdown) vượt ngưỡng này sẽ chạy Async Report
+ASYNC_REPORT_ROW_THRESHOLD = int(os.getenv("ASYNC_REPORT_ROW_THRESHOLD", 50000))
+ASYNC_REPORT_POLL_SECONDS = float(os.getenv("ASYNC_REPORT_POLL_SECONDS", 2))
+ASYNC_REPORT_MAX_POLL_SECONDS = float(os.getenv("ASYNC_REPORT_MAX_POLL_SECONDS", 30))
+ASYNC_REPORT_TIMEOUT_SECONDS = float(os.getenv("ASYNC_REPORT_TIMEOUT_SECONDS", 3600))
+ASYNC_REPORT_PAGE_LIMIT = int(os.getenv("ASYNC_REPORT_PAGE_LIMIT", 500))
+
+# Số request con chạy song song khi một request Insights bị chia nhỏ (theo ngày hoặc theo ad.id)
+INSIGHTS_SPLIT_CONCURRENCY = int(os.getenv("INSIGHTS_SPLIT_CONCURRENCY", 4))
+
+# Bộ lọc IN theo danh sách ID (campaign.id, adset.id) được chia thành các nhóm tối đa IN_FILTER_CHUNK_SIZE ID
+# để URL không quá dài; tối đa IN_FILTER_CONCURRENCY nhóm chạy song song
+IN_FILTER_CHUNK_SIZE = int(os.getenv("IN_FILTER_CHUNK_SIZE", 100))
+IN_FILTER_CONCURRENCY = int(os.getenv("IN_FILTER_CONCURRENCY", 4))
+
+# Trích xuất Fanpage song song
+# - MAX_CONCURRENT_PAGES: số Fanpage được xử lý cùng lúc
+# - PAGE_METRICS_WINDOW_CONCURRENCY: số cửa sổ ngày Page Insights chạy song song trong một Fanpage
+# - PAGE_INSIGHTS_MAX_WINDOW_DAYS: Page Insights API giới hạn khoảng since/until, nên khoảng dài được chia nhỏ
+MAX_CONCURRENT_PAGES = int(os.getenv("EXTRACT_MAX_PAGES", 4))
+PAGE_METRICS_WINDOW_CONCURRENCY = int(os.getenv("PAGE_METRICS_WINDOW_CONCURRENCY", 3))
+PAGE_INSIGHTS_MAX_WINDOW_DAYS = int(os.getenv("PAGE_INSIGHTS_MAX_WINDOW_DAYS", 90))
+
+# Metrics LIFETIME mặc định của post và số post tối đa mỗi request `?ids=` khi lấy theo lô
+DEFAULT_POST_METRICS = [
+    'post_reactions_like_total',
+    'post_impressions_unique',
+    'post_clicks',
+    'post_impressions_organic_unique'
+]
+POST_METRICS_BATCH_SIZE = int(os.getenv("POST_METRICS_BATCH_SIZE", 50))
+
+# Số giá trị breakdown trung bình mỗi quảng cáo/ngày (ước lượng)
+BREAKDOWN_CARDINALITY = {
+    'publisher_platform,platform_position': 12,
+    'age,gender': 18,
+    'region': 40,
+}
+
+# Số ngày ước lượng cho các date_preset
+PRESET_ESTIMATED_DAYS = {
+    'today': 1, 'yesterday': 1, 'last_3d': 3, 'last_7d': 7, 'last_14d': 14, 'last_28d': 28,
+    'last_30d': 30, 'last_90d': 90, 'this_month': 31, 'last_month': 31, 'this_quarter': 92,
+    'last_quarter': 92, 'this_year': 365, 'last_year': 365, 'maximum': 1095, 'data_maximum': 1095,
+    'last_week_mon_sun': 7, 'last_week_sun_sat': 7, 'this_week_mon_today': 7, 'this_week_sun_today': 7,
+}
+
 DATE_PRESET = ['today', 'yesterday', 'this_month', 'last_month', 'this_quarter', 'maximum', 'data_maximum', 'last_3d', 'last_7d', 'last_14d', 'last_28d', 'last_30d', 'last_90d', 'last_week_mon_sun', 'last_week_sun_sat', 'last_quarter', 'last_year', 'this_week_mon_today', 'this_week_sun_today', 'this_year']
 
+def chunked(items: List[Any], size: int) -> List[List[Any]]:
+    """
+    Chia list thành các nhóm liên tiếp tối đa `size` phần tử.
+    """
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def _group_chunk_results(records_by_key: Dict[Tuple[str, int], List[Dict[str, Any]]]) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    Gộp kết quả batch theo (account_id, số thứ tự nhóm ID) về theo account_id, loại bản ghi trùng 'id'.
+    """
+    grouped = {}
+    for (account_id, _), records in records_by_key.items():
+        grouped.setdefault(account_id, {}).update((record['id'], record) for record in records)
+    return {account_id: list(records.values()) for account_id, records in grouped.items()}
+
+
+def split_date_range(start_date: str, end_date: str, window_days: Optional[int] = None) -> List[Tuple[str, str]]:
+    """
+    Chia khoảng ngày (YYYY-MM-DD, bao gồm 2 đầu) thành các cửa sổ liên tiếp tối đa window_days ngày.
+    window_days=None: giữ nguyên một cửa sổ.
+    """
+    start_obj = datetime.strptime(start_date, '%Y-%m-%d').date()
+    end_obj = datetime.strptime(end_date, '%Y-%m-%d').date()
+    if not window_days:
+        return [(start_date, end_date)]
+    windows = []
+    current = start_obj
+    while current <= end_obj:
+        window_end = min(current + timedelta(days=window_days - 1), end_obj)
+        windows.append((current.isoformat(), window_end.isoformat()))
+        current = window_end + timedelta(days=1)
+    return windows
+
+
+def bisect_date_range(start_date: str, end_date: str) -> Tuple[Tuple[str, str], Tuple[str, str]]:
+    """
+    Chia đôi khoảng ngày (ít nhất 2 ngày). Nửa đầu nhận ngày dư khi số ngày lẻ.
+    """
+    start_obj = datetime.strptime(start_date, '%Y-%m-%d').date()
+    end_obj = datetime.strptime(end_date, '%Y-%m-%d').date()
+    days = (end_obj - start_obj).days + 1
+    first_end = start_obj + timedelta(days=(days + 1) // 2 - 1)
+    return (start_date, first_end.isoformat()), ((first_end + timedelta(days=1)).isoformat(), end_date)
+
+
 class FacebookAdsExtractor:
     def __init__(self):
         load_dotenv()
@@ -26,6 +144,17 @@ class FacebookAdsExtractor:
         self.account_ids = []
         self.account_names = []
         self.storage_manager = StorageManager()
+        # Client HTTP dùng chung (pool keep-alive, gzip, timeout, giới hạn đồng thời)
+        self.client = get_graph_client()
+        # Cache số quảng cáo theo tài khoản (dùng để ước lượng khối lượng insights)
+        self._ad_counts: Dict[str, int] = {}
+        # Cửa sổ an toàn (số ngày tối đa mỗi request Insights) đã học theo tài khoản.
+        # DatabaseManager nạp/lưu giá trị này qua etl_state để dùng lại cho các lần chạy sau.
+        self.safe_window_days: Dict[str, int] = {}
+        self._ad_ids: Dict[str, List[str]] = {}
+        self._safe_window_lock = threading.Lock()
+        # RawArchive (tùy chọn): nếu được gán, mỗi trang posts thô được lưu lại trước khi xử lý
+        self.raw_archive = None
         if not self.access_token:
             raise ValueError("SECRET_KEY không được cấu hình")
         
@@ -128,9 +257,7 @@ class FacebookAdsExtractor:
             'fields': 'id,name'
         }
         try:
-            response = requests.get(test_url, params=params)
-            response.raise_for_status()
-            data = response.json()
+            data = self.client.get_json(test_url, params=params)
             logger.info(f"Kết nối đến Facebook API thành công. Tìm thấy {len(data.get('data', []))} tài khoản quảng cáo.")
             return True
         
@@ -153,12 +280,9 @@ class FacebookAdsExtractor:
         }
         
         page_count = 0
-        while url:
-            try:
+        try:
+            for data in self.client.iter_pages(url, params):
                 page_count += 1
-                response = requests.get(url, params=params if page_count == 1 else {})
-                response.raise_for_status()
-                data = response.json()
 
                 accounts_page = data.get('data', [])
                 if not accounts_page:
@@ -167,29 +291,18 @@ class FacebookAdsExtractor:
                     
                 all_accounts.extend(accounts_page)
                 logger.info(f"Đã lấy được {len(accounts_page)} tài khoản (Tổng: {len(all_accounts)}).")
-
-                # Xử lý phân trang (Pagination)
-                next_page_url = data.get('paging', {}).get('next')
-                url = next_page_url # Nếu next_page_url là None, vòng lặp sẽ dừng
-            
-            except requests.exceptions.RequestException as e:
-                logger.error(f"Lỗi khi lấy Ad Accounts (Trang {page_count}): {e}")
-                if e.response is not None:
-                    logger.error(f"Response: {e.response.json()}")
-                break
-            except Exception as e:
-                logger.error(f"Lỗi không xác định: {e}")
-                break
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Lỗi khi lấy Ad Accounts (Trang {page_count + 1}): {e}")
+            if e.response is not None:
+                logger.error(f"Response: {e.response.json()}")
+        except Exception as e:
+            logger.error(f"Lỗi không xác định: {e}")
         return all_accounts
 
-    def get_campaigns_for_account(self, account_id: str, start_date: Optional[str] = None, end_date: Optional[str] = None, date_preset: Optional[str] = None) -> List[Dict[str, Any]]:
+    def _campaigns_params(self, start_date: Optional[str] = None, end_date: Optional[str] = None, date_preset: Optional[str] = None) -> Dict[str, Any]:
         """
-        Lấy tất cả chiến dịch quảng cáo cho một tài khoản cụ thể trong một khoảng thời gian.
-        Nếu có date_preset thì sử dụng date_preset thay vì start_date và end_date.
+        Params cho endpoint /{account_id}/campaigns (dùng chung cho chế độ tuần tự và batch).
         """
-        campaigns = []
-        url = f"{self.base_url}/{account_id}/campaigns"
-
         filtering_structure = [
             {
                 'field': 'effective_status',
@@ -197,70 +310,26 @@ class FacebookAdsExtractor:
                 'value': ['ACTIVE', 'PAUSED', 'ARCHIVED', 'DELETED']
             }
         ]
-        filtering_json_string = json.dumps(filtering_structure)
-
+        params = {
+            'access_token': self.access_token,
+            'fields': 'account_id,id,name,created_time,objective,status,start_time,stop_time',
+            'limit': 100,
+            'filtering': json.dumps(filtering_structure)
+        }
         if date_preset and date_preset in DATE_PRESET:
-            params = {
-                'access_token': self.access_token,
-                'fields': 'account_id,id,name,created_time,objective,status,start_time,stop_time',
-                'limit': 100,
-                'date_preset': date_preset,
-                'filtering': filtering_json_string
-            }
-            logger.info(f"Lấy chiến dịch cho tài khoản {account_id} với khoảng '{date_preset}'...")
+            params['date_preset'] = date_preset
         else:
-            params = {
-                'access_token': self.access_token,
-                'fields': 'account_id,id,name,created_time,objective,status,start_time,stop_time',
-                'limit': 100,
-                'time_range': json.dumps({
-                    'since': start_date,
-                    'until': end_date
-                }),
-                'filtering': filtering_json_string
-            }
-            logger.info(f"Lấy chiến dịch cho tài khoản {account_id} từ {start_date} đến {end_date}...")
-        
-        page_count = 0
-        while url:
-            try:
-                page_count += 1
-                response = requests.get(url, params=params if page_count == 1 else {})
-                response.raise_for_status()
-                data = response.json()
-
-                campaigns_page = data.get('data', [])
-                if not campaigns_page:
-                    logger.info("Không tìm thấy thêm chiến dịch nào.")
-                    break
-                    
-                campaigns.extend(campaigns_page)
-                logger.info(f"Đã lấy được {len(campaigns_page)} chiến dịch (Tổng: {len(campaigns)}).")
-
-                # Xử lý phân trang (Pagination)
-                next_page_url = data.get('paging', {}).get('next')
-                url = next_page_url # Nếu next_page_url là None, vòng lặp sẽ dừng
-            
-            except requests.exceptions.RequestException as e:
-                logger.error(f"Lỗi khi lấy Campaigns cho tài khoản {account_id} (Trang {page_count}): {e}")
-                if e.response is not None:
-                    logger.error(f"Response: {e.response.json()}")
-                break
-            except Exception as e:
-                logger.error(f"Lỗi không xác định: {e}")
-                break
-        
-        logger.info(f"Hoàn tất! Lấy được tổng cộng {len(campaigns)} chiến dịch cho tài khoản {account_id}.")
-        return campaigns
+            params['time_range'] = json.dumps({
+                'since': start_date,
+                'until': end_date
+            })
+        return params
 
-    def get_adsets_for_campaigns(self, account_id: str, campaign_id: List[str], start_date: Optional[str] = None, end_date: Optional[str] = None, date_preset: Optional[str] = None) -> List[Dict[str, Any]]:
+    def _adsets_params(self, campaign_id: List[str], start_date: Optional[str] = None, end_date: Optional[str] = None, date_preset: Optional[str] = None) -> Optional[Dict[str, Any]]:
         """
-        Lấy tất cả adsets cho một hoặc nhiều chiến dịch cụ thể của tài khoản QC trong một khoảng thời gian.
-        Nếu có date_preset thì sử dụng date_preset thay vì start_date và end_date.
+        Params cho endpoint /{account_id}/adsets, lọc theo danh sách campaign.
+        Trả về None nếu thiếu cả date_preset lẫn (start_date, end_date).
         """
-        adsets = []
-        url = f"{self.base_url}/{account_id}/adsets"
-
         filtering_structure = [
             {
                 'field': 'campaign.id',
@@ -273,73 +342,29 @@ class FacebookAdsExtractor:
                 'value': ['ACTIVE', 'PAUSED', 'ARCHIVED', 'DELETED']
             }
         ]
-        
-        # Chuyển cấu trúc dữ liệu thành chuỗi JSON hợp lệ
-        filtering_json_string = json.dumps(filtering_structure)
+        params = {
+            # Chuyển cấu trúc dữ liệu thành chuỗi JSON hợp lệ
+            'filtering': json.dumps(filtering_structure),
+            'fields': 'account_id,campaign_id,id,name,created_time,status,start_time,end_time',
+            'access_token': self.access_token,
+            'limit': 100,
+        }
         if date_preset and date_preset in DATE_PRESET:
-            params = {
-                'filtering': filtering_json_string,
-                'fields': 'account_id,campaign_id,id,name,created_time,status,start_time,end_time',
-                'access_token': self.access_token,
-                'limit': 100,
-                'date_preset': date_preset
-            }
-            logger.info(f"Lấy nhóm quảng cáo cho chiến dịch của tài khoản {account_id} và của tổng {len(campaign_id)} chiến dịch trong khoảng '{date_preset}'...")
+            params['date_preset'] = date_preset
         elif start_date and end_date:
-            params = {
-                'filtering': filtering_json_string,
-                'fields': 'account_id,campaign_id,id,name,created_time,status,start_time,end_time',
-                'access_token': self.access_token,
-                'limit': 100,
-                'time_range': json.dumps({
-                    'since': start_date,
-                    'until': end_date
-                })
-            }
-            logger.info(f"Lấy nhóm quảng cáo cho chiến dịch của tài khoản {account_id} và của tổng {len(campaign_id)} chiến dịch từ {start_date} đến {end_date}...")
+            params['time_range'] = json.dumps({
+                'since': start_date,
+                'until': end_date
+            })
         else:
-            logger.error("Phải cung cấp hoặc date_preset hoặc cả start_date và end_date.")
-            return adsets
-
-        page_count = 0
-        while url:
-            try:
-                page_count += 1
-                response = requests.get(url, params=params if page_count == 1 else {})
-                response.raise_for_status()
-                data = response.json()
-
-                adsets_page = data.get('data', [])
-                if not adsets_page:
-                    logger.info("Không tìm thấy thêm nhóm quảng cáo nào.")
-                    break
-                    
-                adsets.extend(adsets_page)
-                logger.info(f"Đã lấy được {len(adsets_page)} nhóm quảng cáo (Tổng: {len(adsets)}).")
+            return None
+        return params
 
-                # Xử lý phân trang (Pagination)
-                next_page_url = data.get('paging', {}).get('next')
-                url = next_page_url # Nếu next_page_url là None, vòng lặp sẽ dừng
-            
-            except requests.exceptions.RequestException as e:
-                logger.error(f"Lỗi khi lấy Ad Sets cho chiến dịch cho tài khoản {account_id} (Trang {page_count}): {e}")
-                if e.response is not None:
-                    logger.error(f"Response: {e.response.json()}")
-                break
-            except Exception as e:
-                logger.error(f"Lỗi không xác định: {e}")
-                break
-
-        logger.info(f"Hoàn tất! Lấy được tổng cộng {len(adsets)} nhóm quảng cáo cho chiến dịch cho tài khoản {account_id}.")
-        return adsets
-
-    def get_ads_for_adsets(self, account_id: str, adset_id: List[str], start_date: Optional[str] = None, end_date: Optional[str] = None, date_preset: Optional[str] = None) -> List[Dict[str, Any]]:
+    def _ads_params(self, adset_id: List[str], start_date: Optional[str] = None, end_date: Optional[str] = None, date_preset: Optional[str] = None) -> Optional[Dict[str, Any]]:
         """
-        Lấy tất cả quảng cáo cho một nhóm quảng cáo cụ thể thuộc một hoặc nhiều adset cụ thể của tài khoản quảng cáo trong khoảng thời gian.
-        Nếu có date_preset thì sử dụng date_preset thay vì start_date và end_date.
+        Params cho endpoint /{account_id}/ads, lọc theo danh sách adset.
+        Trả về None nếu thiếu cả date_preset lẫn (start_date, end_date).
         """
-        ads = []
-        url = f"{self.base_url}/{account_id}/ads"
         filtering_structure = [
             {
                 'field': 'adset.id',
@@ -352,81 +377,191 @@ class FacebookAdsExtractor:
                 'value': ['ACTIVE', 'PAUSED', 'ARCHIVED', 'DELETED']
             }
         ]
-        # Chuyển cấu trúc dữ liệu thành chuỗi JSON hợp lệ
-        filtering_json_string = json.dumps(filtering_structure)
-
+        params = {
+            # Chuyển cấu trúc dữ liệu thành chuỗi JSON hợp lệ
+            'filtering': json.dumps(filtering_structure),
+            'fields': 'account_id,campaign_id,adset_id,id,name,created_time,status,ad_schedule_start_time,ad_schedule_end_time',
+            'access_token': self.access_token,
+            'limit': 100,
+        }
         if date_preset and date_preset in DATE_PRESET:
-            params = {
-                'filtering': filtering_json_string,
-                'fields': 'account_id,campaign_id,adset_id,id,name,created_time,status,ad_schedule_start_time,ad_schedule_end_time',
-                'access_token': self.access_token,
-                'limit': 100,
-                'date_preset': date_preset
-            }
-            logger.info(f"Lấy quảng cáo cho tổng {len(adset_id)} nhóm quảng cáo thuộc tài khoản {account_id} trong khoảng '{date_preset}'...")
+            params['date_preset'] = date_preset
         elif start_date and end_date:
-            params = {
-                'filtering': filtering_json_string,
-                'fields': 'account_id,campaign_id,adset_id,id,name,created_time,status,ad_schedule_start_time,ad_schedule_end_time',
-                'access_token': self.access_token,
-                'limit': 100,
-                'time_range': json.dumps({
-                    'since': start_date,
-                    'until': end_date
-                })
-            }
-            logger.info(f"Lấy quảng cáo cho tổng {len(adset_id)} nhóm quảng cáo thuộc tài khoản {account_id} từ {start_date} đến {end_date}...")
+            params['time_range'] = json.dumps({
+                'since': start_date,
+                'until': end_date
+            })
         else:
-            logger.error("Phải cung cấp hoặc date_preset hoặc cả start_date và end_date.")
-            return ads
+            return None
+        return params
+
+    def _iter_record_pages(self, url: str, params: Dict[str, Any], entity: str, error_context: str,
+                           checkpoint: Optional[Any] = None) -> Iterator[List[Dict[str, Any]]]:
+        """
+        Duyệt các trang của một endpoint Graph API, yield list bản ghi của từng trang.
+        Trang kế tiếp được tải trước ở thread nền trong lúc bên gọi xử lý trang hiện tại.
+        Lỗi được log và dừng vòng lặp (giữ nguyên các trang đã yield).
+
+        checkpoint (tùy chọn, VD: database_manager.PaginationCheckpoint):
+        - Tiếp tục từ checkpoint.after nếu có, bỏ qua hoàn toàn nếu checkpoint.completed.
+        - checkpoint.commit(after) được gọi khi bên gọi đã xử lý xong một trang (generator được resume).
+        - checkpoint.complete() được gọi khi đã duyệt hết các trang.
+        """
+        if checkpoint is not None:
+            if checkpoint.completed:
+                logger.info(f"Bỏ qua {error_context}: đã nạp xong theo checkpoint.")
+                return
+            if checkpoint.after:
+                params = dict(params, after=checkpoint.after)
+                logger.info(f"Tiếp tục {error_context} từ checkpoint (đã nạp {checkpoint.pages_loaded} trang).")
 
         page_count = 0
-        while url:
-            try:
+        total = 0
+        try:
+            for data in self.client.iter_pages(url, params, prefetch=True):
                 page_count += 1
-                response = requests.get(url, params=params if page_count == 1 else {})
-                response.raise_for_status()
-                data = response.json()
 
-                ads_page = data.get('data', [])
-                if not ads_page:
-                    logger.info("Không tìm thấy thêm quảng cáo nào.")
+                records_page = data.get('data', [])
+                if not records_page:
+                    logger.info(f"Không tìm thấy thêm {entity} nào.")
                     break
-                    
-                ads.extend(ads_page)
-                logger.info(f"Đã lấy được {len(ads_page)} quảng cáo (Tổng: {len(ads)}).")
 
-                # Xử lý phân trang (Pagination)
-                next_page_url = data.get('paging', {}).get('next')
-                url = next_page_url # Nếu next_page_url là None, vòng lặp sẽ dừng
-            
-            except requests.exceptions.RequestException as e:
-                logger.error(f"Lỗi khi lấy Ads cho nhóm quảng cáo {adset_id} (Trang {page_count}): {e}")
-                if e.response is not None:
-                    logger.error(f"Response: {e.response.json()}")
-                break
-            except Exception as e:
-                logger.error(f"Lỗi không xác định: {e}")
-                break
+                total += len(records_page)
+                logger.info(f"Đã lấy được {len(records_page)} {entity} (Tổng: {total}).")
+                yield records_page
+
+                if checkpoint is not None:
+                    paging = data.get('paging', {})
+                    if paging.get('next'):
+                        checkpoint.commit(paging.get('cursors', {}).get('after'))
+            if checkpoint is not None:
+                checkpoint.complete()
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Lỗi khi lấy {error_context} (Trang {page_count + 1}): {e}")
+            if e.response is not None:
+                logger.error(f"Response: {e.response.json()}")
+        except Exception as e:
+            logger.error(f"Lỗi không xác định: {e}")
+
+    def _iter_chunked_in_filter(self, url: str, ids: List[str], build_params: Callable[[List[str]], Dict[str, Any]],
+                                entity: str, error_context: str) -> Iterator[List[Dict[str, Any]]]:
+        """
+        Phân trang một endpoint có bộ lọc IN theo danh sách ID dài (campaign.id, adset.id):
+        chia ID thành các nhóm IN_FILTER_CHUNK_SIZE, chạy tối đa IN_FILTER_CONCURRENCY nhóm song song
+        (vẫn chịu giới hạn chung của GraphClient) và loại bỏ bản ghi trùng theo 'id'.
+        """
+        unique_ids = list(dict.fromkeys(ids))
+        chunks = chunked(unique_ids, IN_FILTER_CHUNK_SIZE)
+        if len(chunks) > 1:
+            logger.info(f"{error_context}: chia {len(unique_ids)} ID thành {len(chunks)} nhóm.")
+        generators = [
+            self._iter_record_pages(url, build_params(chunk), entity, f"{error_context} (nhóm {n}/{len(chunks)})")
+            for n, chunk in enumerate(chunks, start=1)
+        ]
+
+        seen_ids = set()
+        for records_page in self._merge_concurrently(generators, max_workers=IN_FILTER_CONCURRENCY):
+            unique_page = []
+            for record in records_page:
+                if record.get('id') not in seen_ids:
+                    seen_ids.add(record.get('id'))
+                    unique_page.append(record)
+            if unique_page:
+                yield unique_page
+
+    def iter_campaigns_for_account(self, account_id: str, start_date: Optional[str] = None, end_date: Optional[str] = None, date_preset: Optional[str] = None) -> Iterator[List[Dict[str, Any]]]:
+        """
+        Generator của get_campaigns_for_account: yield từng trang chiến dịch.
+        """
+        url = f"{self.base_url}/{account_id}/campaigns"
+        params = self._campaigns_params(start_date, end_date, date_preset)
+
+        if date_preset and date_preset in DATE_PRESET:
+            logger.info(f"Lấy chiến dịch cho tài khoản {account_id} với khoảng '{date_preset}'...")
+        else:
+            logger.info(f"Lấy chiến dịch cho tài khoản {account_id} từ {start_date} đến {end_date}...")
+
+        yield from self._iter_record_pages(url, params, 'chiến dịch', f"Campaigns cho tài khoản {account_id}")
+
+    def get_campaigns_for_account(self, account_id: str, start_date: Optional[str] = None, end_date: Optional[str] = None, date_preset: Optional[str] = None) -> List[Dict[str, Any]]:
+        """
+        Lấy tất cả chiến dịch quảng cáo cho một tài khoản cụ thể trong một khoảng thời gian.
+        Nếu có date_preset thì sử dụng date_preset thay vì start_date và end_date.
+        """
+        campaigns = [c for page in self.iter_campaigns_for_account(account_id, start_date, end_date, date_preset) for c in page]
+        logger.info(f"Hoàn tất! Lấy được tổng cộng {len(campaigns)} chiến dịch cho tài khoản {account_id}.")
+        return campaigns
+
+    def iter_adsets_for_campaigns(self, account_id: str, campaign_id: List[str], start_date: Optional[str] = None, end_date: Optional[str] = None, date_preset: Optional[str] = None) -> Iterator[List[Dict[str, Any]]]:
+        """
+        Generator của get_adsets_for_campaigns: yield từng trang nhóm quảng cáo.
+        """
+        url = f"{self.base_url}/{account_id}/adsets"
+        params = self._adsets_params(campaign_id, start_date, end_date, date_preset)
+
+        if params is None:
+            logger.error("Phải cung cấp hoặc date_preset hoặc cả start_date và end_date.")
+            return
+        if date_preset and date_preset in DATE_PRESET:
+            logger.info(f"Lấy nhóm quảng cáo cho chiến dịch của tài khoản {account_id} và của tổng {len(campaign_id)} chiến dịch trong khoảng '{date_preset}'...")
+        else:
+            logger.info(f"Lấy nhóm quảng cáo cho chiến dịch của tài khoản {account_id} và của tổng {len(campaign_id)} chiến dịch từ {start_date} đến {end_date}...")
+
+        yield from self._iter_chunked_in_filter(
+            url, campaign_id, lambda chunk: self._adsets_params(chunk, start_date, end_date, date_preset),
+            'nhóm quảng cáo', f"Ad Sets cho chiến dịch cho tài khoản {account_id}"
+        )
+
+    def get_adsets_for_campaigns(self, account_id: str, campaign_id: List[str], start_date: Optional[str] = None, end_date: Optional[str] = None, date_preset: Optional[str] = None) -> List[Dict[str, Any]]:
+        """
+        Lấy tất cả adsets cho một hoặc nhiều chiến dịch cụ thể của tài khoản QC trong một khoảng thời gian.
+        Nếu có date_preset thì sử dụng date_preset thay vì start_date và end_date.
+        """
+        adsets = [a for page in self.iter_adsets_for_campaigns(account_id, campaign_id, start_date, end_date, date_preset) for a in page]
+        logger.info(f"Hoàn tất! Lấy được tổng cộng {len(adsets)} nhóm quảng cáo cho chiến dịch cho tài khoản {account_id}.")
+        return adsets
+
+    def iter_ads_for_adsets(self, account_id: str, adset_id: List[str], start_date: Optional[str] = None, end_date: Optional[str] = None, date_preset: Optional[str] = None) -> Iterator[List[Dict[str, Any]]]:
+        """
+        Generator của get_ads_for_adsets: yield từng trang quảng cáo.
+        """
+        url = f"{self.base_url}/{account_id}/ads"
+        params = self._ads_params(adset_id, start_date, end_date, date_preset)
+
+        if params is None:
+            logger.error("Phải cung cấp hoặc date_preset hoặc cả start_date và end_date.")
+            return
+        if date_preset and date_preset in DATE_PRESET:
+            logger.info(f"Lấy quảng cáo cho tổng {len(adset_id)} nhóm quảng cáo thuộc tài khoản {account_id} trong khoảng '{date_preset}'...")
+        else:
+            logger.info(f"Lấy quảng cáo cho tổng {len(adset_id)} nhóm quảng cáo thuộc tài khoản {account_id} từ {start_date} đến {end_date}...")
+
+        yield from self._iter_chunked_in_filter(
+            url, adset_id, lambda chunk: self._ads_params(chunk, start_date, end_date, date_preset),
+            'quảng cáo', f"Ads cho nhóm quảng cáo của tài khoản {account_id}"
+        )
 
+    def get_ads_for_adsets(self, account_id: str, adset_id: List[str], start_date: Optional[str] = None, end_date: Optional[str] = None, date_preset: Optional[str] = None) -> List[Dict[str, Any]]:
+        """
+        Lấy tất cả quảng cáo cho một nhóm quảng cáo cụ thể thuộc một hoặc nhiều adset cụ thể của tài khoản quảng cáo trong khoảng thời gian.
+        Nếu có date_preset thì sử dụng date_preset thay vì start_date và end_date.
+        """
+        ads = [ad for page in self.iter_ads_for_adsets(account_id, adset_id, start_date, end_date, date_preset) for ad in page]
         logger.info(f"Hoàn tất! Lấy được tổng cộng {len(ads)} quảng cáo cho tổng {len(adset_id)} nhóm quảng cáo.")
         return ads
 
-    def get_insights_platform(self, account_id: str, campaign_id: Optional[List[str]] = None, adset_id: Optional[List[str]] = None, ad_id: Optional[List[str]] = None, date_preset: Optional[str] = 'last_7d',
-                     start_date: Optional[str] = None, end_date: Optional[str] = None) -> List[Dict[str, Any]]:
+    def _insights_params(self, account_id: str, breakdowns: str, campaign_id: Optional[List[str]] = None, adset_id: Optional[List[str]] = None,
+                         ad_id: Optional[List[str]] = None, date_preset: Optional[str] = 'last_7d',
+                         start_date: Optional[str] = None, end_date: Optional[str] = None) -> Dict[str, Any]:
         """
-        Lấy dữ liệu insights breakdown theo vị trí quảng cáo.
-        Nếu không có ID nào được cung cấp, sẽ lấy insights tổng hợp cho toàn bộ tài khoản.
+        Dựng params cho insights có breakdown, lọc theo campaign/adset/ad hoặc tổng hợp cấp tài khoản.
         """
-        insights = []
-        url = f"{self.base_url}/{account_id}/insights"
-
         params = {
             'access_token': self.access_token,
             'limit': 100,
             'fields': 'impressions,clicks,spend,ctr,cpc,cpm,reach,frequency,actions,action_values',
             'time_increment': 1,  # Lấy dữ liệu nhóm theo hàng ngày
-            'breakdowns': 'publisher_platform,platform_position',
+            'breakdowns': breakdowns,
         }
 
         filtering_structure = []
@@ -452,36 +587,31 @@ class FacebookAdsExtractor:
         elif start_date and end_date:
             params['time_range'] = json.dumps({'since': start_date, 'until': end_date})
             logger.info(f"Lấy dữ liệu insights cho tài khoản {account_id} từ {start_date} đến {end_date}...")
+        return params
 
-        page_count = 0
-        while url:
-            try:
-                page_count += 1
-                response = requests.get(url, params=params if page_count == 1 else {})
-                response.raise_for_status()
-                data = response.json()
+    def iter_insights_platform(self, account_id: str, campaign_id: Optional[List[str]] = None, adset_id: Optional[List[str]] = None, ad_id: Optional[List[str]] = None, date_preset: Optional[str] = 'last_7d',
+                               start_date: Optional[str] = None, end_date: Optional[str] = None) -> Iterator[List[Dict[str, Any]]]:
+        """
+        Generator của get_insights_platform: yield từng trang insights breakdown theo vị trí quảng cáo.
+        """
+        params = self._insights_params(account_id, 'publisher_platform,platform_position', campaign_id, adset_id, ad_id, date_preset, start_date, end_date)
+        yield from self._iter_record_pages(f"{self.base_url}/{account_id}/insights", params, 'bản ghi insights', f"Insights cho tài khoản {account_id}")
 
-                insights_page = data.get('data', [])
-                if not insights_page:
-                    logger.info("Không tìm thấy thêm dữ liệu insights nào.")
-                    break
-                    
-                insights.extend(insights_page)
-                logger.info(f"Đã lấy được {len(insights_page)} bản ghi insights (Tổng: {len(insights)}).")
+    def get_insights_platform(self, account_id: str, campaign_id: Optional[List[str]] = None, adset_id: Optional[List[str]] = None, ad_id: Optional[List[str]] = None, date_preset: Optional[str] = 'last_7d',
+                     start_date: Optional[str] = None, end_date: Optional[str] = None) -> List[Dict[str, Any]]:
+        """
+        Lấy dữ liệu insights breakdown theo vị trí quảng cáo.
+        Nếu không có ID nào được cung cấp, sẽ lấy insights tổng hợp cho toàn bộ tài khoản.
+        """
+        return [r for page in self.iter_insights_platform(account_id, campaign_id, adset_id, ad_id, date_preset, start_date, end_date) for r in page]
 
-                # Xử lý phân trang (Pagination)
-                next_page_url = data.get('paging', {}).get('next')
-                url = next_page_url # Nếu next_page_url là None, vòng lặp sẽ dừng
-            
-            except requests.exceptions.RequestException as e:
-                logger.error(f"Lỗi khi lấy Insights cho tài khoản {account_id} (Trang {page_count}): {e}")
-                if e.response is not None:
-                    logger.error(f"Response: {e.response.json()}")
-                break
-            except Exception as e:
-                logger.error(f"Lỗi không xác định: {e}")
-                break
-        return insights
+    def iter_insights_demo(self, account_id: str, campaign_id: Optional[List[str]] = None, adset_id: Optional[List[str]] = None, ad_id: Optional[List[str]] = None, date_preset: Optional[str] = 'last_7d',
+                           start_date: Optional[str] = None, end_date: Optional[str] = None) -> Iterator[List[Dict[str, Any]]]:
+        """
+        Generator của get_insights_demo: yield từng trang insights breakdown theo giới tính và độ tuổi.
+        """
+        params = self._insights_params(account_id, 'age,gender', campaign_id, adset_id, ad_id, date_preset, start_date, end_date)
+        yield from self._iter_record_pages(f"{self.base_url}/{account_id}/insights", params, 'bản ghi insights', f"Insights cho tài khoản {account_id}")
     
     def get_insights_demo(self, account_id: str, campaign_id: Optional[List[str]] = None, adset_id: Optional[List[str]] = None, ad_id: Optional[List[str]] = None, date_preset: Optional[str] = 'last_7d',
                      start_date: Optional[str] = None, end_date: Optional[str] = None) -> List[Dict[str, Any]]:
@@ -489,83 +619,316 @@ class FacebookAdsExtractor:
         Lấy dữ liệu insights breakdown theo nhân khẩu học giới tính và độ tuổi.
         Nếu không có ID nào được cung cấp, sẽ lấy insights tổng hợp cho toàn bộ tài khoản.
         """
-        insights = []
-        url = f"{self.base_url}/{account_id}/insights"
+        return [r for page in self.iter_insights_demo(account_id, campaign_id, adset_id, ad_id, date_preset, start_date, end_date) for r in page]
+
+    def _estimate_days(self, start_date: Optional[str], end_date: Optional[str], date_preset: Optional[str]) -> int:
+        """
+        Ước lượng số ngày của khoảng thời gian (dùng để chọn chế độ sync/async report).
+        """
+        if date_preset and date_preset in DATE_PRESET:
+            return PRESET_ESTIMATED_DAYS.get(date_preset, 30)
+        if start_date and end_date:
+            try:
+                start_obj = datetime.strptime(start_date, '%Y-%m-%d').date()
+                end_obj = datetime.strptime(end_date, '%Y-%m-%d').date()
+                return max(1, (end_obj - start_obj).days + 1)
+            except ValueError:
+                pass
+        return 30
+
+    def _count_ads(self, account_id: str) -> int:
+        """
+        Đếm số quảng cáo của tài khoản qua summary.total_count (1 request, chỉ tải 1 bản ghi).
+        Kết quả được cache trong extractor.
+        """
+        if account_id in self._ad_counts:
+            return self._ad_counts[account_id]
 
         params = {
             'access_token': self.access_token,
-            'limit': 100,
-            'fields': 'impressions,clicks,spend,ctr,cpc,cpm,reach,frequency,actions,action_values',
-            'time_increment': 1,  # Lấy dữ liệu nhóm theo hàng ngày
-            'breakdowns': 'age,gender',
+            'fields': 'id',
+            'summary': 'true',
+            'limit': 1,
+            'filtering': json.dumps([{
+                'field': 'effective_status',
+                'operator': 'IN',
+                'value': ['ACTIVE', 'PAUSED', 'ARCHIVED', 'DELETED']
+            }])
         }
+        try:
+            data = self.client.get_json(f"{self.base_url}/{account_id}/ads", params=params)
+            count = int(data.get('summary', {}).get('total_count', 0))
+        except Exception as e:
+            logger.warning(f"Không thể đếm số quảng cáo của tài khoản {account_id}: {e}")
+            count = 0
 
-        filtering_structure = []
-        if campaign_id:
-            filtering_structure.append({'field': 'campaign.id', 'operator': 'IN', 'value': campaign_id})
-            filtering_structure.append({'level': 'campaign'})
-        elif adset_id:
-            filtering_structure.append({'field': 'adset.id', 'operator': 'IN', 'value': adset_id})
-            filtering_structure.append({'level': 'adset'})
-        elif ad_id:
-            filtering_structure.append({'field': 'ad.id', 'operator': 'IN', 'value': ad_id})
-            filtering_structure.append({'level': 'ad'})
-        
-        if filtering_structure:
-            params['filtering'] = json.dumps(filtering_structure)
-        else:
-            params['level'] = 'account'
+        self._ad_counts[account_id] = count
+        return count
 
-        # Chỉ sử dụng date_preset nếu không có time_range.
-        if date_preset and date_preset in DATE_PRESET:
-            params['date_preset'] = date_preset
-            logger.info(f"Lấy dữ liệu insights cho tài khoản {account_id} với khoảng '{date_preset}'...")
-        elif start_date and end_date:
-            params['time_range'] = json.dumps({'since': start_date, 'until': end_date})
-            logger.info(f"Lấy dữ liệu insights cho tài khoản {account_id} từ {start_date} đến {end_date}...")
+    def _should_use_async_report(self, account_id: str, breakdowns: str, start_date: Optional[str], end_date: Optional[str],
+                                 date_preset: Optional[str], ad_count: Optional[int] = None) -> bool:
+        """
+        Chọn chế độ Async Report khi số dòng ước lượng (ngày x quảng cáo x cardinality breakdown)
+        vượt ngưỡng ASYNC_REPORT_ROW_THRESHOLD.
+        """
+        days = self._estimate_days(start_date, end_date, date_preset)
+        if ad_count is None:
+            ad_count = self._count_ads(account_id)
+        estimated_rows = days * ad_count * BREAKDOWN_CARDINALITY.get(breakdowns, 10)
+        use_async = estimated_rows >= ASYNC_REPORT_ROW_THRESHOLD
+        if use_async:
+            logger.info(f"Tài khoản {account_id} ({breakdowns}): ước lượng {estimated_rows} dòng "
+                        f"({days} ngày x {ad_count} quảng cáo) -> dùng Async Report.")
+        return use_async
+
+    def _iter_async_report_pages(self, account_id: str, params: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+        """
+        Chạy Insights dưới dạng Async Report Job:
+        1. POST /{account_id}/insights -> report_run_id
+        2. Poll /{report_run_id} tới khi 'Job Completed'
+        3. Duyệt các trang kết quả của /{report_run_id}/insights (theo lô bản ghi, xem GraphClient.iter_page_chunks)
+        Ném RuntimeError nếu job thất bại hoặc quá thời gian chờ.
+        """
+        job_params = {k: v for k, v in params.items() if k != 'limit'}
+        report = self.client.post_json(f"{self.base_url}/{account_id}/insights", data=job_params)
+        report_run_id = report.get('report_run_id')
+        if not report_run_id:
+            raise RuntimeError(f"Không nhận được report_run_id cho tài khoản {account_id}: {report}")
+        logger.info(f"Đã tạo Async Report {report_run_id} cho tài khoản {account_id}.")
+
+        poll_interval = ASYNC_REPORT_POLL_SECONDS
+        deadline = time.monotonic() + ASYNC_REPORT_TIMEOUT_SECONDS
+        while True:
+            status = self.client.get_json(f"{self.base_url}/{report_run_id}", params={
+                'access_token': self.access_token,
+                'fields': 'async_status,async_percent_completion'
+            })
+            async_status = status.get('async_status')
+            if async_status == 'Job Completed':
+                break
+            if async_status in ('Job Failed', 'Job Skipped'):
+                raise RuntimeError(f"Async Report {report_run_id} kết thúc với trạng thái '{async_status}'.")
+            if time.monotonic() >= deadline:
+                raise RuntimeError(f"Async Report {report_run_id} quá thời gian chờ ({ASYNC_REPORT_TIMEOUT_SECONDS}s).")
 
-        page_count = 0
-        while url:
+            logger.info(f"Async Report {report_run_id}: {async_status} ({status.get('async_percent_completion', 0)}%)...")
+            time.sleep(poll_interval)
+            poll_interval = min(poll_interval * 2, ASYNC_REPORT_MAX_POLL_SECONDS)
+
+        # Trang kết quả Async Report rất lớn: đọc stream và yield theo lô, không giữ nguyên trang trong bộ nhớ
+        yield from self.client.iter_page_chunks(f"{self.base_url}/{report_run_id}/insights", {
+            'access_token': self.access_token,
+            'limit': ASYNC_REPORT_PAGE_LIMIT
+        })
+
+    def _get_safe_window(self, account_id: str) -> Optional[int]:
+        with self._safe_window_lock:
+            return self.safe_window_days.get(account_id)
+
+    def _learn_safe_window(self, account_id: str, days: int):
+        """
+        Ghi nhận số ngày tối đa mỗi request Insights của tài khoản (chỉ giảm, không tăng).
+        """
+        with self._safe_window_lock:
+            current = self.safe_window_days.get(account_id)
+            if current is None or days < current:
+                self.safe_window_days[account_id] = days
+                logger.info(f"Tài khoản {account_id}: cửa sổ an toàn cho Insights giảm còn {days} ngày.")
+
+    def _list_ad_ids(self, account_id: str) -> List[str]:
+        """
+        Lấy danh sách ID quảng cáo của tài khoản (dùng để chia nhỏ theo ad.id khi 1 ngày vẫn quá lớn).
+        Kết quả được cache trong extractor.
+        """
+        with self._safe_window_lock:
+            if account_id in self._ad_ids:
+                return self._ad_ids[account_id]
+
+        params = {
+            'access_token': self.access_token,
+            'fields': 'id',
+            'limit': 500,
+            'filtering': json.dumps([{
+                'field': 'effective_status',
+                'operator': 'IN',
+                'value': ['ACTIVE', 'PAUSED', 'ARCHIVED', 'DELETED']
+            }])
+        }
+        ad_ids = []
+        for data in self.client.iter_pages(f"{self.base_url}/{account_id}/ads", params):
+            ad_ids.extend(ad['id'] for ad in data.get('data', []))
+
+        with self._safe_window_lock:
+            self._ad_ids[account_id] = ad_ids
+        return ad_ids
+
+    def _merge_concurrently(self, generators: List[Iterator[List[Dict[str, Any]]]], max_workers: Optional[int] = None) -> Iterator[List[Dict[str, Any]]]:
+        """
+        Chạy nhiều generator trang song song (tối đa max_workers, mặc định INSIGHTS_SPLIT_CONCURRENCY)
+        và yield các trang theo thứ tự về tới.
+        Mỗi worker chờ bên gọi xử lý xong trang vừa giao rồi mới tiếp tục, để checkpoint của generator con
+        chỉ được ghi sau khi trang đã được nạp. Lỗi của bất kỳ generator nào được ném lại cho bên gọi.
+        """
+        if len(generators) == 1:
+            yield from generators[0]
+            return
+
+        items = queue.Queue()
+        stop = threading.Event()
+
+        def _drain(generator: Iterator[List[Dict[str, Any]]]):
             try:
-                page_count += 1
-                response = requests.get(url, params=params if page_count == 1 else {})
-                response.raise_for_status()
-                data = response.json()
+                for page in generator:
+                    if stop.is_set():
+                        break
+                    processed = threading.Event()
+                    items.put(('page', page, processed))
+                    while not processed.wait(timeout=1):
+                        if stop.is_set():
+                            break
+                    if stop.is_set():
+                        break
+                items.put(('done', None, None))
+            except Exception as e:
+                items.put(('error', e, None))
+            finally:
+                generator.close()
 
-                insights_page = data.get('data', [])
-                if not insights_page:
-                    logger.info("Không tìm thấy thêm dữ liệu insights nào.")
+        executor = ThreadPoolExecutor(max_workers=min(len(generators), max_workers or INSIGHTS_SPLIT_CONCURRENCY), thread_name_prefix='merge-pages')
+        for generator in generators:
+            executor.submit(_drain, generator)
+
+        remaining = len(generators)
+        try:
+            while remaining:
+                kind, value, processed = items.get()
+                if kind == 'page':
+                    try:
+                        yield value
+                    finally:
+                        processed.set()
+                elif kind == 'done':
+                    remaining -= 1
+                else:
+                    raise value
+        finally:
+            stop.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _iter_insights_windows(self, account_id: str, url: str, params: Dict[str, Any], start_date: str, end_date: str,
+                               label: str = '', checkpoint: Optional[Any] = None) -> Iterator[List[Dict[str, Any]]]:
+        """
+        Chia (start_date, end_date) theo cửa sổ an toàn đã học của tài khoản rồi lấy các cửa sổ song song.
+        Mỗi cửa sổ dùng _iter_insights_adaptive (tự chia đôi khi vẫn quá lớn) với checkpoint riêng.
+        """
+        windows = split_date_range(start_date, end_date, self._get_safe_window(account_id))
+        if len(windows) == 1:
+            yield from self._iter_insights_adaptive(account_id, url, params, start_date, end_date, label=label, checkpoint=checkpoint)
+            return
+
+        if checkpoint is not None and checkpoint.completed:
+            return
+        logger.info(f"Tài khoản {account_id}{label}: chia {start_date} -> {end_date} thành {len(windows)} cửa sổ "
+                    f"{self._get_safe_window(account_id)} ngày theo cửa sổ an toàn đã học.")
+        yield from self._merge_concurrently([
+            self._iter_insights_adaptive(account_id, url, params, since, until, label=label,
+                                         checkpoint=checkpoint.for_window(since, until) if checkpoint is not None else None)
+            for since, until in windows
+        ])
+        if checkpoint is not None:
+            checkpoint.complete()
+
+    def _iter_insights_adaptive(self, account_id: str, url: str, base_params: Dict[str, Any], since: Optional[str] = None, until: Optional[str] = None,
+                                ad_ids: Optional[List[str]] = None, label: str = '', checkpoint: Optional[Any] = None) -> Iterator[List[Dict[str, Any]]]:
+        """
+        Lấy insights của một cửa sổ (since, until) và tập ad.id (tùy chọn), yield từng trang.
+        Khi Graph API báo request quá lớn (code 1 / subcode 1504033 hoặc timeout):
+        1. Chia đôi time_range (và ghi nhận cửa sổ an toàn của tài khoản), hoặc
+        2. Nếu chỉ còn 1 ngày (hoặc dùng date_preset): chia đôi tập ad.id,
+        rồi lấy 2 nửa song song và gộp kết quả. Các trang đã yield trước khi lỗi có thể được lấy lại
+        (upsert Fact loại trùng theo khóa nên không ảnh hưởng dữ liệu).
+        Các lỗi khác được ném lại cho bên gọi.
+        """
+        if checkpoint is not None and checkpoint.completed:
+            return
+
+        params = dict(base_params)
+        if since and until:
+            params.pop('date_preset', None)
+            params['time_range'] = json.dumps({'since': since, 'until': until})
+        if ad_ids is not None:
+            filtering = json.loads(params.get('filtering', '[]'))
+            filtering.append({'field': 'ad.id', 'operator': 'IN', 'value': ad_ids})
+            params['filtering'] = json.dumps(filtering)
+        if checkpoint is not None and checkpoint.after:
+            params['after'] = checkpoint.after
+
+        scope = f"tài khoản {account_id}{label}" + (f" [{since} -> {until}]" if since and until else "") + (f" ({len(ad_ids)} quảng cáo)" if ad_ids is not None else "")
+        total = 0
+        try:
+            for data in self.client.iter_pages(url, params, prefetch=True):
+                records_page = data.get('data', [])
+                if not records_page:
                     break
-                    
-                insights.extend(insights_page)
-                logger.info(f"Đã lấy được {len(insights_page)} bản ghi insights (Tổng: {len(insights)}).")
+                total += len(records_page)
+                logger.info(f"Đã lấy được {len(records_page)} bản ghi insights cho {scope} (Tổng: {total}).")
+                yield records_page
+
+                if checkpoint is not None:
+                    paging = data.get('paging', {})
+                    if paging.get('next'):
+                        checkpoint.commit(paging.get('cursors', {}).get('after'))
+            if checkpoint is not None:
+                checkpoint.complete()
+            return
+        except requests.exceptions.RequestException as e:
+            if not is_reduce_data_error(e):
+                logger.error(f"Lỗi khi lấy Insights cho {scope}: {e}")
+                raise
+            error = e
+
+        if since and until and since != until:
+            (first_since, first_until), (second_since, second_until) = bisect_date_range(since, until)
+            first_days = (datetime.strptime(first_until, '%Y-%m-%d') - datetime.strptime(first_since, '%Y-%m-%d')).days + 1
+            self._learn_safe_window(account_id, first_days)
+            logger.warning(f"Insights quá lớn cho {scope}: chia đôi thành [{first_since} -> {first_until}] và [{second_since} -> {second_until}].")
+            halves = [
+                self._iter_insights_adaptive(account_id, url, base_params, first_since, first_until, ad_ids, label,
+                                             checkpoint.for_window(first_since, first_until) if checkpoint is not None else None),
+                self._iter_insights_adaptive(account_id, url, base_params, second_since, second_until, ad_ids, label,
+                                             checkpoint.for_window(second_since, second_until) if checkpoint is not None else None),
+            ]
+        else:
+            ids = ad_ids if ad_ids is not None else self._list_ad_ids(account_id)
+            if len(ids) <= 1:
+                logger.error(f"Insights vẫn quá lớn cho {scope}, không thể chia nhỏ thêm.")
+                raise error
+            middle = len(ids) // 2
+            logger.warning(f"Insights quá lớn cho {scope}: chia đôi tập {len(ids)} quảng cáo.")
+            halves = [
+                self._iter_insights_adaptive(account_id, url, base_params, since, until, ids[:middle], label),
+                self._iter_insights_adaptive(account_id, url, base_params, since, until, ids[middle:], label),
+            ]
 
-                # Xử lý phân trang (Pagination)
-                next_page_url = data.get('paging', {}).get('next')
-                url = next_page_url # Nếu next_page_url là None, vòng lặp sẽ dừng
-            
-            except requests.exceptions.RequestException as e:
-                logger.error(f"Lỗi khi lấy Insights cho tài khoản {account_id} (Trang {page_count}): {e}")
-                if e.response is not None:
-                    logger.error(f"Response: {e.response.json()}")
-                break
-            except Exception as e:
-                logger.error(f"Lỗi không xác định: {e}")
-                break
-        return insights
+        yield from self._merge_concurrently(halves)
+        if checkpoint is not None:
+            checkpoint.complete()
 
-    def get_all_insights_platform(self, account_id: str, start_date: Optional[str] = None, end_date: Optional[str] = None, date_preset: Optional[str] = None) -> List[Dict[str, Any]]:
+    def _iter_ad_level_insights(self, account_id: str, breakdowns: str, start_date: Optional[str] = None, end_date: Optional[str] = None,
+                                date_preset: Optional[str] = None, filtering: Optional[List[Dict[str, Any]]] = None,
+                                label: str = '', ad_count: Optional[int] = None, checkpoint: Optional[Any] = None) -> Iterator[List[Dict[str, Any]]]:
         """
-        Lấy tất cả dữ liệu insights theo từ cấp độ quảng cáo cho theo vị trí quảng cáo
+        Generator chung lấy insights cấp độ quảng cáo (level=ad, time_increment=1) theo một breakdown,
+        yield từng trang bản ghi.
+        Tự động chuyển sang Async Report khi khối lượng dữ liệu ước lượng lớn.
+        Phân trang đồng bộ chia khoảng ngày theo cửa sổ an toàn đã học và tự chia nhỏ khi request quá lớn.
+        Với checkpoint đang dở dang (có cursor), luôn tiếp tục bằng phân trang đồng bộ
+        vì cursor của Async Report không dùng lại được giữa các lần chạy.
         """
-        all_insights = []
-        filtering_structure = [
-            {
-                'field': 'ad.effective_status',
-                'operator': 'IN',
-                'value': ['ACTIVE', 'PAUSED', 'ARCHIVED', 'DELETED']
-            }
-        ]
+        if checkpoint is not None and checkpoint.completed:
+            logger.info(f"Bỏ qua insights{label} ({breakdowns}) cho tài khoản {account_id}: đã nạp xong theo checkpoint.")
+            return
+
         url = f"{self.base_url}/{account_id}/insights"
 
         params = {
@@ -574,160 +937,447 @@ class FacebookAdsExtractor:
             'limit': 100,
             'fields': 'campaign_id,campaign_name,adset_id,adset_name,ad_id,ad_name,impressions,clicks,spend,ctr,cpc,cpm,reach,frequency,actions,action_values',
             'time_increment': 1,  # Lấy dữ liệu nhóm theo hàng ngày
-            'breakdowns': 'publisher_platform,platform_position',
-            'filtering': json.dumps(filtering_structure),
+            'breakdowns': breakdowns,
         }
+        if filtering:
+            params['filtering'] = json.dumps(filtering)
 
         # Chỉ sử dụng date_preset nếu không có time_range.
         if date_preset and date_preset in DATE_PRESET:
             params['date_preset'] = date_preset
-            logger.info(f"Lấy tất cả dữ liệu insights cho tài khoản {account_id} với khoảng '{date_preset}'...")
+            logger.info(f"Lấy tất cả dữ liệu insights{label} cho tài khoản {account_id} với khoảng '{date_preset}'...")
         elif start_date and end_date:
             params['time_range'] = json.dumps({'since': start_date, 'until': end_date})
-            logger.info(f"Lấy tất cả dữ liệu insights cho tài khoản {account_id} từ {start_date} đến {end_date}...")
+            logger.info(f"Lấy tất cả dữ liệu insights{label} cho tài khoản {account_id} từ {start_date} đến {end_date}...")
 
-        page_count = 0
-        while url:
+        resuming = checkpoint is not None and bool(checkpoint.after)
+        use_async = not resuming and self._should_use_async_report(account_id, breakdowns, start_date, end_date, date_preset, ad_count)
+        if use_async:
+            total = 0
             try:
-                page_count += 1
-                response = requests.get(url, params=params if page_count == 1 else {})
-                response.raise_for_status()
-                data = response.json()
+                for data in self._iter_async_report_pages(account_id, params):
+                    insights_page = data.get('data', [])
+                    if not insights_page:
+                        continue
+                    total += len(insights_page)
+                    logger.info(f"Đã lấy được {len(insights_page)} bản ghi insights{label} từ Async Report (Tổng: {total}).")
+                    yield insights_page
+                if checkpoint is not None:
+                    checkpoint.complete()
+                return
+            except Exception as e:
+                # Async Report lỗi -> quay về phân trang đồng bộ để không mất dữ liệu.
+                # Nếu đã yield một phần, lấy lại từ đầu vẫn an toàn: bên nạp upsert theo khóa tự nhiên (ON CONFLICT).
+                logger.warning(f"Async Report lỗi cho tài khoản {account_id}{label} sau {total} bản ghi: {e}. "
+                               f"Chuyển sang phân trang đồng bộ cho toàn bộ khoảng.")
 
-                insights_page = data.get('data', [])
-                if not insights_page:
-                    logger.info("Không tìm thấy thêm dữ liệu insights nào.")
-                    break
-                    
-                all_insights.extend(insights_page)
-                logger.info(f"Đã lấy được {len(insights_page)} bản ghi insights (Tổng: {len(all_insights)}).")
+        if start_date and end_date and not (date_preset and date_preset in DATE_PRESET):
+            yield from self._iter_insights_windows(account_id, url, params, start_date, end_date, label=label, checkpoint=checkpoint)
+        else:
+            yield from self._iter_insights_adaptive(account_id, url, params, label=label, checkpoint=checkpoint)
 
-                # Xử lý phân trang (Pagination)
-                next_page_url = data.get('paging', {}).get('next')
-                url = next_page_url # Nếu next_page_url là None, vòng lặp sẽ dừng
-            
-            except requests.exceptions.RequestException as e:
-                logger.error(f"Lỗi khi lấy Insights cho tài khoản {account_id} (Trang {page_count}): {e}")
-                if e.response is not None:
-                    logger.error(f"Response: {e.response.json()}")
-                break
-            except Exception as e:
-                logger.error(f"Lỗi không xác định: {e}")
-                break
-        return all_insights
+    def _get_ad_level_insights(self, account_id: str, breakdowns: str, start_date: Optional[str] = None, end_date: Optional[str] = None,
+                               date_preset: Optional[str] = None, filtering: Optional[List[Dict[str, Any]]] = None,
+                               label: str = '', ad_count: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        Bản list của _iter_ad_level_insights.
+        """
+        return [r for page in self._iter_ad_level_insights(account_id, breakdowns, start_date, end_date, date_preset, filtering, label, ad_count) for r in page]
+
+    def iter_all_insights_platform(self, account_id: str, start_date: Optional[str] = None, end_date: Optional[str] = None, date_preset: Optional[str] = None,
+                                   ad_count: Optional[int] = None, checkpoint: Optional[Any] = None) -> Iterator[List[Dict[str, Any]]]:
+        """
+        Generator của get_all_insights_platform: yield từng trang insights cấp quảng cáo theo vị trí quảng cáo.
+        """
+        filtering_structure = [
+            {
+                'field': 'ad.effective_status',
+                'operator': 'IN',
+                'value': ['ACTIVE', 'PAUSED', 'ARCHIVED', 'DELETED']
+            }
+        ]
+        yield from self._iter_ad_level_insights(account_id, 'publisher_platform,platform_position', start_date=start_date, end_date=end_date,
+                                                date_preset=date_preset, filtering=filtering_structure, ad_count=ad_count, checkpoint=checkpoint)
+
+    def get_all_insights_platform(self, account_id: str, start_date: Optional[str] = None, end_date: Optional[str] = None, date_preset: Optional[str] = None,
+                                  ad_count: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        Lấy tất cả dữ liệu insights theo từ cấp độ quảng cáo cho theo vị trí quảng cáo
+        """
+        return [r for page in self.iter_all_insights_platform(account_id, start_date, end_date, date_preset, ad_count) for r in page]
+
+    def iter_all_insights_demo(self, account_id: str, start_date: Optional[str] = None, end_date: Optional[str] = None, date_preset: Optional[str] = None,
+                               ad_count: Optional[int] = None, checkpoint: Optional[Any] = None) -> Iterator[List[Dict[str, Any]]]:
+        """
+        Generator của get_all_insights_demo: yield từng trang insights cấp quảng cáo theo nhân khẩu học.
+        """
+        yield from self._iter_ad_level_insights(account_id, 'age,gender', start_date=start_date, end_date=end_date,
+                                                date_preset=date_preset, ad_count=ad_count, checkpoint=checkpoint)
     
-    def get_all_insights_demo(self, account_id: str, start_date: Optional[str] = None, end_date: Optional[str] = None, date_preset: Optional[str] = None) -> List[Dict[str, Any]]:
+    def get_all_insights_demo(self, account_id: str, start_date: Optional[str] = None, end_date: Optional[str] = None, date_preset: Optional[str] = None,
+                              ad_count: Optional[int] = None) -> List[Dict[str, Any]]:
         """
         Lấy tất cả dữ liệu insights theo từ cấp độ quảng cáo cho theo nhân khẩu học.
         """
-        all_insights = []
-        url = f"{self.base_url}/{account_id}/insights"
+        return [r for page in self.iter_all_insights_demo(account_id, start_date, end_date, date_preset, ad_count) for r in page]
 
-        params = {
+    def iter_all_insights_region(self, account_id: str, start_date: Optional[str] = None, end_date: Optional[str] = None, date_preset: Optional[str] = None,
+                                 ad_count: Optional[int] = None, checkpoint: Optional[Any] = None) -> Iterator[List[Dict[str, Any]]]:
+        """
+        Generator của get_all_insights_region: yield từng trang insights cấp quảng cáo theo khu vực (region).
+        """
+        if not (date_preset and date_preset in DATE_PRESET) and not (start_date and end_date):
+            # Thêm fallback để tránh lỗi
+            logger.error("Phải cung cấp date_preset hoặc (start_date, end_date) cho get_all_insights_region.")
+            return
+        yield from self._iter_ad_level_insights(account_id, 'region', start_date=start_date, end_date=end_date,
+                                                date_preset=date_preset, label=' (region)', ad_count=ad_count, checkpoint=checkpoint)
+    
+    def get_all_insights_region(self, account_id: str, start_date: Optional[str] = None, end_date: Optional[str] = None, date_preset: Optional[str] = None,
+                                ad_count: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        Lấy tất cả dữ liệu insights theo từ cấp độ quảng cáo cho theo khu vực (region).
+        """
+        return [r for page in self.iter_all_insights_region(account_id, start_date, end_date, date_preset, ad_count) for r in page]
+
+    def get_dimensions_for_account(self, account_id: str, start_date: Optional[str] = None, end_date: Optional[str] = None, date_preset: Optional[str] = None) -> Dict[str, List[Dict[str, Any]]]:
+        """
+        Lấy chuỗi Campaign -> Adset -> Ad cho một tài khoản.
+        Các bản ghi được gắn sẵn 'account_id' để upsert vào các bảng Dimension.
+        """
+        result = {'campaigns': [], 'adsets': [], 'ads': []}
+
+        campaigns = self.get_campaigns_for_account(account_id=account_id, start_date=start_date, end_date=end_date, date_preset=date_preset)
+        if not campaigns:
+            return result
+        for c in campaigns:
+            c['account_id'] = account_id
+        result['campaigns'] = campaigns
+        campaign_ids = [c['id'] for c in campaigns]
+
+        adsets = self.get_adsets_for_campaigns(account_id=account_id, campaign_id=campaign_ids, start_date=start_date, end_date=end_date, date_preset=date_preset)
+        if not adsets:
+            return result
+        for a in adsets:
+            a['account_id'] = account_id
+        result['adsets'] = adsets
+        adset_ids = [a['id'] for a in adsets]
+
+        ads = self.get_ads_for_adsets(account_id=account_id, adset_id=adset_ids, start_date=start_date, end_date=end_date, date_preset=date_preset)
+        for ad in ads:
+            ad['account_id'] = account_id
+        result['ads'] = ads
+        return result
+
+    def _batch_paginate(self, initial_urls: Dict[Any, str], label: str, failed: Optional[set] = None) -> Dict[Any, List[Dict[str, Any]]]:
+        """
+        Chạy nhiều truy vấn phân trang cùng lúc qua Graph API batch.
+        initial_urls: {key: relative_url trang đầu}. Mỗi vòng gửi trang kế tiếp (paging.next)
+        của mọi key còn dữ liệu trong cùng một batch.
+        Trả về {key: list bản ghi}. Key bị lỗi sẽ có list rỗng/dở dang (đã log lỗi)
+        và được thêm vào set `failed` nếu có truyền vào.
+        """
+        results = {key: [] for key in initial_urls}
+        pending = dict(initial_urls)
+        retries = {}
+        round_count = 0
+
+        while pending:
+            round_count += 1
+            keys = list(pending.keys())
+            sub_requests = [{'method': 'GET', 'relative_url': pending[key]} for key in keys]
+            responses = self.client.batch(self.base_url, sub_requests, self.access_token)
+
+            next_pending = {}
+            for key, response in zip(keys, responses):
+                if response is None:
+                    retries[key] = retries.get(key, 0) + 1
+                    if retries[key] <= GRAPH_BATCH_MAX_RETRIES:
+                        next_pending[key] = pending[key]
+                    else:
+                        logger.error(f"Batch {label} cho {key} không có kết quả sau {GRAPH_BATCH_MAX_RETRIES} lần thử lại.")
+                        if failed is not None:
+                            failed.add(key)
+                    continue
+
+                body = response['body']
+                if response['code'] != 200 or 'error' in body:
+                    logger.error(f"Lỗi batch khi lấy {label} cho {key}: {body.get('error', body)}")
+                    if failed is not None:
+                        failed.add(key)
+                    continue
+
+                data = body.get('data', [])
+                results[key].extend(data)
+                next_url = body.get('paging', {}).get('next')
+                if next_url and data:
+                    next_pending[key] = relative_url(self.base_url, next_url)
+
+            pending = next_pending
+            logger.info(f"Batch {label}: vòng {round_count} xong, còn {len(pending)} truy vấn có trang tiếp theo.")
+
+        return results
+
+    def get_dimensions_batched(self, accounts: List[Dict[str, Any]], start_date: Optional[str] = None, end_date: Optional[str] = None,
+                               date_preset: Optional[str] = None) -> Dict[str, List[Dict[str, Any]]]:
+        """
+        Lấy chuỗi Campaign -> Adset -> Ad cho nhiều tài khoản bằng Graph API batch request.
+        Mỗi tầng (campaigns, adsets, ads) của mọi tài khoản được gộp vào các batch tối đa 50 sub-request,
+        thay vì mỗi tài khoản tự gọi tuần tự từng tầng.
+        Kết quả cùng định dạng với get_dimensions_for_account. Nếu batch lỗi, quay về cách gọi từng tài khoản.
+        """
+        result = {'campaigns': [], 'adsets': [], 'ads': []}
+        account_ids = [account['id'] for account in accounts]
+        if not account_ids:
+            return result
+
+        try:
+            campaign_urls = {
+                account_id: relative_url(self.base_url, f"{account_id}/campaigns", self._campaigns_params(start_date, end_date, date_preset))
+                for account_id in account_ids
+            }
+            campaigns_by_account = self._batch_paginate(campaign_urls, 'Campaigns')
+
+            # Danh sách ID của tầng trên được chia nhóm (IN_FILTER_CHUNK_SIZE) thành nhiều sub-request
+            adset_urls = {}
+            for account_id, campaigns in campaigns_by_account.items():
+                for n, chunk in enumerate(chunked(list(dict.fromkeys(c['id'] for c in campaigns)), IN_FILTER_CHUNK_SIZE)):
+                    params = self._adsets_params(chunk, start_date, end_date, date_preset)
+                    if params:
+                        adset_urls[(account_id, n)] = relative_url(self.base_url, f"{account_id}/adsets", params)
+            adsets_by_account = _group_chunk_results(self._batch_paginate(adset_urls, 'Adsets')) if adset_urls else {}
+
+            ad_urls = {}
+            for account_id, adsets in adsets_by_account.items():
+                for n, chunk in enumerate(chunked([a['id'] for a in adsets], IN_FILTER_CHUNK_SIZE)):
+                    params = self._ads_params(chunk, start_date, end_date, date_preset)
+                    if params:
+                        ad_urls[(account_id, n)] = relative_url(self.base_url, f"{account_id}/ads", params)
+            ads_by_account = _group_chunk_results(self._batch_paginate(ad_urls, 'Ads')) if ad_urls else {}
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Lỗi khi gọi batch Dimension, chuyển sang lấy từng tài khoản: {e}")
+            for account_id in account_ids:
+                dims = self.get_dimensions_for_account(account_id, start_date, end_date, date_preset)
+                for key in result:
+                    result[key].extend(dims[key])
+            return result
+
+        for key, records_by_account in (('campaigns', campaigns_by_account), ('adsets', adsets_by_account), ('ads', ads_by_account)):
+            for account_id, records in records_by_account.items():
+                for record in records:
+                    record['account_id'] = account_id
+                result[key].extend(records)
+
+        logger.info(f"Batch Dimension: {len(result['campaigns'])} campaigns, {len(result['adsets'])} adsets, {len(result['ads'])} ads cho {len(account_ids)} tài khoản.")
+        return result
+
+    def _updated_dimensions_params(self, level: str, updated_since: Optional[int] = None) -> Dict[str, Any]:
+        """
+        Params cho /{account_id}/{level} khi đồng bộ theo updated_time.
+        updated_since: unix timestamp; None = lấy toàn bộ object (full sync).
+        """
+        filtering_structure = [
+            {
+                'field': 'effective_status',
+                'operator': 'IN',
+                'value': ['ACTIVE', 'PAUSED', 'ARCHIVED', 'DELETED']
+            }
+        ]
+        if updated_since:
+            filtering_structure.append({
+                'field': 'updated_time',
+                'operator': 'GREATER_THAN',
+                'value': int(updated_since)
+            })
+        return {
             'access_token': self.access_token,
-            'level': 'ad',
+            'fields': DIMENSION_SYNC_FIELDS[level],
             'limit': 100,
-            'fields': 'campaign_id,campaign_name,adset_id,adset_name,ad_id,ad_name,impressions,clicks,spend,ctr,cpc,cpm,reach,frequency,actions,action_values',
-            'time_increment': 1,  # Lấy dữ liệu nhóm theo hàng ngày
-            'breakdowns': 'age,gender',
+            'filtering': json.dumps(filtering_structure)
         }
 
-        # Chỉ sử dụng date_preset nếu không có time_range.
-        if date_preset and date_preset in DATE_PRESET:
-            params['date_preset'] = date_preset
-            logger.info(f"Lấy tất cả dữ liệu insights cho tài khoản {account_id} với khoảng '{date_preset}'...")
-        elif start_date and end_date:
-            params['time_range'] = json.dumps({'since': start_date, 'until': end_date})
-            logger.info(f"Lấy tất cả dữ liệu insights cho tài khoản {account_id} từ {start_date} đến {end_date}...")
+    def get_updated_dimensions(self, updated_since: Dict[str, Optional[int]]) -> Dict[str, Any]:
+        """
+        Đồng bộ Campaign/Adset/Ad theo updated_time cho nhiều tài khoản.
+        updated_since: {account_id: unix timestamp} - chỉ lấy object có updated_time lớn hơn mốc;
+        None = lấy toàn bộ object của tài khoản (full sync). Không lọc theo khoảng ngày.
+
+        3 tầng được lấy độc lập (không cần danh sách ID của tầng trên) nên gộp chung vào Graph API batch
+        khi GRAPH_BATCH_DIMENSIONS bật.
+        Trả về {'campaigns', 'adsets', 'ads', 'failed_accounts'}; tài khoản trong failed_accounts
+        có dữ liệu không đầy đủ và không nên được tiến mốc updated_time.
+        """
+        levels = ('campaigns', 'adsets', 'ads')
+        result = {level: [] for level in levels}
+        failed = set()
+
+        requests_by_key = {
+            (account_id, level): self._updated_dimensions_params(level, since)
+            for account_id, since in updated_since.items()
+            for level in levels
+        }
+        records_by_key = None
 
-        page_count = 0
-        while url:
+        if GRAPH_BATCH_DIMENSIONS and requests_by_key:
+            urls = {key: relative_url(self.base_url, f"{key[0]}/{key[1]}", params) for key, params in requests_by_key.items()}
             try:
-                page_count += 1
-                response = requests.get(url, params=params if page_count == 1 else {})
-                response.raise_for_status()
-                data = response.json()
-
-                insights_page = data.get('data', [])
-                if not insights_page:
-                    logger.info("Không tìm thấy thêm dữ liệu insights nào.")
-                    break
-                    
-                all_insights.extend(insights_page)
-                logger.info(f"Đã lấy được {len(insights_page)} bản ghi insights (Tổng: {len(all_insights)}).")
-
-                # Xử lý phân trang (Pagination)
-                next_page_url = data.get('paging', {}).get('next')
-                url = next_page_url # Nếu next_page_url là None, vòng lặp sẽ dừng
-            
+                records_by_key = self._batch_paginate(urls, 'Dimension (updated_time)', failed=failed)
             except requests.exceptions.RequestException as e:
-                logger.error(f"Lỗi khi lấy Insights cho tài khoản {account_id} (Trang {page_count}): {e}")
-                if e.response is not None:
-                    logger.error(f"Response: {e.response.json()}")
-                break
-            except Exception as e:
-                logger.error(f"Lỗi không xác định: {e}")
-                break
-        return all_insights
-    
-    def get_all_insights_region(self, account_id: str, start_date: Optional[str] = None, end_date: Optional[str] = None, date_preset: Optional[str] = None) -> List[Dict[str, Any]]:
+                logger.error(f"Lỗi khi gọi batch Dimension (updated_time), chuyển sang lấy tuần tự: {e}")
+                failed = set()
+
+        if records_by_key is None:
+            records_by_key = {}
+            for (account_id, level), params in requests_by_key.items():
+                records = []
+                try:
+                    for data in self.client.iter_pages(f"{self.base_url}/{account_id}/{level}", params):
+                        records.extend(data.get('data', []))
+                except requests.exceptions.RequestException as e:
+                    logger.error(f"Lỗi khi lấy {level} (updated_time) cho tài khoản {account_id}: {e}")
+                    failed.add((account_id, level))
+                records_by_key[(account_id, level)] = records
+
+        for (account_id, level), records in records_by_key.items():
+            for record in records:
+                record['account_id'] = account_id
+            result[level].extend(records)
+
+        result['failed_accounts'] = sorted({account_id for account_id, _ in failed})
+        logger.info(f"Đồng bộ Dimension (updated_time): {len(result['campaigns'])} campaigns, {len(result['adsets'])} adsets, "
+                    f"{len(result['ads'])} ads thay đổi cho {len(updated_since)} tài khoản.")
+        return result
+
+    def get_dimensions_for_accounts(self, accounts: List[Dict[str, Any]], start_date: Optional[str] = None, end_date: Optional[str] = None,
+                                    date_preset: Optional[str] = None, use_batch: Optional[bool] = None,
+                                    max_accounts: Optional[int] = None) -> Dict[str, List[Dict[str, Any]]]:
         """
-        Lấy tất cả dữ liệu insights theo từ cấp độ quảng cáo cho theo khu vực (region).
+        Lấy chuỗi Campaign -> Adset -> Ad cho nhiều tài khoản.
+        - use_batch (mặc định theo GRAPH_BATCH_DIMENSIONS): gộp qua Graph API batch (get_dimensions_batched).
+        - Ngược lại: gọi get_dimensions_for_account song song với tối đa `max_accounts` tài khoản.
         """
-        all_insights = []
-        url = f"{self.base_url}/{account_id}/insights"
+        use_batch = GRAPH_BATCH_DIMENSIONS if use_batch is None else use_batch
+        if use_batch:
+            return self.get_dimensions_batched(accounts, start_date, end_date, date_preset)
+
+        result = {'campaigns': [], 'adsets': [], 'ads': []}
+        with ThreadPoolExecutor(max_workers=max_accounts or MAX_CONCURRENT_ACCOUNTS) as executor:
+            futures = {
+                executor.submit(self.get_dimensions_for_account, account['id'], start_date, end_date, date_preset): account
+                for account in accounts
+            }
+            for future in as_completed(futures):
+                account = futures[future]
+                try:
+                    dims = future.result()
+                except Exception as e:
+                    logger.error(f"Lỗi khi lấy Dimension cho tài khoản {account.get('name')} ({account['id']}): {e}", exc_info=True)
+                    continue
+                for key in result:
+                    result[key].extend(dims[key])
+        return result
+
+    def stream_insights_concurrently(self, accounts: List[Dict[str, Any]], on_page: Callable[[str, str, List[Dict[str, Any]]], None],
+                                     start_date: Optional[str] = None, end_date: Optional[str] = None, date_preset: Optional[str] = None,
+                                     max_accounts: Optional[int] = None, max_per_account: Optional[int] = None,
+                                     checkpoint_factory: Optional[Callable[[str, str], Any]] = None,
+                                     failed_accounts: Optional[List[str]] = None) -> Dict[str, int]:
+        """
+        Lấy Insights (platform, demographic, region) cho nhiều tài khoản song song theo dạng streaming.
+
+        - Tối đa `max_accounts` tài khoản được xử lý cùng lúc; trong mỗi tài khoản 3 breakdown chạy
+          song song với tối đa `max_per_account` tác vụ.
+        - Mỗi trang được giao ngay cho on_page(key, account_id, records) trong thread worker
+          (key: 'insights_platform' | 'insights_demographic' | 'insights_region'), không giữ lại trong bộ nhớ.
+          on_page phải thread-safe.
+        - checkpoint_factory(account_id, key) (tùy chọn) trả về checkpoint cho từng luồng phân trang;
+          checkpoint chỉ được ghi sau khi on_page của trang đó chạy xong.
+        - failed_accounts (tùy chọn): list nhận thêm ID các tài khoản bị lỗi trong quá trình xử lý.
+
+        Trả về số bản ghi đã xử lý theo từng key.
+        """
+        max_accounts = max_accounts or MAX_CONCURRENT_ACCOUNTS
+        max_per_account = max_per_account or MAX_CONCURRENT_PER_ACCOUNT
 
-        params = {
-            'access_token': self.access_token,
-            'level': 'ad',
-            'limit': 100,
-            'fields': 'campaign_id,campaign_name,adset_id,adset_name,ad_id,ad_name,impressions,clicks,spend,ctr,cpc,cpm,reach,frequency,actions,action_values',
-            'time_increment': 1,  # Lấy dữ liệu nhóm theo hàng ngày
-            'breakdowns': 'region',
+        insights_generators = {
+            'insights_platform': self.iter_all_insights_platform,
+            'insights_demographic': self.iter_all_insights_demo,
+            'insights_region': self.iter_all_insights_region,
         }
+        counts = {key: 0 for key in insights_generators}
+        counts_lock = threading.Lock()
+
+        def _consume(account_id: str, key: str):
+            checkpoint = checkpoint_factory(account_id, key) if checkpoint_factory else None
+            record_count = 0
+            for records in insights_generators[key](account_id=account_id, start_date=start_date, end_date=end_date,
+                                                    date_preset=date_preset, checkpoint=checkpoint):
+                on_page(key, account_id, records)
+                record_count += len(records)
+            with counts_lock:
+                counts[key] += record_count
+
+        def _process_account(account_id: str):
+            with ThreadPoolExecutor(max_workers=max_per_account) as account_executor:
+                futures = [account_executor.submit(_consume, account_id, key) for key in insights_generators]
+                for future in as_completed(futures):
+                    future.result()
+
+        with ThreadPoolExecutor(max_workers=max_accounts) as executor:
+            futures = {executor.submit(_process_account, account['id']): account for account in accounts}
+            for future in as_completed(futures):
+                account = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.error(f"Lỗi khi trích xuất dữ liệu cho tài khoản {account.get('name')} ({account['id']}): {e}", exc_info=True)
+                    if failed_accounts is not None:
+                        failed_accounts.append(account['id'])
+                    continue
+                logger.info(f"--- Hoàn tất trích xuất cho tài khoản: {account.get('name')} ({account['id']}) ---")
+
+        return counts
+
+    def extract_accounts_concurrently(self, accounts: List[Dict[str, Any]], start_date: Optional[str] = None, end_date: Optional[str] = None,
+                                      date_preset: Optional[str] = None, max_accounts: Optional[int] = None,
+                                      max_per_account: Optional[int] = None, use_batch: Optional[bool] = None) -> Dict[str, List[Dict[str, Any]]]:
+        """
+        Trích xuất Dimension và Insights (platform, demographic, region) cho nhiều tài khoản song song.
 
-        # Chỉ sử dụng date_preset nếu không có time_range.
-        if date_preset and date_preset in DATE_PRESET:
-            params['date_preset'] = date_preset
-            logger.info(f"Lấy tất cả dữ liệu insights (region) cho tài khoản {account_id} với khoảng '{date_preset}'...")
-        elif start_date and end_date:
-            params['time_range'] = json.dumps({'since': start_date, 'until': end_date})
-            logger.info(f"Lấy tất cả dữ liệu insights (region) cho tài khoản {account_id} từ {start_date} đến {end_date}...")
-        else:
-            # Thêm fallback để tránh lỗi
-            logger.error("Phải cung cấp date_preset hoặc (start_date, end_date) cho get_all_insights_region.")
-            return all_insights
+        - Dimension của mọi tài khoản (get_dimensions_for_accounts) chạy song song với Insights.
+        - Insights dùng stream_insights_concurrently và gom các trang lại thành list.
+        - Tổng số request HTTP đồng thời luôn bị chặn bởi GraphClient (EXTRACT_MAX_CONCURRENCY).
 
-        page_count = 0
-        while url:
-            try:
-                page_count += 1
-                response = requests.get(url, params=params if page_count == 1 else {})
-                response.raise_for_status()
-                data = response.json()
+        Trả về dict gồm các list cùng định dạng với các hàm get_* tuần tự, để các hàm
+        upsert hiện có dùng lại được.
+        """
+        combined = {
+            'campaigns': [],
+            'adsets': [],
+            'ads': [],
+            'insights_platform': [],
+            'insights_demographic': [],
+            'insights_region': [],
+        }
+        combined_lock = threading.Lock()
 
-                insights_page = data.get('data', [])
-                if not insights_page:
-                    logger.info("Không tìm thấy thêm dữ liệu insights (region) nào.")
-                    break
-                    
-                all_insights.extend(insights_page)
-                logger.info(f"Đã lấy được {len(insights_page)} bản ghi insights (region) (Tổng: {len(all_insights)}).")
+        def _collect(key: str, account_id: str, records: List[Dict[str, Any]]):
+            with combined_lock:
+                combined[key].extend(records)
 
-                # Xử lý phân trang (Pagination)
-                next_page_url = data.get('paging', {}).get('next')
-                url = next_page_url # Nếu next_page_url là None, vòng lặp sẽ dừng
-            
-            except requests.exceptions.RequestException as e:
-                logger.error(f"Lỗi khi lấy Insights (region) cho tài khoản {account_id} (Trang {page_count}): {e}")
-                if e.response is not None:
-                    logger.error(f"Response: {e.response.json()}")
-                break
+        with ThreadPoolExecutor(max_workers=1) as dims_executor:
+            dims_future = dims_executor.submit(self.get_dimensions_for_accounts, accounts, start_date, end_date, date_preset, use_batch, max_accounts)
+            self.stream_insights_concurrently(accounts, _collect, start_date=start_date, end_date=end_date, date_preset=date_preset,
+                                              max_accounts=max_accounts, max_per_account=max_per_account)
+            try:
+                dims = dims_future.result()
+                for key, records in dims.items():
+                    combined[key].extend(records)
             except Exception as e:
-                logger.error(f"Lỗi không xác định: {e}")
-                break
-        return all_insights
-    
+                logger.error(f"Lỗi khi trích xuất Dimension: {e}", exc_info=True)
+
+        return combined
+
     def get_total_metric(self, account_id: str, metric_name: str, 
                          campaign_ids: Optional[List[str]] = None, 
                          adset_ids: Optional[List[str]] = None, 
@@ -794,12 +1444,9 @@ class FacebookAdsExtractor:
             return insights_data # Trả về list rỗng
 
         page_count = 0
-        while url:
-            try:
+        try:
+            for data in self.client.iter_pages(url, params):
                 page_count += 1
-                response = requests.get(url, params=params if page_count == 1 else {})
-                response.raise_for_status()
-                data = response.json()
 
                 insights_page = data.get('data', [])
                 if not insights_page:
@@ -808,19 +1455,12 @@ class FacebookAdsExtractor:
                     
                 insights_data.extend(insights_page)
                 logger.info(f"Đã lấy được {len(insights_page)} bản ghi metric (Tổng: {len(insights_data)}).")
-
-                # Xử lý phân trang (Pagination)
-                next_page_url = data.get('paging', {}).get('next')
-                url = next_page_url # Nếu next_page_url là None, vòng lặp sẽ dừng
-            
-            except requests.exceptions.RequestException as e:
-                logger.error(f"Lỗi khi lấy metric '{metric_name}' (Trang {page_count}): {e}")
-                if e.response is not None:
-                    logger.error(f"Response: {e.response.json()}")
-                break
-            except Exception as e:
-                logger.error(f"Lỗi không xác định: {e}")
-                break
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Lỗi khi lấy metric '{metric_name}' (Trang {page_count + 1}): {e}")
+            if e.response is not None:
+                logger.error(f"Response: {e.response.json()}")
+        except Exception as e:
+            logger.error(f"Lỗi không xác định: {e}")
                 
         return insights_data
 
@@ -844,13 +1484,10 @@ class FacebookAdsExtractor:
         }
         
         page_count = 0
-        while url:
-            try:
+        try:
+            # Params chỉ được gửi ở lần gọi đầu tiên (iter_pages tự xử lý phân trang)
+            for data in self.client.iter_pages(url, params):
                 page_count += 1
-                # Chỉ sử dụng params cho lần gọi đầu tiên
-                response = requests.get(url, params=params if page_count == 1 else {})
-                response.raise_for_status()
-                data = response.json()
 
                 pages_page = data.get('data', [])
                 if not pages_page:
@@ -859,32 +1496,27 @@ class FacebookAdsExtractor:
                     
                 all_pages.extend(pages_page)
                 logger.info(f"Đã lấy được {len(pages_page)} Fanpage (Tổng: {len(all_pages)}).")
-
-                # Xử lý phân trang (Pagination) y hệt logic cũ
-                paging_data = data.get('paging', {})
-                if paging_data:
-                    url = paging_data.get('next') # Nếu next_page_url là None, vòng lặp sẽ dừng
-                else:
-                    url = None # Dừng nếu không có key 'paging'
-            
-            except requests.exceptions.RequestException as e:
-                logger.error(f"Lỗi khi lấy Fanpages (Trang {page_count}): {e}")
-                if e.response is not None:
-                    logger.error(f"Response: {e.response.json()}")
-                break
-            except Exception as e:
-                logger.error(f"Lỗi không xác định: {e}")
-                break
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Lỗi khi lấy Fanpages (Trang {page_count + 1}): {e}")
+            if e.response is not None:
+                logger.error(f"Response: {e.response.json()}")
+        except Exception as e:
+            logger.error(f"Lỗi không xác định: {e}")
                 
         logger.info(f"Hoàn tất! Lấy được tổng cộng {len(all_pages)} Fanpage.")
         return all_pages
     
     def get_page_metrics_by_day(self, page_id: str, page_access_token: str, 
                                   start_date: Optional[str] = None, end_date: Optional[str] = None,
-                                  metrics_list: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+                                  metrics_list: Optional[List[str]] = None,
+                                  max_windows: Optional[int] = None) -> List[Dict[str, Any]]:
         """
         Lấy TỔNG HỢP metrics cho Fanpage, trả về một danh sách "phẳng" (flat list)
         nhóm theo NGÀY, phù hợp để load vào database. Backend JS sẽ xử lý date_preset và input vào sau
+
+        Khoảng ngày dài được chia thành các cửa sổ tối đa PAGE_INSIGHTS_MAX_WINDOW_DAYS ngày
+        (Page Insights API giới hạn khoảng since/until); các cửa sổ chạy song song và được gộp
+        vào cùng một pivot theo ngày.
         
         Args:
             page_id (str): ID của Fanpage.
@@ -892,6 +1524,7 @@ class FacebookAdsExtractor:
             start_date (str): Ngày bắt đầu (YYYY-MM-DD).
             end_date (str): Ngày kết thúc (YYYY-MM-DD).
             metrics_list (Optional[List[str]]): Danh sách metric.
+            max_windows (Optional[int]): Số cửa sổ chạy song song (mặc định PAGE_METRICS_WINDOW_CONCURRENCY).
         """
         final_daily_list = []
         # 1. Xử lý input ngày tháng
@@ -915,42 +1548,80 @@ class FacebookAdsExtractor:
                 'page_posts_impressions_organic_unique'
             ]
         metrics_str = ",".join(metrics_list)
-        
-        # 3. Xây dựng URL và params ban đầu
+
+        # 3. Chia khoảng ngày thành các cửa sổ.
+        #    end_time của giá trị ngày rơi vào (since, until], nên các cửa sổ sau cửa sổ đầu
+        #    lùi 'since' một ngày để không bỏ sót ngày giáp ranh (trùng ngày sẽ được gộp trong pivot).
+        windows = []
+        for window_start, window_end in split_date_range(start_date, end_date, PAGE_INSIGHTS_MAX_WINDOW_DAYS):
+            since = window_start
+            if window_start != start_date:
+                since = (datetime.strptime(window_start, '%Y-%m-%d').date() - timedelta(days=1)).isoformat()
+            windows.append((since, window_end))
+
+        # 4. Dictionary để "pivot" dữ liệu theo ngày
+        #    Key là ngày (VD: '2025-10-01'), 
+        #    Value là một dict chứa tất cả metric của ngày đó
+        daily_data_pivot = {}
+        pivot_lock = threading.Lock()
+
+        def _merge(window_pivot: Dict[str, Dict[str, Any]]):
+            with pivot_lock:
+                for date_key, row in window_pivot.items():
+                    daily_data_pivot.setdefault(date_key, {}).update(row)
+
+        def _fetch_window(since: str, until: str):
+            _merge(self._get_page_metrics_window(page_id, page_access_token, metrics_str, since, until,
+                                                 start_date_obj, end_date_obj))
+
+        if len(windows) == 1:
+            _fetch_window(*windows[0])
+        else:
+            logger.info(f"Chia Page Metrics của Page {page_id} thành {len(windows)} cửa sổ ngày.")
+            with ThreadPoolExecutor(max_workers=max_windows or PAGE_METRICS_WINDOW_CONCURRENCY) as executor:
+                futures = [executor.submit(_fetch_window, since, until) for since, until in windows]
+                for future in as_completed(futures):
+                    # Lỗi Token (190) được ném lại cho bên gọi
+                    future.result()
+
+        # 5. Trả về kết quả
+        # Chuyển đổi dict pivot (keyed by date) thành một danh sách các "dòng", sắp theo ngày
+        final_daily_list = [daily_data_pivot[date_key] for date_key in sorted(daily_data_pivot)]
+        logger.info(f"Tổng hợp hoàn tất. Trả về {len(final_daily_list)} bản ghi (ngày).")
+        return final_daily_list
+
+    def _get_page_metrics_window(self, page_id: str, page_access_token: str, metrics_str: str,
+                                 since: str, until: str, start_date_obj, end_date_obj) -> Dict[str, Dict[str, Any]]:
+        """
+        Lấy Page Insights cho một cửa sổ since/until và pivot theo ngày.
+        Chỉ giữ các ngày nằm trong khoảng yêu cầu gốc (start_date_obj - end_date_obj).
+        Lỗi Token (190) được ném lại; các lỗi request khác chỉ được log.
+        """
         url = f"{self.base_url}/{page_id}/insights"
         
         params = {
             'access_token': page_access_token,
             'metric': metrics_str,
             'period': 'day',
-            'since': start_date,
-            'until': end_date,
+            'since': since,
+            'until': until,
             'debug': 'all',
             'limit': 100 # Yêu cầu tối đa 100 ngày mỗi lần
         }
         
-        # 4. Dictionary để "pivot" dữ liệu theo ngày
-        #    Key là ngày (VD: '2025-10-01'), 
-        #    Value là một dict chứa tất cả metric của ngày đó
         daily_data_pivot = {}
         
         page_count = 0
         keep_looping = True # Cờ để dừng vòng lặp ngoài
 
-        while url and keep_looping:
-            try:
+        try:
+            for data in self.client.iter_pages(url, params):
                 page_count += 1
-                current_params = params if page_count == 1 else {}
-                
-                response = requests.get(url, params=current_params)
-                response.raise_for_status()
-                
-                data = response.json()
                 metrics_page = data.get('data', [])
 
                 if not metrics_page:
                     logger.info("Không tìm thấy thêm dữ liệu metrics nào.")
-                    break # Dừng vòng lặp while
+                    break # Dừng vòng lặp phân trang
 
                 # Lặp qua các metric (VD: page_impressions, page_fans...)
                 for metric in metrics_page:
@@ -999,52 +1670,42 @@ class FacebookAdsExtractor:
                     if not keep_looping:
                         break # Dừng vòng lặp 'for metric...'
 
-                # 8. Lấy URL trang tiếp theo (Giữ nguyên)
-                if keep_looping: 
-                    paging_data = data.get('paging', {})
-                    url = paging_data.get('next')
-                    if not url:
-                        logger.info("Hoàn tất phân trang (không còn 'next').")
-                        break
-                else:
+                # 8. Dừng phân trang nếu đã vượt khoảng (iter_pages tự lấy trang tiếp theo)
+                if not keep_looping:
                     logger.info("Dừng phân trang do phát hiện ngày nằm ngoài khoảng.")
-                    url = None
-
-            except requests.exceptions.RequestException as e:
-                is_token_error = False
-                if e.response is not None:
-                    try:
-                        error_data = e.response.json().get('error', {})
-                        if error_data.get('code') == 190: # 190 is OAuthException
-                            is_token_error = True
-                    except requests.exceptions.JSONDecodeError:
-                        pass # Không phải lỗi JSON
-                
-                if is_token_error:
-                    logger.warning(f"Phát hiện lỗi Token (190) cho Page {page_id} (trong get_page_metrics_by_day).")
-                    raise e # Ném lại lỗi để (database_manager) bắt
-                
-                # Lỗi request khác (ví dụ: 500, 404), chỉ log và break
-                logger.error(f"Lỗi khi lấy Page Metrics (Trang {page_count}) cho Page {page_id}: {e}")
-                if e.response is not None:
-                    logger.error(f"Response: {e.response.json()}")
-                break # Break the `while` loop
+                    break
+            else:
+                logger.info("Hoàn tất phân trang (không còn 'next').")
+        except requests.exceptions.RequestException as e:
+            is_token_error = False
+            if e.response is not None:
+                try:
+                    error_data = e.response.json().get('error', {})
+                    if error_data.get('code') == 190: # 190 is OAuthException
+                        is_token_error = True
+                except requests.exceptions.JSONDecodeError:
+                    pass # Không phải lỗi JSON
             
-            except Exception as e:
-                logger.error(f"Lỗi không xác định: {e}")
-                break
+            if is_token_error:
+                logger.warning(f"Phát hiện lỗi Token (190) cho Page {page_id} (trong get_page_metrics_by_day).")
+                raise e # Ném lại lỗi để (database_manager) bắt
+            
+            # Lỗi request khác (ví dụ: 500, 404), chỉ log và dừng
+            logger.error(f"Lỗi khi lấy Page Metrics (Trang {page_count + 1}) cho Page {page_id}: {e}")
+            if e.response is not None:
+                logger.error(f"Response: {e.response.json()}")
+        
+        except Exception as e:
+            logger.error(f"Lỗi không xác định: {e}")
 
-        # --- THAY ĐỔI LOGIC: Bước 9 ---
-        # 9. Trả về kết quả
-        # Chuyển đổi dict pivot (keyed by date) thành một danh sách các "dòng"
-        final_daily_list = list(daily_data_pivot.values())
-        logger.info(f"Tổng hợp hoàn tất. Trả về {len(final_daily_list)} bản ghi (ngày).")
-        return final_daily_list
+        return daily_data_pivot
         
     def get_posts_with_lifetime_insights(self, page_id: str, page_access_token: str,
                                          start_date: str, end_date: str,
                                          metrics_list: Optional[List[str]] = None,
-                                         skip_media: bool = False) -> List[Dict[str, Any]]:
+                                         skip_media: bool = False,
+                                         media_pipeline: Optional[MediaMirrorPipeline] = None,
+                                         refresh_tier: Optional[Callable[[str, Optional[str]], Optional[int]]] = None) -> List[Dict[str, Any]]:
         """
         Lấy các bài post được TẠO trong khoảng
         start_date và end_date. Lấy media, shares, comment_count, và metrics LIFETIME. Backend JS sẽ xử lý date_preset và input vào sau.
@@ -1056,25 +1717,27 @@ class FacebookAdsExtractor:
             end_date (str): Ngày kết thúc (YYYY-MM-DD).
             metrics_list (Optional[List[str]]): Danh sách metric. Nếu None, dùng mặc định.
             skip_media (bool): Nếu True, sẽ không upload ảnh lên R2 (để chạy nhanh/tiết kiệm).
+            media_pipeline (Optional[MediaMirrorPipeline]): Nếu có, ảnh được giao cho pipeline mirror chạy nền
+                (full_picture_url = None, URL R2 được cập nhật sau); nếu không, upload ngay trong vòng lặp.
+            refresh_tier (Optional[Callable]): refresh_tier(post_id, created_time) trả về tier làm mới của post,
+                hoặc None nếu post chưa đến hạn làm mới. Nếu có, danh sách post được lấy KHÔNG kèm insights,
+                post chưa đến hạn bị bỏ qua, và metrics lifetime của các post còn lại được lấy theo lô cho từng tier
+                (get_post_lifetime_metrics).
         """
         all_posts_data = []
         
         # 1. Xử lý metric (nếu không nhập, dùng mặc định của bạn)
         if not metrics_list:
-            metrics_list = [
-                'post_reactions_like_total',
-                'post_impressions_unique',
-                'post_clicks',
-                'post_impressions_organic_unique'
-            ]
-        metrics_str = ",".join(metrics_list)
+            metrics_list = DEFAULT_POST_METRICS
         
         # 2. Xây dựng chuỗi fields
-        base_fields = 'id,message,created_time,full_picture,shares,properties'
-        insights_field = f'insights.metric({metrics_str})'
-        comments_field = 'comments.summary(total_count)'
-        
-        fields_query = f"{base_fields},{insights_field},{comments_field}"
+        base_fields = 'id,message,created_time,full_picture,properties'
+        if refresh_tier is None:
+            fields_query = f"{base_fields},{self._post_lifetime_fields(metrics_list)}"
+        else:
+            # Metrics lifetime được lấy riêng, chỉ cho các post đến hạn làm mới
+            fields_query = base_fields
+        due_ids_by_tier = {}
         
         # 3. Xây dựng endpoint và params
         url = f"{self.base_url}/{page_id}/posts"
@@ -1099,20 +1762,28 @@ class FacebookAdsExtractor:
         
         page_count = 0
         
-        while url:
-            try:
+        try:
+            for data in self.client.iter_pages(url, params):
                 page_count += 1
-                response = requests.get(url, params=params if page_count == 1 else {})
-                response.raise_for_status()
-                data = response.json()
 
                 posts_page = data.get('data', [])
                 if not posts_page:
                     logger.info("Không tìm thấy thêm bài đăng nào trong khoảng này.")
                     break
+
+                if self.raw_archive is not None:
+                    try:
+                        self.raw_archive.write_posts(page_id, posts_page)
+                    except Exception as e:
+                        logger.warning(f"Lỗi khi lưu archive posts của page {page_id}: {e}")
                 
                 # 4. Xử lý (Parsing) dữ liệu chi tiết
                 for post in posts_page:
+                    if refresh_tier is not None:
+                        tier = refresh_tier(post.get('id'), post.get('created_time'))
+                        if tier is None:
+                            continue # Chưa đến hạn làm mới, giữ nguyên dữ liệu trong CSDL
+                        due_ids_by_tier.setdefault(tier, []).append(post.get('id'))
                     properties_text = None
                     properties_list = post.get('properties', []) # Đây là một list
                     if properties_list and isinstance(properties_list, list) and len(properties_list) > 0:
@@ -1121,87 +1792,256 @@ class FacebookAdsExtractor:
                     post_id = post.get('id')
                     original_url = post.get('full_picture')
                     final_picture_url = original_url
+                    picture_variants = None
                     if skip_media:
                         # Nếu skip, gán là None để Database Manager biết đường giữ lại ảnh cũ
                         final_picture_url = None 
+                    elif media_pipeline is not None:
+                        # Mirror chạy nền, không chờ tải/upload ảnh
+                        media_pipeline.submit(post_id, original_url)
+                        final_picture_url = None
                     elif original_url:
                         # Logic cũ: Gọi hàm upload sang R2
-                        final_picture_url = self.storage_manager.process_and_upload_image(
+                        mirrored = self.storage_manager.mirror_post_image(
                             original_url, 
                             post_id
                         )
+                        final_picture_url = mirrored['full_picture_url']
+                        picture_variants = mirrored['picture_variants']
                     post_data = {
                         'post_id': post.get('id'),
                         'message': post.get('message', 'Không có nội dung text'),
                         'created_time': post.get('created_time'),
                         'full_picture_url': final_picture_url,
-                        'shares_count': post.get('shares', {}).get('count', 0),
+                        'picture_variants': picture_variants,
                         'properties': properties_text,
                         'fetch_range': f"{start_date}_to_{end_date}"
                     }
                     
-                    # Lấy tổng số comment
-                    post_data['comments_total_count'] = post.get('comments', {}).get('summary', {}).get('total_count', 0)
-                    
-                    # Lấy dữ liệu insights (chỉ quan tâm lifetime)
-                    insights_data = post.get('insights', {}).get('data', [])
-                    
-                    for metric in insights_data:
-                        metric_name = metric.get('name')
-                        metric_period = metric.get('period')
-                        
-                        # Chỉ lấy metric 'lifetime' như bạn yêu cầu
-                        if metric_period == 'lifetime' and metric_name in metrics_list:
-                            metric_value = metric.get('values', [{}])[0].get('value', 0)
-                            if metric_name == 'post_impressions_unique':
-                                # API trả về 'post_impressions_unique'
-                                # nhưng ta lưu là 'post_impressions' để CSDL không bị ảnh hưởng
-                                post_data['post_impressions'] = metric_value
-                            elif metric_name in metrics_list:
-                                # Các metric khác (post_clicks, post_reactions_like_total)
-                                post_data[metric_name] = metric_value
-                    
-                    # Gán giá trị 0 cho các metric không tìm thấy (để đảm bảo cột)
-                    for m in metrics_list:
-                        if m not in post_data:
-                            post_data[m] = 0
+                    if refresh_tier is None:
+                        post_data.update(self._parse_post_lifetime_metrics(post, metrics_list))
                             
                     all_posts_data.append(post_data)
 
                 logger.info(f"Đã lấy được {len(posts_page)} bài đăng (Tổng: {len(all_posts_data)}).")
+        except requests.exceptions.RequestException as e:
+            is_token_error = False
+            if e.response is not None:
+                try:
+                    error_data = e.response.json().get('error', {})
+                    if error_data.get('code') == 190: # 190 is OAuthException
+                        is_token_error = True
+                except requests.exceptions.JSONDecodeError:
+                    pass # Không phải lỗi JSON
+
+            if is_token_error:
+                logger.warning(f"Phát hiện lỗi Token (190) cho Page {page_id} (trong get_posts_with_lifetime_insights).")
+                raise e # Ném lại lỗi để (database_manager) bắt
+
+            # Lỗi request khác (ví dụ: 500, 404), chỉ log và dừng
+            logger.error(f"Lỗi khi lấy Posts (Trang {page_count + 1}) cho Page {page_id}: {e}")
+            if e.response is not None:
+                logger.error(f"Response: {e.response.json()}")
+        except Exception as e:
+            logger.error(f"Lỗi không xác định: {e}")
+                
+        if due_ids_by_tier:
+            # 5. Lấy metrics lifetime theo lô cho từng tier rồi gộp vào từng post
+            metrics_by_post = {}
+            for tier, post_ids in sorted(due_ids_by_tier.items()):
+                for record in self.get_post_lifetime_metrics(post_ids, page_access_token, metrics_list):
+                    metrics_by_post[record['post_id']] = record
+            posts_with_metrics = []
+            for post_data in all_posts_data:
+                metrics = metrics_by_post.get(post_data['post_id'])
+                if metrics is None:
+                    continue # Không lấy được metrics: bỏ qua để không ghi đè bằng 0
+                post_data.update(metrics)
+                posts_with_metrics.append(post_data)
+            all_posts_data = posts_with_metrics
+                
+        logger.info(f"Hoàn tất! Lấy được tổng cộng {len(all_posts_data)} bài đăng.")
+        return all_posts_data
 
-                # 5. Xử lý phân trang (Pagination)
-                paging_data = data.get('paging', {})
-                if paging_data:
-                    url = paging_data.get('next')
-                else:
-                    url = None
+    @staticmethod
+    def _post_lifetime_fields(metrics_list: List[str]) -> str:
+        """Fields cho các chỉ số lifetime của post (shares, comments, insights)."""
+        return f"shares,insights.metric({','.join(metrics_list)}),comments.summary(total_count)"
+
+    @staticmethod
+    def _parse_post_lifetime_metrics(post: Dict[str, Any], metrics_list: List[str]) -> Dict[str, Any]:
+        """
+        Bóc tách shares, tổng comment và các metric LIFETIME của một post.
+        """
+        post_data = {
+            'shares_count': post.get('shares', {}).get('count', 0),
+            # Lấy tổng số comment
+            'comments_total_count': post.get('comments', {}).get('summary', {}).get('total_count', 0),
+        }
+        
+        # Lấy dữ liệu insights (chỉ quan tâm lifetime)
+        insights_data = post.get('insights', {}).get('data', [])
+        
+        for metric in insights_data:
+            metric_name = metric.get('name')
+            metric_period = metric.get('period')
             
+            # Chỉ lấy metric 'lifetime' như bạn yêu cầu
+            if metric_period == 'lifetime' and metric_name in metrics_list:
+                metric_value = metric.get('values', [{}])[0].get('value', 0)
+                if metric_name == 'post_impressions_unique':
+                    # API trả về 'post_impressions_unique'
+                    # nhưng ta lưu là 'post_impressions' để CSDL không bị ảnh hưởng
+                    post_data['post_impressions'] = metric_value
+                elif metric_name in metrics_list:
+                    # Các metric khác (post_clicks, post_reactions_like_total)
+                    post_data[metric_name] = metric_value
+        
+        # Gán giá trị 0 cho các metric không tìm thấy (để đảm bảo cột)
+        for m in metrics_list:
+            if m not in post_data:
+                post_data[m] = 0
+        return post_data
+
+    def get_post_lifetime_metrics(self, post_ids: List[str], page_access_token: str,
+                                  metrics_list: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        """
+        Lấy metrics LIFETIME (shares, comments, insights) cho danh sách post theo lô:
+        mỗi request lấy tối đa POST_METRICS_BATCH_SIZE post qua `?ids=...`.
+        Lỗi Token (190) được ném lại; các lỗi request khác chỉ được log (lô đó bị bỏ qua).
+
+        Trả về list {'post_id', 'shares_count', 'comments_total_count', <metric>...}.
+        """
+        if not metrics_list:
+            metrics_list = DEFAULT_POST_METRICS
+        fields = self._post_lifetime_fields(metrics_list)
+
+        results = []
+        for chunk in chunked(post_ids, POST_METRICS_BATCH_SIZE):
+            params = {
+                'access_token': page_access_token,
+                'ids': ','.join(chunk),
+                'fields': fields,
+            }
+            try:
+                data = self.client.get_json(f"{self.base_url}/", params=params)
             except requests.exceptions.RequestException as e:
-                is_token_error = False
-                if e.response is not None:
-                    try:
-                        error_data = e.response.json().get('error', {})
-                        if error_data.get('code') == 190: # 190 is OAuthException
-                            is_token_error = True
-                    except requests.exceptions.JSONDecodeError:
-                        pass # Không phải lỗi JSON
-
-                if is_token_error:
-                    logger.warning(f"Phát hiện lỗi Token (190) cho Page {page_id} (trong get_posts_with_lifetime_insights).")
-                    raise e # Ném lại lỗi để (database_manager) bắt
-
-                # Lỗi request khác (ví dụ: 500, 404), chỉ log và break
-                logger.error(f"Lỗi khi lấy Posts (Trang {page_count}) cho Page {page_id}: {e}")
-                if e.response is not None:
-                    logger.error(f"Response: {e.response.json()}")
-                break # Break the `while` loop
+                if is_token_error(e):
+                    raise
+                logger.error(f"Lỗi khi lấy metrics lifetime cho {len(chunk)} post: {e}")
+                continue
+            for post_id, post in data.items():
+                record = self._parse_post_lifetime_metrics(post, metrics_list)
+                record['post_id'] = post_id
+                results.append(record)
+        logger.info(f"Đã lấy metrics lifetime cho {len(results)}/{len(post_ids)} post.")
+        return results
+
+    def extract_fanpages_concurrently(self, fanpages: List[Dict[str, Any]], start_date: str, end_date: str,
+                                      skip_media: bool = False, max_pages: Optional[int] = None,
+                                      failed_pages: Optional[List[str]] = None,
+                                      media_pipeline: Optional[MediaMirrorPipeline] = None,
+                                      post_refresh_tier: Optional[Callable[[str, Optional[str]], Optional[int]]] = None,
+                                      due_post_ids: Optional[Dict[str, Dict[int, List[str]]]] = None) -> Dict[str, List[Dict[str, Any]]]:
+        """
+        Trích xuất Page Metrics (theo ngày) và Post Metrics (lifetime) cho nhiều Fanpage song song.
+
+        - Tối đa `max_pages` Fanpage được xử lý cùng lúc; trong mỗi Fanpage, Page Metrics được chia
+          thành các cửa sổ ngày chạy song song (xem get_page_metrics_by_day).
+        - Kết quả được gộp (thread-safe) thành các list phẳng cùng định dạng với các hàm tuần tự,
+          để upsert_page_metrics_daily / upsert_post_performance dùng lại được.
+        - failed_pages (tùy chọn): list nhận thêm ID các Fanpage bị lỗi (VD: lỗi Token 190).
+        - media_pipeline (tùy chọn): ảnh post được mirror nền qua pipeline này thay vì upload ngay.
+        - post_refresh_tier (tùy chọn): chính sách làm mới theo tier cho các post trong khoảng ngày
+          (xem get_posts_with_lifetime_insights).
+        - due_post_ids (tùy chọn): {page_id: {tier: [post_id]}} các post NGOÀI khoảng ngày đã đến hạn làm mới;
+          metrics lifetime của chúng được lấy theo lô cho từng tier.
+
+        Trả về dict {'page_metrics': [...], 'post_metrics': [...], 'post_lifetime_metrics': [...]}
+        ('post_lifetime_metrics' chỉ gồm post_id và các chỉ số lifetime).
+        """
+        combined = {
+            'page_metrics': [],
+            'post_metrics': [],
+            'post_lifetime_metrics': [],
+        }
+        combined_lock = threading.Lock()
+
+        token_manager = get_page_token_manager()
+        token_manager.update_from_pages(fanpages)
+
+        def _extract_page(page_id: str, page_token: str):
+            logger.info(f"Lấy Page Metrics (daily) cho Page {page_id} từ {start_date} đến {end_date}...")
+            page_metrics = self.get_page_metrics_by_day(
+                page_id=page_id,
+                page_access_token=page_token,
+                start_date=start_date,
+                end_date=end_date
+            )
+
+            logger.info(f"Lấy Post Metrics (lifetime) cho Page {page_id}, các post tạo từ {start_date} đến {end_date}...")
+            post_metrics = self.get_posts_with_lifetime_insights(
+                page_id=page_id,
+                page_access_token=page_token,
+                start_date=start_date,
+                end_date=end_date,
+                metrics_list=None, # Dùng default metrics
+                skip_media=skip_media,
+                media_pipeline=media_pipeline,
+                refresh_tier=post_refresh_tier
+            )
+            # Thêm page_id vào mỗi record post để load vào DB
+            for post in post_metrics:
+                post['page_id'] = page_id
+
+            # Các post cũ hơn khoảng ngày nhưng đã đến hạn làm mới
+            lifetime_metrics = []
+            for tier, post_ids in sorted(((due_post_ids or {}).get(page_id) or {}).items()):
+                logger.info(f"Làm mới metrics lifetime cho {len(post_ids)} post (tier {tier}) của Page {page_id}...")
+                lifetime_metrics.extend(self.get_post_lifetime_metrics(post_ids, page_token))
+
+            with combined_lock:
+                combined['page_metrics'].extend(page_metrics)
+                combined['post_metrics'].extend(post_metrics)
+                combined['post_lifetime_metrics'].extend(lifetime_metrics)
+
+        def _process_page(page: Dict[str, Any]):
+            page_id = page.get('id')
+            page_token = page.get('access_token')
+            try:
+                _extract_page(page_id, page_token)
             except Exception as e:
-                logger.error(f"Lỗi không xác định: {e}")
-                break
-                
-        logger.info(f"Hoàn tất! Lấy được tổng cộng {len(all_posts_data)} bài đăng.")
-        return all_posts_data
+                if not is_token_error(e):
+                    raise
+                # Lỗi Token (190): chỉ lấy lại token của page này rồi thử lại một lần
+                token_manager.invalidate(page_id, page_token)
+                new_token = token_manager.get_token(page_id)
+                if not new_token or new_token == page_token:
+                    raise
+                logger.warning(f"Thử lại Fanpage {page_id} với Page Token mới.")
+                _extract_page(page_id, new_token)
+
+        pages_with_token = []
+        for page in fanpages:
+            if not page.get('access_token'):
+                logger.warning(f"Bỏ qua Page {page.get('name')} ({page.get('id')}) vì không có Page Access Token.")
+                continue
+            pages_with_token.append(page)
+
+        with ThreadPoolExecutor(max_workers=max_pages or MAX_CONCURRENT_PAGES) as executor:
+            futures = {executor.submit(_process_page, page): page for page in pages_with_token}
+            for future in as_completed(futures):
+                page = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.error(f"Lỗi khi trích xuất dữ liệu cho Fanpage {page.get('name')} ({page.get('id')}): {e}", exc_info=True)
+                    if failed_pages is not None:
+                        failed_pages.append(page.get('id'))
+                    continue
+                logger.info(f"--- Hoàn tất trích xuất cho Fanpage: {page.get('name')} ({page.get('id')}) ---")
+
+        return combined
 
 def main():
     try:
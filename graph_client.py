@@ -0,0 +1,523 @@
+import os
+import re
+import json
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Any, Iterator, Optional
+from urllib.parse import urlparse, urlencode
+import orjson
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+# Số kết nối keep-alive tối đa được giữ trong pool (dùng chung cho mọi thread)
+GRAPH_POOL_SIZE = int(os.getenv("GRAPH_POOL_SIZE", 16))
+# Trần số request HTTP chạy đồng thời qua client (mức thực tế do UsageThrottle tự điều chỉnh)
+GRAPH_MAX_CONCURRENCY = int(os.getenv("EXTRACT_MAX_CONCURRENCY", 16))
+# Số lần thử lại khi Graph API trả về lỗi giới hạn (rate limit)
+GRAPH_MAX_RETRIES = int(os.getenv("GRAPH_MAX_RETRIES", 5))
+# Số sub-request tối đa trong một lần gọi batch (giới hạn của Graph API)
+GRAPH_BATCH_SIZE = 50
+# Timeout (connect, read) tính bằng giây
+GRAPH_CONNECT_TIMEOUT = float(os.getenv("GRAPH_CONNECT_TIMEOUT", 10))
+GRAPH_READ_TIMEOUT = float(os.getenv("GRAPH_READ_TIMEOUT", 120))
+# Đọc trang lớn theo dạng stream (iter_page_chunks): kích thước khối đọc và số bản ghi tối đa mỗi lô yield
+GRAPH_STREAM_READ_BYTES = int(os.getenv("GRAPH_STREAM_READ_BYTES", 256 * 1024))
+GRAPH_STREAM_CHUNK_RECORDS = int(os.getenv("GRAPH_STREAM_CHUNK_RECORDS", 200))
+
+# Ngưỡng % usage (lấy max của call_count/total_cputime/total_time/acc_id_util_pct)
+# - Dưới USAGE_LOW: tăng dần số request đồng thời
+# - Trên USAGE_HIGH: giảm một nửa số request đồng thời và giãn nhịp gọi cho key đó
+USAGE_LOW = float(os.getenv("GRAPH_USAGE_LOW", 50))
+USAGE_HIGH = float(os.getenv("GRAPH_USAGE_HIGH", 85))
+# Khoảng cách tối đa (giây) giữa 2 request của cùng một key khi usage chạm 100%
+MAX_PACING_SECONDS = float(os.getenv("GRAPH_MAX_PACING_SECONDS", 5))
+# Thời gian chờ mặc định khi bị rate limit mà API không trả estimated_time_to_regain_access
+DEFAULT_BACKOFF_SECONDS = float(os.getenv("GRAPH_DEFAULT_BACKOFF_SECONDS", 30))
+
+# Các mã lỗi rate limit của Graph API / Marketing API
+RATE_LIMIT_ERROR_CODES = {4, 17, 32, 613}
+RATE_LIMIT_ERROR_CODE_RANGE = range(80000, 80015) # 80000 - 80014 (VD: 80004 ads_management)
+# Lỗi "Please reduce the amount of data you're asking for" của Insights API
+REDUCE_DATA_ERROR_CODE = 1
+REDUCE_DATA_ERROR_SUBCODES = {1504033}
+
+_OBJECT_ID_PATTERN = re.compile(r'^/(?:v\d+\.\d+/)?(act_\d+|\d+)(?:/|$)')
+
+
+def decode_json(response: requests.Response) -> Any:
+    """
+    Decode body JSON của response bằng orjson (nhanh hơn nhiều so với response.json() của stdlib).
+    Ném ValueError (orjson.JSONDecodeError) nếu body không phải JSON.
+    """
+    return orjson.loads(response.content)
+
+
+class StreamingDataParser:
+    """
+    Parse tăng dần (incremental) một payload Graph API dạng {"data": [{...}, ...], "paging": {...}}:
+    mỗi object trong mảng "data" được decode (orjson) ngay khi đọc đủ byte của nó, không cần giữ cả trang.
+
+    - feed(chunk) trả về list các bản ghi vừa hoàn chỉnh.
+    - finish() trả về phần còn lại của payload (VD: {'data': [], 'paging': {...}}).
+    Payload không bắt đầu bằng "data" (hiếm gặp) được gom lại và decode một lần ở finish(),
+    khi đó các bản ghi nằm trong kết quả của finish().
+    """
+
+    _PREFIX = re.compile(rb'\s*\{\s*"data"\s*:\s*\[')
+    _STRUCTURAL = re.compile(rb'["\\{}\[\]]')
+
+    def __init__(self):
+        self._buffer = b''
+        self._state = 'prefix' # prefix -> array -> suffix (hoặc fallback)
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._record_start = 0
+
+    def feed(self, chunk: bytes) -> List[Dict[str, Any]]:
+        self._buffer += chunk
+        if self._state == 'prefix':
+            match = self._PREFIX.match(self._buffer)
+            if match:
+                self._buffer = self._buffer[match.end():]
+                self._state = 'array'
+            elif len(self._buffer) >= 64:
+                # Không đúng dạng mong đợi: decode cả payload ở finish()
+                self._state = 'fallback'
+        if self._state != 'array':
+            return []
+        return self._scan()
+
+    def _scan(self) -> List[Dict[str, Any]]:
+        records = []
+        buf = self._buffer
+        i = self._pos
+        while True:
+            match = self._STRUCTURAL.search(buf, i)
+            if not match:
+                i = len(buf)
+                break
+            start = match.start()
+            char = buf[start:start + 1]
+            i = start + 1
+            if self._in_string:
+                if char == b'\\':
+                    if i >= len(buf):
+                        i = start # Ký tự escape nằm ở cuối khối, chờ thêm dữ liệu
+                        break
+                    i += 1
+                elif char == b'"':
+                    self._in_string = False
+                continue
+            if char == b'"':
+                self._in_string = True
+            elif char in (b'{', b'['):
+                if self._depth == 0:
+                    self._record_start = start
+                self._depth += 1
+            elif self._depth == 0:
+                # ']' đóng mảng "data": phần còn lại là paging
+                self._state = 'suffix'
+                self._buffer = buf[i:]
+                return records
+            else:
+                self._depth -= 1
+                if self._depth == 0:
+                    records.append(orjson.loads(buf[self._record_start:i]))
+
+        # Bỏ các byte đã xử lý, chỉ giữ bản ghi đang đọc dở
+        keep_from = self._record_start if self._depth > 0 else i
+        self._buffer = buf[keep_from:]
+        self._pos = i - keep_from
+        self._record_start = 0
+        return records
+
+    def finish(self) -> Dict[str, Any]:
+        if self._state == 'suffix':
+            return orjson.loads(b'{"data":[]' + self._buffer)
+        if self._state in ('prefix', 'fallback'):
+            return orjson.loads(self._buffer)
+        raise ValueError("Payload JSON bị cắt giữa mảng 'data'.")
+
+
+class UsageThrottle:
+    """
+    Điều tiết request theo header usage mà Graph API trả về:
+    X-App-Usage, X-Ad-Account-Usage và X-Business-Use-Case-Usage.
+
+    - Mỗi key (ad account 'act_...', page/business id, hoặc '__app__') có một "ngân sách":
+      usage càng cao thì khoảng cách giữa 2 request càng lớn; khi bị khóa thì chờ tới
+      hết estimated_time_to_regain_access.
+    - Số request đồng thời toàn cục tự điều chỉnh theo kiểu AIMD: tăng 1 khi usage thấp,
+      giảm một nửa khi usage cao hoặc bị rate limit.
+    """
+
+    APP_KEY = '__app__'
+
+    def __init__(self, max_concurrency: int = GRAPH_MAX_CONCURRENCY):
+        self.max_concurrency = max(1, max_concurrency)
+        self.limit = max(1, self.max_concurrency // 2)
+        self.in_flight = 0
+        self._cond = threading.Condition()
+        self._usage: Dict[str, float] = {}
+        self._blocked_until: Dict[str, float] = {}
+        self._next_allowed: Dict[str, float] = {}
+        self._last_decrease = 0.0
+
+    @staticmethod
+    def key_for(url: str) -> Optional[str]:
+        """
+        Xác định key ngân sách từ URL. Trả về None nếu không phải request tới Graph API (VD: CDN ảnh).
+        """
+        parsed = urlparse(url)
+        if not parsed.netloc.startswith('graph.'):
+            return None
+        match = _OBJECT_ID_PATTERN.match(parsed.path)
+        return match.group(1) if match else UsageThrottle.APP_KEY
+
+    def _wait_seconds(self, key: Optional[str], now: float) -> float:
+        wait = 0.0
+        for k in (self.APP_KEY, key) if key else ():
+            wait = max(wait, self._blocked_until.get(k, 0) - now, self._next_allowed.get(k, 0) - now)
+        return wait
+
+    def acquire(self, key: Optional[str]):
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                wait = self._wait_seconds(key, now)
+                if wait <= 0 and self.in_flight < self.limit:
+                    break
+                self._cond.wait(timeout=wait if wait > 0 else None)
+            self.in_flight += 1
+            if key:
+                # Đặt lịch sớm nhất cho request kế tiếp của key theo mức usage hiện tại
+                self._next_allowed[key] = now + self._pacing_seconds(key)
+
+    def release(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def _pacing_seconds(self, key: str) -> float:
+        usage = max(self._usage.get(key, 0), self._usage.get(self.APP_KEY, 0))
+        if usage <= USAGE_LOW:
+            return 0.0
+        ratio = min(1.0, (usage - USAGE_LOW) / (100 - USAGE_LOW))
+        return MAX_PACING_SECONDS * ratio * ratio
+
+    @staticmethod
+    def _parse_header(headers, name: str):
+        raw = headers.get(name)
+        if not raw:
+            return None
+        try:
+            return orjson.loads(raw)
+        except ValueError:
+            logger.warning(f"Không thể parse header {name}: {raw}")
+            return None
+
+    def update(self, key: Optional[str], headers):
+        """
+        Cập nhật ngân sách từ header usage của một response.
+        """
+        if key is None:
+            return
+
+        readings = {}  # key -> (usage %, số giây cần chờ để lấy lại quyền truy cập)
+
+        app_usage = self._parse_header(headers, 'X-App-Usage')
+        if app_usage:
+            pct = max(float(app_usage.get(f, 0) or 0) for f in ('call_count', 'total_cputime', 'total_time'))
+            readings[self.APP_KEY] = (pct, 0)
+
+        account_usage = self._parse_header(headers, 'X-Ad-Account-Usage')
+        if account_usage:
+            pct = float(account_usage.get('acc_id_util_pct', 0) or 0)
+            regain = float(account_usage.get('reset_time_duration', 0) or 0) if pct >= 100 else 0
+            readings[key] = (pct, regain)
+
+        buc_usage = self._parse_header(headers, 'X-Business-Use-Case-Usage')
+        if buc_usage:
+            for entries in buc_usage.values():
+                for entry in entries or []:
+                    pct = max(float(entry.get(f, 0) or 0) for f in ('call_count', 'total_cputime', 'total_time'))
+                    # estimated_time_to_regain_access tính bằng phút
+                    regain = float(entry.get('estimated_time_to_regain_access', 0) or 0) * 60
+                    prev_pct, prev_regain = readings.get(key, (0, 0))
+                    readings[key] = (max(pct, prev_pct), max(regain, prev_regain))
+
+        if not readings:
+            return
+
+        with self._cond:
+            now = time.monotonic()
+            highest = 0.0
+            for k, (pct, regain) in readings.items():
+                self._usage[k] = pct
+                highest = max(highest, pct)
+                if regain > 0:
+                    self._blocked_until[k] = max(self._blocked_until.get(k, 0), now + regain)
+                    logger.warning(f"Graph API yêu cầu chờ {regain:.0f}s cho '{k}' (usage {pct:.0f}%).")
+
+            # Chỉ giảm tối đa 1 lần/giây để các response đang bay không làm limit tụt về 1 ngay lập tức
+            if highest >= USAGE_HIGH and now - self._last_decrease >= 1:
+                self._last_decrease = now
+                new_limit = max(1, self.limit // 2)
+                if new_limit != self.limit:
+                    logger.info(f"Usage {highest:.0f}% -> giảm số request đồng thời {self.limit} -> {new_limit}.")
+                self.limit = new_limit
+            elif highest < USAGE_LOW and self.limit < self.max_concurrency:
+                self.limit += 1
+            self._cond.notify_all()
+
+    def penalize(self, key: Optional[str], retry_after: Optional[float] = None):
+        """
+        Gọi khi nhận lỗi rate limit: khóa key và giảm mạnh số request đồng thời.
+        """
+        with self._cond:
+            wait = retry_after if retry_after and retry_after > 0 else DEFAULT_BACKOFF_SECONDS
+            target = key or self.APP_KEY
+            self._blocked_until[target] = max(self._blocked_until.get(target, 0), time.monotonic() + wait)
+            self.limit = 1
+            logger.warning(f"Bị rate limit cho '{target}'. Tạm dừng {wait:.0f}s, giảm request đồng thời về 1.")
+            self._cond.notify_all()
+
+
+def _rate_limit_error_code(response: requests.Response) -> Optional[int]:
+    """
+    Trả về mã lỗi nếu response là lỗi rate limit của Graph API, ngược lại trả về None.
+    """
+    if response.status_code < 400:
+        return None
+    try:
+        code = decode_json(response).get('error', {}).get('code')
+    except ValueError:
+        return None
+    if code in RATE_LIMIT_ERROR_CODES or code in RATE_LIMIT_ERROR_CODE_RANGE:
+        return code
+    return None
+
+
+def is_reduce_data_error(error: Exception) -> bool:
+    """
+    True nếu lỗi cho thấy request Insights quá lớn và nên được chia nhỏ:
+    timeout, hoặc lỗi code 1 / subcode 1504033 ("reduce the amount of data").
+    """
+    if isinstance(error, requests.exceptions.Timeout):
+        return True
+    response = getattr(error, 'response', None)
+    if response is None:
+        return False
+    try:
+        err = decode_json(response).get('error', {})
+    except ValueError:
+        return False
+    if err.get('error_subcode') in REDUCE_DATA_ERROR_SUBCODES:
+        return True
+    return err.get('code') == REDUCE_DATA_ERROR_CODE and 'reduce the amount of data' in str(err.get('message', '')).lower()
+
+
+class GraphClient:
+    """
+    HTTP client dùng chung cho Graph API (và CDN ảnh của Meta).
+    - Một requests.Session duy nhất với pool kết nối keep-alive, tránh mở TLS mới cho mỗi trang.
+    - Luôn yêu cầu nén gzip.
+    - Timeout thống nhất cho mọi request.
+    - Một iterator phân trang duy nhất (iter_pages) thay cho các vòng lặp `while url:`.
+    - Tự điều tiết tốc độ theo header usage của Graph API (UsageThrottle).
+    """
+
+    def __init__(self, pool_size: int = GRAPH_POOL_SIZE, max_concurrency: int = GRAPH_MAX_CONCURRENCY,
+                 timeout: tuple = (GRAPH_CONNECT_TIMEOUT, GRAPH_READ_TIMEOUT)):
+        self.timeout = timeout
+        self.session = requests.Session()
+        # pool_block=True: khi pool đã dùng hết, thread chờ kết nối rảnh thay vì mở kết nối mới
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({
+            'Accept-Encoding': 'gzip, deflate',
+            'Connection': 'keep-alive',
+        })
+        self.throttle = UsageThrottle(max_concurrency)
+
+    def _request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """
+        Gửi request qua pool kết nối, có điều tiết theo usage và tự thử lại khi bị rate limit.
+        """
+        key = self.throttle.key_for(url)
+        attempt = 0
+        while True:
+            self.throttle.acquire(key)
+            try:
+                response = self.session.request(method, url, timeout=self.timeout, **kwargs)
+            finally:
+                self.throttle.release()
+            self.throttle.update(key, response.headers)
+
+            error_code = _rate_limit_error_code(response) if key else None
+            if error_code is None or attempt >= GRAPH_MAX_RETRIES:
+                return response
+
+            attempt += 1
+            # Nếu header đã báo thời gian chờ thì update() đã khóa key; penalize đảm bảo luôn có backoff
+            self.throttle.penalize(key, DEFAULT_BACKOFF_SECONDS * attempt)
+            logger.warning(f"Lỗi rate limit {error_code} (lần {attempt}/{GRAPH_MAX_RETRIES}), thử lại: {url.split('?')[0]}")
+
+    def get(self, url: str, params: Optional[Dict[str, Any]] = None, stream: bool = False) -> requests.Response:
+        """
+        Gửi GET qua pool kết nối. Không tự raise lỗi HTTP để caller quyết định cách xử lý.
+        Lỗi rate limit (4/17/32/613/800xx) được chờ và thử lại tự động.
+        """
+        return self._request('GET', url, params=params, stream=stream)
+
+    def post_json(self, url: str, data: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """
+        POST (form-encoded) và trả về JSON đã decode. Ném requests.exceptions.HTTPError nếu status lỗi.
+        """
+        response = self._request('POST', url, data=data)
+        response.raise_for_status()
+        return decode_json(response)
+
+    def get_json(self, url: str, params: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """
+        GET và trả về JSON đã decode. Ném requests.exceptions.HTTPError nếu status lỗi.
+        """
+        response = self.get(url, params=params)
+        response.raise_for_status()
+        return decode_json(response)
+
+    def batch(self, base_url: str, sub_requests: List[Dict[str, Any]], access_token: str) -> List[Optional[Dict[str, Any]]]:
+        """
+        Gửi nhiều sub-request qua endpoint batch của Graph API (tối đa 50 sub-request mỗi lần gọi).
+        Trả về list cùng thứ tự với sub_requests; mỗi phần tử là {'code': int, 'body': dict}
+        hoặc None nếu Graph API không trả kết quả cho sub-request đó (VD: timeout).
+        """
+        parsed = urlparse(base_url)
+        batch_url = f"{parsed.scheme}://{parsed.netloc}/"
+        results = []
+        for i in range(0, len(sub_requests), GRAPH_BATCH_SIZE):
+            chunk = sub_requests[i:i + GRAPH_BATCH_SIZE]
+            responses = self.post_json(batch_url, data={
+                'access_token': access_token,
+                'batch': json.dumps(chunk),
+                'include_headers': 'false',
+            })
+            for item in responses:
+                if item is None:
+                    results.append(None)
+                    continue
+                try:
+                    body = orjson.loads(item.get('body') or '{}')
+                except ValueError:
+                    body = {}
+                results.append({'code': item.get('code'), 'body': body})
+        return results
+
+    def iter_pages(self, url: str, params: Optional[Dict[str, Any]] = None, prefetch: bool = False) -> Iterator[Dict[str, Any]]:
+        """
+        Duyệt tuần tự các trang kết quả của một endpoint Graph API.
+        Yield nguyên payload của từng trang (gồm 'data' và 'paging').
+        Params chỉ gửi ở trang đầu; các trang sau dùng URL 'paging.next' (đã chứa sẵn params).
+
+        prefetch=True: trang kế tiếp được tải ở thread nền trong lúc trang hiện tại đang được xử lý,
+        nên tại mỗi thời điểm chỉ giữ tối đa 2 trang trong bộ nhớ.
+        """
+        if not prefetch:
+            page_params = params
+            while url:
+                data = self.get_json(url, params=page_params)
+                yield data
+                url = (data.get('paging') or {}).get('next')
+                page_params = None
+            return
+
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='graph-prefetch')
+        try:
+            future = executor.submit(self.get_json, url, params)
+            while future is not None:
+                data = future.result()
+                next_url = (data.get('paging') or {}).get('next')
+                # Không tải trước khi trang hiện tại rỗng (bên gọi sẽ dừng ở trang này)
+                future = executor.submit(self.get_json, next_url) if next_url and data.get('data') else None
+                yield data
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def iter_page_chunks(self, url: str, params: Optional[Dict[str, Any]] = None,
+                         chunk_records: int = GRAPH_STREAM_CHUNK_RECORDS) -> Iterator[Dict[str, Any]]:
+        """
+        Giống iter_pages nhưng đọc mỗi trang theo dạng stream (StreamingDataParser) và yield từng lô
+        tối đa `chunk_records` bản ghi dưới dạng {'data': [...], 'paging': {...}}, nên không bao giờ
+        giữ nguyên một trang lớn trong bộ nhớ. 'paging' chỉ có ở lô cuối cùng (không rỗng) của mỗi trang
+        (các lô trước có 'paging' rỗng). Lô 'data' rỗng chỉ được yield khi cả trang không có bản ghi nào.
+        Dùng cho các trang rất lớn (VD: kết quả Async Report).
+        """
+        page_params = params
+        while url:
+            response = self.get(url, params=page_params, stream=True)
+            page_records = 0
+            try:
+                response.raise_for_status()
+                parser = StreamingDataParser()
+                pending = []
+                for chunk in response.iter_content(chunk_size=GRAPH_STREAM_READ_BYTES):
+                    pending.extend(parser.feed(chunk))
+                    # Luôn giữ lại ít nhất một lô để gắn 'paging' vào lô cuối của trang
+                    while len(pending) > chunk_records:
+                        yield {'data': pending[:chunk_records], 'paging': {}}
+                        page_records += chunk_records
+                        pending = pending[chunk_records:]
+                envelope = parser.finish()
+            finally:
+                response.close()
+            # Payload không đúng dạng chuẩn: bản ghi nằm trong envelope
+            pending.extend(envelope.get('data') or [])
+            page_records += len(pending)
+            paging = envelope.get('paging') or {}
+            for start in range(0, max(len(pending), 1), chunk_records):
+                last = start + chunk_records >= len(pending)
+                yield {'data': pending[start:start + chunk_records], 'paging': paging if last else {}}
+            if not page_records:
+                return
+            url = paging.get('next')
+            page_params = None
+
+def relative_url(base_url: str, path_or_url: str, params: Optional[Dict[str, Any]] = None) -> str:
+    """
+    Tạo 'relative_url' cho sub-request batch.
+    - path_or_url là URL đầy đủ (VD: paging.next): bỏ scheme và host.
+    - path_or_url là đường dẫn (VD: 'act_1/campaigns'): thêm version của base_url và params.
+    access_token luôn bị loại khỏi params vì batch dùng token chung.
+    """
+    parsed = urlparse(path_or_url)
+    if parsed.netloc:
+        relative = parsed.path.lstrip('/')
+        return f"{relative}?{parsed.query}" if parsed.query else relative
+
+    version = urlparse(base_url).path.strip('/')
+    relative = f"{version}/{path_or_url.lstrip('/')}" if version else path_or_url.lstrip('/')
+    query = {k: v for k, v in (params or {}).items() if k != 'access_token'}
+    return f"{relative}?{urlencode(query)}" if query else relative
+
+
+_default_client: Optional[GraphClient] = None
+_default_client_lock = threading.Lock()
+
+
+def get_graph_client() -> GraphClient:
+    """
+    Trả về GraphClient dùng chung cho toàn bộ process (khởi tạo lười, thread-safe).
+    """
+    global _default_client
+    if _default_client is None:
+        with _default_client_lock:
+            if _default_client is None:
+                _default_client = GraphClient()
+                logger.info("Đã khởi tạo GraphClient dùng chung.")
+    return _default_client
@@ -1,10 +1,14 @@
 # Đây là script Python để tự động nạp dữ liệu hàng ngày (ADS + FANPAGE)
-# Script sẽ lặp qua từng ngày trong khoảng thời gian đã định.
-# Quy trình mỗi ngày: 
-# 1. Nạp Ads Data -> 2. Sleep 1.5s -> 3. Nạp Fanpage Data -> 4. Sleep 4s -> Ngày tiếp theo.
+# Quy trình:
+# 1. Nạp Ads Data một lần cho cả khoảng thời gian (Insights theo time_increment=1).
+# 2. Lặp qua từng ngày để nạp Fanpage Data.
+# Tốc độ gọi API do GraphClient tự điều tiết theo header usage của Meta (không sleep cố định).
+# Insights Ads được ghi checkpoint theo ETL_JOB_ID: chạy lại script sau khi crash sẽ tiếp tục từ trang đã nạp cuối cùng.
+# Mặc định chạy Ads ở chế độ incremental: chỉ lấy lại cửa sổ attribution (INCREMENTAL_ATTRIBUTION_DAYS ngày cuối)
+# và các ngày chưa có trong CSDL (ETL_INCREMENTAL=false để lấy lại toàn bộ khoảng).
 
+import os
 import logging
-import time
 from datetime import date, timedelta
 from database_manager import DatabaseManager
 
@@ -20,16 +24,15 @@ logging.basicConfig(
 START_DATE = date(2025, 10, 14)
 # Ngày kết thúc (bao gồm)
 END_DATE = date(2025, 11, 24)
-
-# Thời gian chờ kết thúc 1 ngày (giây)
-WAIT_SECONDS_END_OF_DAY = 4
-# Thời gian chờ giữa Ads task và Fanpage task (giây)
-WAIT_SECONDS_BETWEEN_TASKS = 1.5
+# Mã job dùng cho checkpoint phân trang (giữ nguyên giữa các lần chạy lại để resume)
+JOB_ID = os.getenv("ETL_JOB_ID", f"loaddaily-{START_DATE.isoformat()}-{END_DATE.isoformat()}")
+# Chỉ lấy lại cửa sổ attribution + các ngày còn thiếu
+INCREMENTAL = os.getenv("ETL_INCREMENTAL", "true").lower() in ("1", "true", "yes")
 # ------------------
 
 def main():
     """
-    Script chính để lặp qua các ngày và nạp dữ liệu tổng hợp.
+    Script chính: nạp Ads cho cả khoảng, sau đó lặp qua các ngày để nạp Fanpage.
     """
     logging.info("--- BẮT ĐẦU SCRIPT NẠP DỮ LIỆU TỰ ĐỘNG (ADS & FANPAGE) ---")
     
@@ -43,6 +46,30 @@ def main():
         logging.error(f"Không thể khởi tạo DatabaseManager hoặc tạo bảng. Lỗi: {e}")
         return
 
+    start_date_str = START_DATE.strftime('%Y-%m-%d')
+    end_date_str = END_DATE.strftime('%Y-%m-%d')
+
+    # ---------------------------------------------------------
+    # BƯỚC 1: NẠP DỮ LIỆU QUẢNG CÁO (ADS) CHO CẢ KHOẢNG
+    # ---------------------------------------------------------
+    try:
+        logging.info(f"-> [1/2] Đang nạp ADS DATA từ {start_date_str} đến {end_date_str}...")
+        db_manager.refresh_data(
+            start_date=start_date_str,
+            end_date=end_date_str,
+            job_id=JOB_ID,
+            incremental=INCREMENTAL
+        )
+        # Job đã chạy xong -> xóa checkpoint để lần chạy sau nạp lại từ đầu
+        db_manager.clear_checkpoints(JOB_ID)
+        logging.info(f"-> [1/2] Hoàn thành nạp ADS DATA.")
+    except Exception as e:
+        logging.error(f"-> [1/2] LỖI nạp ADS DATA: {e}", exc_info=True)
+        logging.warning(f"Giữ lại checkpoint của job '{JOB_ID}' để chạy lại.")
+
+    # ---------------------------------------------------------
+    # BƯỚC 2: NẠP DỮ LIỆU FANPAGE (THEO TỪNG NGÀY)
+    # ---------------------------------------------------------
     current_date = START_DATE
     total_days = (END_DATE - START_DATE).days + 1
     day_count = 1
@@ -52,29 +79,7 @@ def main():
         current_date_str = current_date.strftime('%Y-%m-%d')
         
         logging.info(f"========== [Ngày {day_count}/{total_days} - {current_date_str}] BẮT ĐẦU XỬ LÝ ==========")
-        
-        # ---------------------------------------------------------
-        # BƯỚC 1: NẠP DỮ LIỆU QUẢNG CÁO (ADS)
-        # ---------------------------------------------------------
-        try:
-            logging.info(f"-> [1/2] Đang nạp ADS DATA cho ngày: {current_date_str}...")
-            db_manager.refresh_data(
-                start_date=current_date_str,
-                end_date=current_date_str
-            )
-            logging.info(f"-> [1/2] Hoàn thành nạp ADS DATA.")
-        except Exception as e:
-            logging.error(f"-> [1/2] LỖI nạp ADS DATA ngày {current_date_str}: {e}", exc_info=True)
-        
-        # ---------------------------------------------------------
-        # BƯỚC 2: SLEEP 1.5 GIÂY
-        # ---------------------------------------------------------
-        logging.info(f"... Nghỉ {WAIT_SECONDS_BETWEEN_TASKS}s trước khi nạp Fanpage ...")
-        time.sleep(WAIT_SECONDS_BETWEEN_TASKS)
 
-        # ---------------------------------------------------------
-        # BƯỚC 3: NẠP DỮ LIỆU FANPAGE
-        # ---------------------------------------------------------
         try:
             logging.info(f"-> [2/2] Đang nạp FANPAGE DATA cho ngày: {current_date_str}...")
             db_manager.refresh_data_fanpage(
@@ -91,13 +96,6 @@ def main():
         # Tăng ngày lên
         current_date += timedelta(days=1)
         day_count += 1
-        
-        # ---------------------------------------------------------
-        # BƯỚC 4: SLEEP 4 GIÂY (NẾU CÒN NGÀY TIẾP THEO)
-        # ---------------------------------------------------------
-        if current_date <= END_DATE:
-            logging.info(f"Đang chờ {WAIT_SECONDS_END_OF_DAY} giây trước khi sang ngày tiếp theo...")
-            time.sleep(WAIT_SECONDS_END_OF_DAY)
 
     logging.info("--- ĐÃ HOÀN THÀNH TOÀN BỘ QUÁ TRÌNH NẠP DỮ LIỆU ---")
 
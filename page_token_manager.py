@@ -0,0 +1,310 @@
+import os
+import time
+import logging
+import threading
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Any, Optional, Set
+import requests
+from graph_client import get_graph_client, decode_json
+
+logger = logging.getLogger(__name__)
+
+# Chu kỳ (giây) luồng nền kiểm tra hạn của các Page Token
+PAGE_TOKEN_CHECK_INTERVAL = float(os.getenv("PAGE_TOKEN_CHECK_INTERVAL", 900))
+# Token còn hạn ít hơn khoảng này (giây) sẽ được làm mới trước
+PAGE_TOKEN_REFRESH_MARGIN = float(os.getenv("PAGE_TOKEN_REFRESH_MARGIN", 24 * 3600))
+# Token không có hạn (expires_at = 0) vẫn được debug_token lại sau khoảng này để phát hiện token bị thu hồi
+PAGE_TOKEN_RECHECK_SECONDS = float(os.getenv("PAGE_TOKEN_RECHECK_SECONDS", 6 * 3600))
+
+PAGE_FIELDS = 'id,name,access_token,category'
+
+
+def is_token_error(error: Exception) -> bool:
+    """
+    True nếu lỗi là OAuthException (code 190): token hết hạn hoặc bị thu hồi.
+    """
+    response = getattr(error, 'response', None)
+    if response is None:
+        return False
+    try:
+        return decode_json(response).get('error', {}).get('code') == 190
+    except ValueError:
+        return False
+
+
+class _TokenEntry:
+    __slots__ = ('token', 'expires_at', 'checked_at', 'valid')
+
+    def __init__(self, token: str, expires_at: Optional[float] = None, checked_at: Optional[float] = None,
+                 valid: bool = True):
+        self.token = token
+        # None: chưa debug_token; 0: không hết hạn; > 0: epoch (giây)
+        self.expires_at = expires_at
+        self.checked_at = checked_at
+        self.valid = valid
+
+    def expires_within(self, seconds: float, now: float) -> bool:
+        return bool(self.expires_at) and self.expires_at - now <= seconds
+
+
+class PageTokenManager:
+    """
+    Cache Page Access Token trong bộ nhớ kèm hạn dùng (lấy từ debug_token).
+
+    - get_token(page_id): trả token trong cache; chỉ khi chưa có hoặc đã hỏng mới gọi API,
+      và chỉ lấy riêng page đó (GET /{page_id}?fields=access_token), không liệt kê lại toàn bộ Fanpage.
+    - invalidate(page_id): đánh dấu token hỏng (VD: sau lỗi 190) để lần get_token sau lấy token mới.
+    - Luồng nền (start) định kỳ debug_token các token và làm mới những token sắp hết hạn
+      bằng một lần gọi /me/accounts.
+    - Các lần làm mới đồng thời cho cùng một page (hoặc cùng một lần làm mới toàn bộ)
+      được gộp thành một request; các thread khác chờ chung kết quả.
+    """
+
+    def __init__(self, user_access_token: Optional[str] = None, base_url: Optional[str] = None,
+                 loader: Optional[Callable[[], Dict[str, str]]] = None,
+                 saver: Optional[Callable[[List[Dict[str, Any]]], None]] = None):
+        """
+        Args:
+            user_access_token: User Token dùng để lấy Page Token (mặc định SECRET_KEY).
+            base_url: Graph API base URL (mặc định BASE_URL).
+            loader: hàm trả về {page_id: token} để nạp cache ban đầu (VD: từ dim_fanpage).
+            saver: hàm nhận list page ({'id','name','access_token','category'}) khi có token mới (VD: upsert_fanpages).
+        """
+        self.user_access_token = user_access_token or os.getenv("SECRET_KEY")
+        self.base_url = base_url or os.getenv("BASE_URL", "https://graph.facebook.com/v24.0")
+        self.loader = loader
+        self.saver = saver
+        self.client = get_graph_client()
+
+        self._entries: Dict[str, _TokenEntry] = {}
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._inflight: Dict[str, Future] = {}
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    # --- Cache ---
+
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            if self.loader:
+                try:
+                    for page_id, token in (self.loader() or {}).items():
+                        if token and page_id not in self._entries:
+                            self._entries[page_id] = _TokenEntry(token)
+                except Exception as e:
+                    logger.error(f"Lỗi khi nạp Page Token ban đầu: {e}")
+            self._loaded = True
+
+    def attach(self, loader: Optional[Callable[[], Dict[str, str]]] = None,
+               saver: Optional[Callable[[List[Dict[str, Any]]], None]] = None):
+        """
+        Gắn loader/saver nếu manager chưa có (VD: manager được tạo trước bởi nơi không có CSDL).
+        Loader mới gắn sẽ được dùng để nạp cache ở lần get_token tiếp theo.
+        """
+        with self._lock:
+            if loader is not None and self.loader is None:
+                self.loader = loader
+                self._loaded = False
+            if saver is not None and self.saver is None:
+                self.saver = saver
+
+    def update_from_pages(self, pages: List[Dict[str, Any]]):
+        """
+        Cập nhật cache từ kết quả /me/accounts (hoặc GET /{page_id}). Token đổi thì phải debug_token lại.
+        """
+        with self._lock:
+            for page in pages:
+                page_id, token = page.get('id'), page.get('access_token')
+                if not page_id or not token:
+                    continue
+                entry = self._entries.get(page_id)
+                if entry is None or entry.token != token or not entry.valid:
+                    self._entries[page_id] = _TokenEntry(token)
+
+    def get_token(self, page_id: str) -> Optional[str]:
+        """
+        Trả về Page Token còn dùng được cho page_id (None nếu không lấy được).
+        """
+        self._ensure_loaded()
+        with self._lock:
+            entry = self._entries.get(page_id)
+            if entry is not None and entry.valid and not entry.expires_within(0, time.time()):
+                return entry.token
+        return self._coalesced(page_id, lambda: self._fetch_page_token(page_id))
+
+    def invalidate(self, page_id: str, token: Optional[str] = None):
+        """
+        Đánh dấu token của page_id là hỏng. Nếu truyền token, chỉ đánh dấu khi cache vẫn đang giữ
+        đúng token đó (tránh xóa nhầm token mới do thread khác vừa làm mới).
+        """
+        with self._lock:
+            entry = self._entries.get(page_id)
+            if entry is not None and (token is None or entry.token == token):
+                entry.valid = False
+
+    # --- Làm mới (gộp các lần gọi đồng thời) ---
+
+    def _coalesced(self, key: str, fn: Callable[[], Any]) -> Any:
+        with self._lock:
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._inflight[key] = future
+        if not owner:
+            return future.result()
+        try:
+            future.set_result(fn())
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+        return future.result()
+
+    def _fetch_page_token(self, page_id: str) -> Optional[str]:
+        """
+        Lấy token mới cho MỘT page bằng User Token.
+        """
+        try:
+            page = self.client.get_json(f"{self.base_url}/{page_id}",
+                                        params={'fields': PAGE_FIELDS, 'access_token': self.user_access_token})
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Lỗi khi lấy Page Token cho {page_id}: {e}")
+            return None
+        if not page.get('access_token'):
+            logger.error(f"Không lấy được Page Token cho {page_id} (User Token không có quyền trên page này?).")
+            return None
+        self._store_pages([page])
+        logger.info(f"Đã làm mới Page Token cho {page_id}.")
+        return page['access_token']
+
+    def refresh_all(self) -> int:
+        """
+        Lấy lại token của mọi Fanpage bằng một lần liệt kê /me/accounts (chỉ chạy ở luồng nền
+        hoặc job ETL). Các lần gọi đồng thời dùng chung một lần liệt kê. Trả về số page đã cập nhật.
+        """
+        return self._coalesced('__all__', self._list_all_pages)
+
+    def _list_all_pages(self) -> int:
+        pages = []
+        params = {'access_token': self.user_access_token, 'fields': PAGE_FIELDS, 'limit': 100}
+        for data in self.client.iter_pages(f"{self.base_url}/me/accounts", params):
+            pages.extend(p for p in data.get('data', []) if p.get('access_token'))
+        self._store_pages(pages)
+        self._drop_unlisted({page['id'] for page in pages if page.get('id')})
+        logger.info(f"Đã làm mới Page Token cho {len(pages)} Fanpage.")
+        return len(pages)
+
+    def _drop_unlisted(self, listed_ids: Set[str]):
+        """
+        Bỏ khỏi cache các token hỏng/sắp hết hạn của page không còn trong /me/accounts
+        (page bị xóa hoặc mất quyền), để chúng không kích hoạt refresh_all ở mọi chu kỳ kiểm tra.
+        """
+        now = time.time()
+        with self._lock:
+            dropped = [page_id for page_id, entry in self._entries.items()
+                       if page_id not in listed_ids and (not entry.valid or entry.expires_within(PAGE_TOKEN_REFRESH_MARGIN, now))]
+            for page_id in dropped:
+                del self._entries[page_id]
+        if dropped:
+            logger.warning(f"Bỏ {len(dropped)} Page Token không còn trong /me/accounts: {', '.join(dropped)}")
+
+    def _store_pages(self, pages: List[Dict[str, Any]]):
+        if not pages:
+            return
+        self.update_from_pages(pages)
+        if self.saver:
+            try:
+                self.saver(pages)
+            except Exception as e:
+                logger.error(f"Lỗi khi lưu Page Token: {e}")
+
+    # --- Kiểm tra hạn (debug_token) ---
+
+    def _debug_token(self, token: str) -> Dict[str, Any]:
+        data = self.client.get_json(f"{self.base_url}/debug_token",
+                                    params={'input_token': token, 'access_token': self.user_access_token})
+        return data.get('data', {})
+
+    def check_tokens(self):
+        """
+        debug_token các token chưa kiểm tra (hoặc kiểm tra đã lâu), rồi làm mới nếu có token
+        sắp hết hạn hoặc không còn hợp lệ.
+        """
+        self._ensure_loaded()
+        now = time.time()
+        with self._lock:
+            to_check = {page_id: entry.token for page_id, entry in self._entries.items()
+                        if entry.valid and (entry.checked_at is None or now - entry.checked_at >= PAGE_TOKEN_RECHECK_SECONDS)}
+
+        for page_id, token in to_check.items():
+            try:
+                info = self._debug_token(token)
+            except requests.exceptions.RequestException as e:
+                logger.warning(f"Lỗi debug_token cho page {page_id}: {e}")
+                continue
+            with self._lock:
+                entry = self._entries.get(page_id)
+                if entry is None or entry.token != token:
+                    continue
+                entry.checked_at = now
+                entry.expires_at = float(info.get('expires_at') or 0)
+                entry.valid = bool(info.get('is_valid', True))
+
+        with self._lock:
+            stale = [page_id for page_id, entry in self._entries.items()
+                     if not entry.valid or entry.expires_within(PAGE_TOKEN_REFRESH_MARGIN, now)]
+        if stale:
+            logger.info(f"{len(stale)} Page Token sắp hết hạn hoặc không hợp lệ, đang làm mới...")
+            self.refresh_all()
+
+    # --- Luồng nền ---
+
+    def start(self):
+        """
+        Khởi động luồng nền làm mới token (gọi nhiều lần cũng chỉ chạy một luồng).
+        """
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop_event.clear()
+            self._thread = threading.Thread(target=self._run, name='page-token-refresh', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                self.check_tokens()
+            except Exception as e:
+                logger.error(f"Lỗi khi làm mới Page Token (luồng nền): {e}", exc_info=True)
+            self._stop_event.wait(PAGE_TOKEN_CHECK_INTERVAL)
+
+
+_default_manager: Optional[PageTokenManager] = None
+_default_manager_lock = threading.Lock()
+
+
+def get_page_token_manager(loader: Optional[Callable[[], Dict[str, str]]] = None,
+                           saver: Optional[Callable[[List[Dict[str, Any]]], None]] = None) -> PageTokenManager:
+    """
+    Trả về PageTokenManager dùng chung cho toàn bộ process (khởi tạo lười, thread-safe).
+    loader/saver được gắn vào manager nếu manager chưa có (xem PageTokenManager.attach).
+    """
+    global _default_manager
+    if _default_manager is None:
+        with _default_manager_lock:
+            if _default_manager is None:
+                _default_manager = PageTokenManager(loader=loader, saver=saver)
+                logger.info("Đã khởi tạo PageTokenManager dùng chung.")
+    if loader is not None or saver is not None:
+        _default_manager.attach(loader=loader, saver=saver)
+    return _default_manager
@@ -0,0 +1,142 @@
+import os
+import io
+import uuid
+import logging
+import threading
+from datetime import datetime
+from typing import Dict, List, Any, Iterator, Optional, Tuple
+import orjson
+import zstandard
+
+logger = logging.getLogger(__name__)
+
+# Vùng lưu dữ liệu thô (landing zone): mỗi trang insights/posts lấy từ API được lưu dạng NDJSON nén zstd
+# - RAW_ARCHIVE_ENABLED: bật/tắt ghi archive khi refresh
+# - RAW_ARCHIVE_DIR: thư mục gốc của archive
+# - RAW_ARCHIVE_ZSTD_LEVEL: mức nén zstd
+RAW_ARCHIVE_ENABLED = os.getenv("RAW_ARCHIVE_ENABLED", "true").lower() in ("1", "true", "yes")
+RAW_ARCHIVE_DIR = os.getenv("RAW_ARCHIVE_DIR", "raw_archive")
+RAW_ARCHIVE_ZSTD_LEVEL = int(os.getenv("RAW_ARCHIVE_ZSTD_LEVEL", 3))
+# Số thread đọc/giải nén archive song song khi transform lại (retransform.py)
+RAW_ARCHIVE_RELOAD_WORKERS = int(os.getenv("RAW_ARCHIVE_RELOAD_WORKERS", 4))
+
+ARCHIVE_SUFFIX = '.ndjson.zst'
+# Các loại insights được lưu archive (trùng với key của stream_insights_concurrently)
+INSIGHT_KINDS = ('insights_platform', 'insights_demographic', 'insights_region')
+# Khóa tự nhiên (theo tên trường thô của API) của từng loại insights, dùng để gộp các lần chạy trong một phân vùng
+INSIGHT_KEY_FIELDS = {
+    'insights_platform': ('date_start', 'ad_id', 'publisher_platform', 'platform_position'),
+    'insights_demographic': ('date_start', 'ad_id', 'gender', 'age'),
+    'insights_region': ('date_start', 'ad_id', 'region'),
+}
+
+
+class RawArchive:
+    """
+    Lưu bản ghi thô từ Graph API dạng NDJSON nén zstd, phân vùng theo thư mục:
+
+        {root}/{kind}/{owner_key}={owner_id}/date={YYYY-MM-DD}/{run_id}.ndjson.zst
+
+    - kind: 'insights_platform' | 'insights_demographic' | 'insights_region' | 'posts'
+    - Mỗi lần refresh (run_id) ghi vào file riêng; mỗi trang được nén thành một frame zstd và
+      nối vào cuối file (file nhiều frame vẫn giải nén tuần tự được).
+    - Khi đọc lại, gộp mọi file trong phân vùng theo khóa tự nhiên, bản ghi của lần chạy mới hơn thắng
+      (file của một lần chạy có thể chỉ chứa một phần ngày: job chạy tiếp, tài khoản lỗi giữa chừng).
+    """
+
+    def __init__(self, root: Optional[str] = None, run_id: Optional[str] = None, level: int = RAW_ARCHIVE_ZSTD_LEVEL):
+        self.root = root or RAW_ARCHIVE_DIR
+        # run_id bắt đầu bằng timestamp để sắp xếp theo tên file là sắp xếp theo thời gian
+        self.run_id = run_id or f"{datetime.now().strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        self.level = level
+        self._lock = threading.Lock()
+
+    # --- Ghi ---
+
+    def _partition_dir(self, kind: str, owner_key: str, owner_id: str, date_str: str) -> str:
+        return os.path.join(self.root, kind, f"{owner_key}={owner_id}", f"date={date_str}")
+
+    def _append(self, directory: str, records: List[Dict[str, Any]]):
+        payload = b''.join(orjson.dumps(record) + b'\n' for record in records)
+        # Nén ngoài lock (tốn CPU), chỉ ghi file dưới lock
+        frame = zstandard.ZstdCompressor(level=self.level).compress(payload)
+        with self._lock:
+            os.makedirs(directory, exist_ok=True)
+            with open(os.path.join(directory, f"{self.run_id}{ARCHIVE_SUFFIX}"), 'ab') as f:
+                f.write(frame)
+
+    def _write_grouped(self, kind: str, owner_key: str, owner_id: str, records: List[Dict[str, Any]], date_field: str):
+        by_date = {}
+        for record in records:
+            date_str = str(record.get(date_field) or '')[:10] or 'unknown'
+            by_date.setdefault(date_str, []).append(record)
+        for date_str, date_records in by_date.items():
+            self._append(self._partition_dir(kind, owner_key, owner_id, date_str), date_records)
+
+    def write_insights(self, kind: str, account_id: str, records: List[Dict[str, Any]]):
+        """
+        Lưu một trang insights (bản ghi thô từ API) của tài khoản, chia theo date_start.
+        """
+        if records:
+            self._write_grouped(kind, 'account', account_id, records, 'date_start')
+
+    def write_posts(self, page_id: str, records: List[Dict[str, Any]]):
+        """
+        Lưu một trang posts (bản ghi thô từ API) của Fanpage, chia theo ngày created_time.
+        """
+        if records:
+            self._write_grouped('posts', 'page', page_id, records, 'created_time')
+
+    # --- Đọc ---
+
+    def iter_partitions(self, kind: str, start_date: Optional[str] = None, end_date: Optional[str] = None,
+                        owner_ids: Optional[List[str]] = None) -> Iterator[Tuple[str, str, List[str]]]:
+        """
+        Duyệt các phân vùng của `kind` trong khoảng ngày (bao gồm 2 đầu).
+        Yield (owner_id, date_str, danh sách file của các lần chạy, cũ trước mới sau).
+        """
+        kind_dir = os.path.join(self.root, kind)
+        if not os.path.isdir(kind_dir):
+            return
+        for owner_dir in sorted(os.listdir(kind_dir)):
+            owner_id = owner_dir.split('=', 1)[-1]
+            if owner_ids and owner_id not in owner_ids:
+                continue
+            owner_path = os.path.join(kind_dir, owner_dir)
+            for date_dir in sorted(os.listdir(owner_path)):
+                date_str = date_dir.split('=', 1)[-1]
+                if (start_date and date_str < start_date) or (end_date and date_str > end_date):
+                    continue
+                date_path = os.path.join(owner_path, date_dir)
+                parts = sorted(name for name in os.listdir(date_path) if name.endswith(ARCHIVE_SUFFIX))
+                if parts:
+                    yield owner_id, date_str, [os.path.join(date_path, name) for name in parts]
+
+    @staticmethod
+    def read_file(path: str) -> Iterator[Dict[str, Any]]:
+        """
+        Đọc một file archive (nhiều frame zstd nối nhau), yield từng bản ghi.
+        """
+        with open(path, 'rb') as f:
+            reader = zstandard.ZstdDecompressor().stream_reader(f, read_across_frames=True)
+            for line in io.BufferedReader(reader):
+                if line.strip():
+                    yield orjson.loads(line)
+
+    @classmethod
+    def read_partition(cls, paths: List[str], key_fields: Tuple[str, ...]) -> List[Dict[str, Any]]:
+        """
+        Đọc và gộp các file của một phân vùng (cũ trước mới sau): trùng khóa tự nhiên thì giữ bản ghi mới nhất.
+        """
+        merged = {}
+        for path in paths:
+            for record in cls.read_file(path):
+                merged[tuple(record.get(f) for f in key_fields)] = record
+        return list(merged.values())
+
+
+def get_raw_archive() -> Optional[RawArchive]:
+    """
+    Trả về RawArchive cho một lần refresh (run_id mới), hoặc None nếu RAW_ARCHIVE_ENABLED tắt.
+    """
+    return RawArchive() if RAW_ARCHIVE_ENABLED else None
@@ -0,0 +1,60 @@
+# Script transform + nạp lại bảng Fact insights từ archive thô (raw_archive), KHÔNG gọi Graph API.
+# Dùng sau khi đổi logic bóc tách (VD: thêm action_type mới) để dựng lại lịch sử mà không tốn quota.
+# Ví dụ:
+#   python retransform.py --start 2025-01-01 --end 2025-12-31
+#   python retransform.py --start 2025-10-01 --end 2025-10-31 --kinds insights_platform --accounts act_123 --workers 8
+
+import argparse
+import logging
+from datetime import date
+from database_manager import DatabaseManager
+from raw_archive import INSIGHT_KINDS, RAW_ARCHIVE_DIR, RAW_ARCHIVE_RELOAD_WORKERS
+
+# Cấu hình logging cơ bản
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S'
+)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Transform và nạp lại Fact insights từ archive thô (không gọi API).")
+    parser.add_argument('--start', required=True, type=date.fromisoformat, help="Ngày bắt đầu (YYYY-MM-DD, bao gồm)")
+    parser.add_argument('--end', required=True, type=date.fromisoformat, help="Ngày kết thúc (YYYY-MM-DD, bao gồm)")
+    parser.add_argument('--kinds', nargs='+', choices=INSIGHT_KINDS, default=list(INSIGHT_KINDS),
+                        help="Các loại insights cần nạp lại (mặc định: tất cả)")
+    parser.add_argument('--accounts', nargs='+', default=None, help="Chỉ nạp lại các tài khoản này (VD: act_123)")
+    parser.add_argument('--workers', type=int, default=RAW_ARCHIVE_RELOAD_WORKERS, help="Số thread đọc/giải nén song song")
+    parser.add_argument('--archive-dir', default=RAW_ARCHIVE_DIR, help="Thư mục gốc của archive")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.start > args.end:
+        logging.error("--start phải nhỏ hơn hoặc bằng --end.")
+        return 1
+
+    logging.info(f"--- BẮT ĐẦU TRANSFORM LẠI TỪ ARCHIVE ({args.start} -> {args.end}) ---")
+    try:
+        db_manager = DatabaseManager()
+        db_manager.create_all_tables()
+        db_manager.reload_from_archive(
+            start_date=args.start.isoformat(),
+            end_date=args.end.isoformat(),
+            kinds=args.kinds,
+            account_ids=args.accounts,
+            archive_root=args.archive_dir,
+            max_workers=args.workers
+        )
+    except Exception as e:
+        logging.error(f"LỖI khi transform lại từ archive: {e}", exc_info=True)
+        return 1
+
+    logging.info("--- ĐÃ HOÀN THÀNH TRANSFORM LẠI TỪ ARCHIVE ---")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -1,13 +1,47 @@
 import boto3
-import requests
 import os
 import logging
+import threading
+import tempfile
+import xxhash
 from io import BytesIO
+from PIL import Image, ImageOps
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Optional
 from urllib.parse import urlparse
 from botocore.config import Config
+from boto3.s3.transfer import TransferConfig
+from graph_client import get_graph_client
 
 logger = logging.getLogger(__name__)
 
+# Số worker tải/upload ảnh song song của MediaMirrorPipeline
+MEDIA_MIRROR_WORKERS = int(os.getenv("MEDIA_MIRROR_WORKERS", 4))
+
+# Tải/upload ảnh theo dạng stream, bộ nhớ dùng cho mỗi ảnh bị chặn trên:
+# - MEDIA_STREAM_CHUNK_BYTES: kích thước mỗi khối đọc từ HTTP response
+# - MEDIA_SPOOL_MAX_BYTES: phần giữ trong RAM trước khi ghi tràn ra file tạm trên đĩa
+# - MEDIA_MULTIPART_CHUNK_BYTES: kích thước mỗi part khi upload multipart (tối thiểu 5MB theo S3)
+MEDIA_STREAM_CHUNK_BYTES = int(os.getenv("MEDIA_STREAM_CHUNK_BYTES", 256 * 1024))
+MEDIA_SPOOL_MAX_BYTES = int(os.getenv("MEDIA_SPOOL_MAX_BYTES", 1024 * 1024))
+MEDIA_MULTIPART_CHUNK_BYTES = int(os.getenv("MEDIA_MULTIPART_CHUNK_BYTES", 8 * 1024 * 1024))
+
+# Các bản thu nhỏ WebP (theo chiều rộng, px) tạo kèm khi mirror ảnh post
+MEDIA_THUMBNAIL_WIDTHS = sorted(int(w) for w in os.getenv("MEDIA_THUMBNAIL_WIDTHS", "160,480,1024").split(',') if w.strip())
+MEDIA_THUMBNAIL_QUALITY = int(os.getenv("MEDIA_THUMBNAIL_QUALITY", 80))
+
+def pick_picture_variant(picture_variants: Optional[Dict[str, str]], min_width: int) -> Optional[str]:
+    """
+    Chọn bản thu nhỏ nhỏ nhất có chiều rộng >= min_width (nếu không có thì lấy bản lớn nhất).
+    Trả về None nếu ảnh chưa có bản thu nhỏ.
+    """
+    if not picture_variants:
+        return None
+    widths = sorted(int(w) for w in picture_variants)
+    chosen = next((w for w in widths if w >= min_width), widths[-1])
+    return picture_variants[str(chosen)]
+
+
 class StorageManager:
     def __init__(self):
         self.endpoint_url = os.getenv('R2_ENDPOINT_URL')
@@ -29,58 +63,230 @@ class StorageManager:
             self.s3_client = None
             logger.warning("R2 Credentials chưa được cấu hình.")
 
+        # Upload multipart tuần tự theo từng part: mỗi ảnh chỉ giữ tối đa một part trong RAM
+        self.transfer_config = TransferConfig(
+            multipart_threshold=MEDIA_MULTIPART_CHUNK_BYTES,
+            multipart_chunksize=MEDIA_MULTIPART_CHUNK_BYTES,
+            max_concurrency=1,
+            use_threads=False
+        )
+
+        # Tải ảnh qua pool kết nối dùng chung với extractor
+        self.http_client = get_graph_client()
+
+        # Hash nội dung (xxh3) của các ảnh đã có trên R2 (ảnh gốc + đủ bản thu nhỏ) trong tiến trình này, tránh HEAD lặp lại
+        self._known_hashes = set()
+        self._hash_lock = threading.Lock()
+
+    def _public_url(self, file_key):
+        """Tạo URL vĩnh viễn cho một object trên R2."""
+        # Xử lý chuẩn hóa domain (bỏ dấu / ở cuối nếu có)
+        domain = self.public_domain.rstrip('/')
+        if not domain.startswith('http'):
+            domain = f'https://{domain}'
+        return f"{domain}/{file_key}"
+
+    def _object_exists(self, file_key):
+        """HEAD object trên R2. Trả về True nếu object đã tồn tại."""
+        try:
+            self.s3_client.head_object(Bucket=self.bucket_name, Key=file_key)
+            return True
+        except self.s3_client.exceptions.ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+
+    def find_mirrored_post_image(self, post_id):
+        """
+        Kiểm tra ảnh đã được mirror theo cách đặt tên cũ (posts/{post_id}.*).
+        Trả về Public URL nếu đã có, ngược lại None.
+        """
+        if not self.s3_client:
+            return None
+        response = self.s3_client.list_objects_v2(Bucket=self.bucket_name, Prefix=f"posts/{post_id}.", MaxKeys=1)
+        contents = response.get('Contents') or []
+        if not contents:
+            return None
+        return self._public_url(contents[0]['Key'])
+
+    def _upload_variants(self, spool, content_hash):
+        """
+        Tạo các bản thu nhỏ WebP (MEDIA_THUMBNAIL_WIDTHS) từ ảnh gốc trong spool và upload lên R2
+        với key media/{hash}_w{width}.webp. Ảnh nhỏ hơn width được giữ nguyên kích thước.
+        Trả về {width (str): url}.
+        """
+        spool.seek(0)
+        with Image.open(spool) as img:
+            # Với JPEG, decode trực tiếp ở độ phân giải gần nhất đủ dùng để tiết kiệm RAM
+            img.draft('RGB', (max(MEDIA_THUMBNAIL_WIDTHS), max(MEDIA_THUMBNAIL_WIDTHS) * 4))
+            base = ImageOps.exif_transpose(img)
+            base = base.convert('RGBA' if base.mode in ('RGBA', 'LA', 'P') else 'RGB')
+
+        variants = {}
+        # Thu nhỏ dần từ lớn đến nhỏ, mỗi bước dùng lại kết quả của bước trước
+        for width in sorted(MEDIA_THUMBNAIL_WIDTHS, reverse=True):
+            base.thumbnail((width, base.height), Image.LANCZOS)
+            buf = BytesIO()
+            base.save(buf, format='WEBP', quality=MEDIA_THUMBNAIL_QUALITY, method=4)
+            buf.seek(0)
+            variant_key = f"media/{content_hash}_w{width}.webp"
+            self.s3_client.upload_fileobj(buf, self.bucket_name, variant_key, ExtraArgs={'ContentType': 'image/webp'})
+            variants[str(width)] = self._public_url(variant_key)
+        return variants
+
+    def _variant_urls(self, content_hash):
+        return {str(width): self._public_url(f"media/{content_hash}_w{width}.webp") for width in MEDIA_THUMBNAIL_WIDTHS}
+
+    def _variants_exist(self, content_hash):
+        return all(self._object_exists(f"media/{content_hash}_w{width}.webp") for width in MEDIA_THUMBNAIL_WIDTHS)
+
     def process_and_upload_image(self, meta_url, post_id):
         """
-        1. Tải ảnh từ Meta URL (có token).
-        2. Upload lên R2.
-        3. Trả về Public URL vĩnh viễn.
+        Mirror ảnh post lên R2 và trả về Public URL vĩnh viễn (xem mirror_post_image).
         """
+        return self.mirror_post_image(meta_url, post_id)['full_picture_url']
+
+    def mirror_post_image(self, meta_url, post_id) -> Dict[str, Any]:
+        """
+        1. Bỏ qua nếu ảnh của post đã được mirror (posts/{post_id}.*).
+        2. Tải ảnh từ Meta URL (có token) theo dạng stream vào file tạm (RAM giới hạn), đồng thời tính hash.
+        3. Upload lên R2 theo hash nội dung (media/{xxh3}{ext}), ảnh trùng giữa các post chỉ lưu một lần,
+           kèm các bản thu nhỏ WebP.
+        4. Trả về {'full_picture_url': url, 'picture_variants': {width: url} hoặc None}.
+        """
+        result = {'full_picture_url': meta_url, 'picture_variants': None}
         if not self.s3_client or not meta_url:
-            return meta_url # Fallback về link gốc nếu chưa cấu hình
+            return result # Fallback về link gốc nếu chưa cấu hình
 
         try:
-            # B1: Tải ảnh về RAM
-            response = requests.get(meta_url, stream=True, timeout=15)
+            # B1: Ảnh đã được mirror trước đây -> dùng lại
+            existing_url = self.find_mirrored_post_image(post_id)
+            if existing_url:
+                logger.info(f"Ảnh của post {post_id} đã có trên R2, bỏ qua: {existing_url}")
+                result['full_picture_url'] = existing_url
+                return result
+
+            # B2: Tải ảnh theo dạng stream
+            response = self.http_client.get(meta_url, stream=True)
             if response.status_code != 200:
+                response.close()
                 logger.error(f"Không thể tải ảnh từ Meta: {meta_url}")
-                return meta_url
+                return result
 
-            # B2: Tạo tên file và metadata
+            # B3: Tạo tên file và metadata
             # Lấy đuôi file (.jpg, .png) từ url gốc, mặc định là .jpg
             path = urlparse(meta_url).path
             ext = os.path.splitext(path)[1]
             if not ext:
                 ext = '.jpg'
             
-            # Đặt tên file theo Post ID để dễ quản lý và tránh trùng lặp
-            file_key = f"posts/{post_id}{ext}"
-            
             # ContentType rất quan trọng để trình duyệt hiển thị ảnh thay vì tải xuống
             content_type = response.headers.get('content-type', 'image/jpeg')
-            file_obj = BytesIO(response.content)
-
-            # B3: Upload lên R2
-            self.s3_client.upload_fileobj(
-                file_obj,
-                self.bucket_name,
-                file_key,
-                ExtraArgs={
-                    'ContentType': content_type,
-                    # 'ACL': 'public-read' # R2 thường quản lý public qua Bucket Policy, dòng này có thể bỏ nếu lỗi
-                }
-            )
 
-            # B4: Tạo URL vĩnh viễn
-            # Xử lý chuẩn hóa domain (bỏ dấu / ở cuối nếu có)
-            domain = self.public_domain.rstrip('/')
-            if not domain.startswith('http'):
-                domain = f'https://{domain}'
-            
-            permanent_url = f"{domain}/{file_key}"
+            # Ghi body vào file tạm (giữ trong RAM tới MEDIA_SPOOL_MAX_BYTES, vượt thì tràn ra đĩa)
+            # và tính hash nội dung trong cùng một lượt đọc
+            with tempfile.SpooledTemporaryFile(max_size=MEDIA_SPOOL_MAX_BYTES) as spool:
+                hasher = xxhash.xxh3_64()
+                try:
+                    for chunk in response.iter_content(chunk_size=MEDIA_STREAM_CHUNK_BYTES):
+                        if chunk:
+                            hasher.update(chunk)
+                            spool.write(chunk)
+                finally:
+                    response.close()
+
+                # Đặt tên file theo hash nội dung: cùng một creative dùng cho nhiều post chỉ lưu một lần
+                content_hash = hasher.hexdigest()
+                file_key = f"media/{content_hash}{ext}"
+                permanent_url = self._public_url(file_key)
+
+                with self._hash_lock:
+                    already_known = content_hash in self._known_hashes
+                if already_known or self._object_exists(file_key):
+                    # Ảnh mirror trước khi có bản thu nhỏ (hoặc lần trước tạo lỗi / thiếu width): tạo bổ sung
+                    if not already_known and MEDIA_THUMBNAIL_WIDTHS and not self._variants_exist(content_hash):
+                        result['picture_variants'] = self._safe_upload_variants(spool, content_hash, post_id)
+                    else:
+                        result['picture_variants'] = self._variant_urls(content_hash) if MEDIA_THUMBNAIL_WIDTHS else None
+                    self._remember_hash(content_hash, result['picture_variants'])
+                    logger.info(f"Ảnh của post {post_id} trùng nội dung với ảnh đã có: {permanent_url}")
+                    result['full_picture_url'] = permanent_url
+                    return result
+
+                # B4: Upload lên R2 (multipart theo từng part nếu ảnh lớn)
+                spool.seek(0)
+                self.s3_client.upload_fileobj(
+                    spool,
+                    self.bucket_name,
+                    file_key,
+                    ExtraArgs={
+                        'ContentType': content_type,
+                        # 'ACL': 'public-read' # R2 thường quản lý public qua Bucket Policy, dòng này có thể bỏ nếu lỗi
+                    },
+                    Config=self.transfer_config
+                )
+                result['picture_variants'] = self._safe_upload_variants(spool, content_hash, post_id)
+            self._remember_hash(content_hash, result['picture_variants'])
             
             logger.info(f"Đã upload R2 thành công: {permanent_url}")
-            return permanent_url
+            result['full_picture_url'] = permanent_url
+            return result
 
         except Exception as e:
             logger.error(f"Lỗi khi upload ảnh R2 cho post {post_id}: {e}")
-            return meta_url # Fallback về link gốc để không mất dữ liệu
\ No newline at end of file
+            return result # Fallback về link gốc để không mất dữ liệu
+
+    def _remember_hash(self, content_hash, variants):
+        """Chỉ ghi nhớ hash khi ảnh gốc và đủ các bản thu nhỏ đã có trên R2, để lần sau không trả URL WebP chết."""
+        if MEDIA_THUMBNAIL_WIDTHS and not variants:
+            return
+        with self._hash_lock:
+            self._known_hashes.add(content_hash)
+
+    def _safe_upload_variants(self, spool, content_hash, post_id):
+        """Tạo bản thu nhỏ; lỗi (VD: định dạng Pillow không đọc được) chỉ được log, ảnh gốc vẫn dùng được."""
+        if not MEDIA_THUMBNAIL_WIDTHS:
+            return None
+        try:
+            return self._upload_variants(spool, content_hash)
+        except Exception as e:
+            logger.warning(f"Không thể tạo ảnh thu nhỏ cho post {post_id}: {e}")
+            return None
+
+
+class MediaMirrorPipeline:
+    """
+    Mirror ảnh post lên R2 như một bước riêng, chạy nền với pool worker giới hạn.
+
+    - submit() chỉ xếp việc vào pool và trả về ngay, việc lấy post không phải chờ tải/upload ảnh.
+    - Mỗi post chỉ được mirror một lần trong một pipeline.
+    - drain() chờ các việc còn lại và trả về {post_id: {'full_picture_url', 'picture_variants'}}
+      (URL R2, hoặc URL gốc nếu mirror lỗi).
+    """
+
+    def __init__(self, storage_manager: StorageManager, max_workers: Optional[int] = None):
+        self.storage_manager = storage_manager
+        self._executor = ThreadPoolExecutor(max_workers=max_workers or MEDIA_MIRROR_WORKERS,
+                                            thread_name_prefix='media-mirror')
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def submit(self, post_id, meta_url):
+        if not post_id or not meta_url:
+            return
+        with self._lock:
+            if post_id in self._futures:
+                return
+            self._futures[post_id] = self._executor.submit(self.storage_manager.mirror_post_image, meta_url, post_id)
+
+    def drain(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            futures = dict(self._futures)
+        results = {}
+        for post_id, future in futures.items():
+            mirrored = future.result()  # mirror_post_image tự bắt lỗi và trả về URL gốc
+            if mirrored.get('full_picture_url'):
+                results[post_id] = mirrored
+        self._executor.shutdown(wait=True)
+        logger.info(f"Hoàn tất mirror ảnh cho {len(results)} post.")
+        return results
@@ -0,0 +1,59 @@
+import orjson
+from graph_client import GraphClient
+
+
+class FakeResponse:
+    def __init__(self, payload: dict, read_bytes: int = 1000):
+        self.body = orjson.dumps(payload)
+        self.read_bytes = read_bytes
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size=None):
+        for start in range(0, len(self.body), self.read_bytes):
+            yield self.body[start:start + self.read_bytes]
+
+    def close(self):
+        pass
+
+
+def make_client(pages):
+    client = GraphClient()
+    requested = []
+
+    def fake_get(url, params=None, stream=False):
+        requested.append(url)
+        return FakeResponse(pages[url])
+
+    client.get = fake_get
+    return client, requested
+
+
+def test_iter_page_chunks_follows_next_after_exact_multiple_page():
+    first = [{'id': str(i)} for i in range(200)]
+    second = [{'id': str(i)} for i in range(200, 250)]
+    client, requested = make_client({
+        'page1': {'data': first, 'paging': {'next': 'page2'}},
+        'page2': {'data': second, 'paging': {}},
+    })
+
+    chunks = list(client.iter_page_chunks('page1', chunk_records=100))
+
+    assert requested == ['page1', 'page2']
+    assert all(chunk['data'] for chunk in chunks)
+    assert [record for chunk in chunks for record in chunk['data']] == first + second
+    # 'paging' chỉ gắn vào lô cuối của mỗi trang
+    assert [chunk['paging'] for chunk in chunks] == [{}, {'next': 'page2'}, {}]
+
+
+def test_iter_page_chunks_stops_on_empty_page():
+    client, requested = make_client({
+        'page1': {'data': [{'id': '1'}], 'paging': {'next': 'page2'}},
+        'page2': {'data': [], 'paging': {'next': 'page3'}},
+    })
+
+    chunks = list(client.iter_page_chunks('page1', chunk_records=100))
+
+    assert requested == ['page1', 'page2']
+    assert [chunk['data'] for chunk in chunks] == [[{'id': '1'}], []]